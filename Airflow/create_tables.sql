@@ -16,6 +16,7 @@ CREATE TABLE public.songplays (
 	sessionid int4,
 	location varchar(256),
 	user_agent varchar(256),
+	time_key int4 NOT NULL,
 	CONSTRAINT songplays_pkey PRIMARY KEY (playid)
 );
 
@@ -62,16 +63,23 @@ CREATE TABLE public.staging_songs (
 	"year" int4
 );
 
+-- Calendar loaded by LoadCalendarOperator (see calendar_dimension.py): one row per hour,
+-- identified by the number of hours since 1970-01-01
 CREATE TABLE public."time" (
+	time_key int4 NOT NULL,
 	start_time timestamp NOT NULL,
-	"hour" int4,
-	"day" int4,
-	week int4,
-	"month" varchar(256),
-	"year" int4,
-	weekday varchar(256),
-	CONSTRAINT time_pkey PRIMARY KEY (start_time)
-);
+	"date" date NOT NULL,
+	"hour" int2 NOT NULL,
+	"day" int2 NOT NULL,
+	week int2 NOT NULL,
+	"month" int2 NOT NULL,
+	quarter int2 NOT NULL,
+	"year" int2 NOT NULL,
+	weekday int2 NOT NULL,
+	is_weekend boolean NOT NULL,
+	CONSTRAINT time_pkey PRIMARY KEY (time_key)
+) DISTSTYLE ALL
+SORTKEY (time_key);
 
 CREATE TABLE public.users (
 	userid int4 NOT NULL,
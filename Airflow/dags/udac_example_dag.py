@@ -3,7 +3,8 @@ import os
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
-                                LoadDimensionOperator, DataQualityOperator)
+                                LoadDimensionOperator, DataQualityOperator,
+                                LoadCalendarOperator)
 from helpers import SqlQueries
 
 # AWS_KEY = os.environ.get('AWS_KEY')
@@ -12,6 +13,9 @@ from helpers import SqlQueries
 #bucket_name = 'dataengineering-nano-dwh-bucket'
 bucket_name = 'udacity-dend'
 
+# Bucket the generated calendar files are written to, before their COPY
+calendar_bucket = 'dataengineering-nano-dwh-bucket'
+
 #
 # Default arguments for the DAG
 #     - Retry 3 times
@@ -70,7 +74,8 @@ load_songplays_table = LoadFactOperator(
     dag=dag,
     redshift_conn_id="redshift",
     table="songplays",
-    query=SqlQueries.songplay_table_insert
+    query=SqlQueries.songplay_table_insert,
+    rollups=True
 )
 
 load_user_dimension_table = LoadDimensionOperator(
@@ -100,13 +105,20 @@ load_artist_dimension_table = LoadDimensionOperator(
     query = SqlQueries.artist_table_insert
 )
 
-load_time_dimension_table = LoadDimensionOperator(
+#
+# The calendar covers the year of the run and the staged song plays.  It is only extended
+# with the days it does not cover yet, instead of being rebuilt from songplays.
+#
+load_time_dimension_table = LoadCalendarOperator(
     task_id='Load_time_dim_table',
     dag=dag,
-    redshift_conn_id = "redshift",
-    clear=True,
-    table = "time",
-    query = SqlQueries.time_table_insert
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    table="time",
+    s3_bucket=calendar_bucket,
+    calendar_start="{execution_date.year}-01-01",
+    calendar_end="{execution_date.year}-12-31",
+    grain=SqlQueries.calendar_grain
 )
 
 #
@@ -114,7 +126,9 @@ load_time_dimension_table = LoadDimensionOperator(
 #
 dq_checks=[
     {'check_sql': "SELECT COUNT(*) FROM users WHERE userid is null", 'expected_result': 0},
-    {'check_sql': "SELECT COUNT(*) FROM songs WHERE songid is null", 'expected_result': 0}
+    {'check_sql': "SELECT COUNT(*) FROM songs WHERE songid is null", 'expected_result': 0},
+    {'check_sql': "SELECT COUNT(*) FROM songplays sp LEFT JOIN time t ON sp.time_key = t.time_key WHERE t.time_key is null",
+     'expected_result': 0}
 ]
 
 run_quality_checks = DataQualityOperator(
@@ -134,7 +148,7 @@ stage_songs_to_redshift >> load_songplays_table
 load_songplays_table >> load_song_dimension_table
 load_songplays_table >> load_user_dimension_table
 load_songplays_table >> load_artist_dimension_table
-load_songplays_table >> load_time_dimension_table
+stage_events_to_redshift >> load_time_dimension_table
 load_song_dimension_table >> run_quality_checks
 load_user_dimension_table >> run_quality_checks
 load_artist_dimension_table >> run_quality_checks
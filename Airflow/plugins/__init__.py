@@ -12,7 +12,8 @@ class UdacityPlugin(AirflowPlugin):
         operators.StageToRedshiftOperator,
         operators.LoadFactOperator,
         operators.LoadDimensionOperator,
-        operators.DataQualityOperator
+        operators.DataQualityOperator,
+        operators.LoadCalendarOperator
     ]
     helpers = [
         helpers.SqlQueries
@@ -1,4 +1,8 @@
 class SqlQueries:
+    # Grain of the time table loaded by LoadCalendarOperator, and of the time_key of songplays:
+    # the number of hours since 1970-01-01, like get_time_key_sql() of calendar_dimension.py
+    calendar_grain = 'hour'
+
     songplay_table_insert = ("""
         SELECT
                 md5(events.sessionid || events.start_time) songplay_id,
@@ -9,7 +13,8 @@ class SqlQueries:
                 songs.artist_id, 
                 events.sessionid, 
                 events.location, 
-                events.useragent
+                events.useragent,
+                DATEDIFF(hour, TIMESTAMP '1970-01-01', events.start_time) time_key
                 FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
             FROM staging_events
             WHERE page='NextSong') events
@@ -33,10 +38,4 @@ class SqlQueries:
     artist_table_insert = ("""
         SELECT distinct artist_id, artist_name, artist_location, artist_latitude, artist_longitude
         FROM staging_songs
-    """)
-
-    time_table_insert = ("""
-        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
-               extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
-        FROM songplays
     """)
\ No newline at end of file
@@ -0,0 +1,104 @@
+import os
+import sys
+from datetime import datetime
+from airflow.contrib.hooks.aws_hook import AwsHook
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+class LoadCalendarOperator(BaseOperator):
+    '''LoadCalendarOperator:
+       This operator makes sure that the calendar (time) table covers a range of days, and
+       the days of the staged song plays.  The missing days are generated by
+       calendar_dimension.py, written to S3 as a gzip'd CSV file, and loaded with one COPY;
+       the days already in the table are not loaded again.
+       Args:
+       redshift_conn_id: The connection ID to Redshift.
+       aws_credentials_id: The credential ID in Airflow.
+       table: The calendar table.
+       s3_bucket: The S3 bucket the calendar files are written to.
+       calendar_start: First day of the calendar, YYYY-MM-DD, formatted with the context.
+       calendar_end: Last day of the calendar, YYYY-MM-DD, formatted with the context.
+       grain: Period of a row: day, hour, minute or second.  It must be the grain of the
+           time_key of the fact table.
+    '''
+    ui_color = '#80BD9E'
+
+    template_fields = ("calendar_start", "calendar_end")
+
+    copy_sql = """
+        COPY {}
+        FROM %s
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        COMPUPDATE OFF
+        REGION 'us-west-2'
+        CSV
+        GZIP
+        TIMEFORMAT 'YYYY-MM-DD HH:MI:SS';
+    """
+
+    staged_range_sql = """
+        SELECT MIN(TIMESTAMP 'epoch' + ts/1000 * interval '1 second'),
+               MAX(TIMESTAMP 'epoch' + ts/1000 * interval '1 second')
+        FROM staging_events
+        WHERE page='NextSong'
+    """
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id='',
+                 aws_credentials_id='',
+                 table='time',
+                 s3_bucket='',
+                 calendar_start='',
+                 calendar_end='',
+                 grain='hour',
+                 *args, **kwargs):
+
+        super(LoadCalendarOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.aws_credentials_id = aws_credentials_id
+        self.table = table
+        self.s3_bucket = s3_bucket
+        self.calendar_start = calendar_start
+        self.calendar_end = calendar_end
+        self.grain = grain
+
+    def execute(self, context):
+        # calendar_dimension.py is shared with the Redshift ETL, at the root of the repository.  When
+        # the plugins are deployed on their own, copy it (and staging_manifest.py) into the plugins
+        # folder.  It is only imported here, so that the other operators work without it.
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir)
+        if root not in sys.path:
+            sys.path.append(root)
+        from calendar_dimension import load_calendar
+        from staging_manifest import S3Store
+
+        aws_hook = AwsHook(self.aws_credentials_id)
+        credentials = aws_hook.get_credentials()
+        staging = S3Store(self.s3_bucket, aws_hook.get_client_type('s3'))
+        copy_sql = LoadCalendarOperator.copy_sql.format(self.table, credentials.access_key, credentials.secret_key)
+
+        start_date = datetime.strptime(self.calendar_start.format(**context), '%Y-%m-%d').date()
+        end_date = datetime.strptime(self.calendar_end.format(**context), '%Y-%m-%d').date()
+
+        conn = PostgresHook(self.redshift_conn_id).get_conn()
+        cur = conn.cursor()
+        try:
+            cur.execute(LoadCalendarOperator.staged_range_sql)
+            first, last = cur.fetchone()
+            if first is not None:
+                start_date = min(start_date, first.date())
+                end_date = max(end_date, last.date())
+
+            self.log.info("Loading the calendar of {} from {} to {}".format(self.table, start_date, end_date))
+            rows = load_calendar(cur, staging, 'calendar/{}/'.format(self.table), copy_sql,
+                                 start_date, end_date, self.grain, self.table)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.log.info("Added {} rows to {}".format(rows, self.table))
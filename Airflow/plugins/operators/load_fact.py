@@ -1,3 +1,5 @@
+import os
+import sys
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
@@ -10,21 +12,27 @@ class LoadFactOperator(BaseOperator):
        redshift_conn_id: The connection ID to Redshift.
        table: The destination table.
        query: The query to select the data to insert into the table.
+       rollups: If set, the days of the inserted rows (their start_time) are aggregated
+           again in the rollups of the table, in the same transaction as the insert.
     '''
     
     ui_color = '#F98866'
 
+    rollup_days_sql = 'SELECT DISTINCT TRUNC(start_time) FROM ({}) AS loaded'
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  table="",
                  query="",
+                 rollups=False,
                  *args, **kwargs):
 
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id = redshift_conn_id
         self.table = table
         self.query = query
+        self.rollups = rollups
 
     def execute(self, context):
 
@@ -32,4 +40,30 @@ class LoadFactOperator(BaseOperator):
 
         self.log.info("Inserting into {}".format(self.table))
         sql_stmt = 'INSERT INTO {} {};'.format(self.table, self.query)
-        redshift_hook.run(sql_stmt)
+
+        if not self.rollups:
+            redshift_hook.run(sql_stmt)
+            return
+
+        # rollups.py is shared with the Redshift ETL, at the root of the repository.  When the
+        # plugins are deployed on their own, copy it (and the modules it imports) into the plugins
+        # folder.  It is only imported here, so that the operator works without it when the
+        # rollups are not refreshed.
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir)
+        if root not in sys.path:
+            sys.path.append(root)
+        from rollups import AIRFLOW_COLUMNS, refresh_rollups
+
+        conn = redshift_hook.get_conn()
+        cur = conn.cursor()
+        try:
+            cur.execute(sql_stmt)
+            days = refresh_rollups(cur, LoadFactOperator.rollup_days_sql.format(self.query),
+                                   columns=AIRFLOW_COLUMNS, fact_table=self.table)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.log.info("Refreshed {} days in the rollups of {}".format(len(days), self.table))
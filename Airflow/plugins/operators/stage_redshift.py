@@ -1,3 +1,5 @@
+import os
+import sys
 from airflow.contrib.hooks.aws_hook import AwsHook
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
@@ -14,6 +16,11 @@ class StageToRedshiftOperator(BaseOperator):
        s3_bucket: The name of the S3 bucket.
        s3_key: The name of the S3 key.
        json_args: JSON arguments for the COPY command.
+       manifest_bucket: If set, the objects under the S3 key are listed, and loaded through a
+           COPY manifest written to this bucket, instead of from the bare prefix.
+       compact: With a manifest bucket, first combine the objects into gzip'd files balanced
+           over the slices of the cluster.
+       target_file_size: Size of the compacted files in MB, before compression.
     '''   
     ui_color = '#358140'
 
@@ -27,7 +34,8 @@ class StageToRedshiftOperator(BaseOperator):
         COMPUPDATE OFF
         REGION 'us-west-2'
         JSON {}
-        TIMEFORMAT 'epochmillisecs';
+        TIMEFORMAT 'epochmillisecs'
+        {};
     """
 
     @apply_defaults
@@ -38,6 +46,9 @@ class StageToRedshiftOperator(BaseOperator):
                  s3_bucket="",
                  s3_key="",
                  json_args="",
+                 manifest_bucket="",
+                 compact=False,
+                 target_file_size=64,
                  *args, **kwargs):
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
@@ -47,6 +58,9 @@ class StageToRedshiftOperator(BaseOperator):
         self.s3_bucket = s3_bucket
         self.s3_key = s3_key
         self.json_args = json_args
+        self.manifest_bucket = manifest_bucket
+        self.compact = compact
+        self.target_file_size = target_file_size
 
     def execute(self, context):
         aws_hook = AwsHook(self.aws_credentials_id)
@@ -59,11 +73,49 @@ class StageToRedshiftOperator(BaseOperator):
         self.log.info("Copying data from S3 to Redshift")
         rendered_key = self.s3_key.format(**context)
         s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
+        copy_options = ""
+
+        if self.manifest_bucket:
+            s3_path, copy_options = self.write_manifest(aws_hook, redshift, rendered_key, context)
+
         formatted_sql = StageToRedshiftOperator.copy_sql.format(
             self.table,
             s3_path,
             credentials.access_key,
             credentials.secret_key,
-            self.json_args
+            self.json_args,
+            copy_options
         )
         redshift.run(formatted_sql)
+
+    def write_manifest(self, aws_hook, redshift, rendered_key, context):
+        '''
+        Lists the objects under the key, optionally compacts them, and writes a COPY manifest
+        to the manifest bucket.  Returns the manifest URL and the extra COPY options.
+        '''
+        # staging_manifest.py is shared with the Redshift ETL, at the root of the repository.  When
+        # the plugins are deployed on their own, copy it into the plugins folder, which is on the
+        # path.  It is only imported here, so that the operator works without it when no manifest
+        # is used.
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir)
+        if root not in sys.path:
+            sys.path.append(root)
+        from staging_manifest import S3Store, build_manifest, write_manifest, get_slice_count
+
+        client = aws_hook.get_client_type('s3')
+        staging = S3Store(self.manifest_bucket, client)
+        conn = redshift.get_conn()
+        try:
+            slices = get_slice_count(conn.cursor())
+        finally:
+            conn.close()
+        run_prefix = '{}/{}'.format(self.table, context['ts_nodash'])
+
+        manifest = build_manifest(S3Store(self.s3_bucket, client), rendered_key, slices,
+                                  compact_store=staging if self.compact else None,
+                                  compact_prefix='compacted/{}/'.format(run_prefix),
+                                  target_size=self.target_file_size * 1024 * 1024)
+        manifest_url = write_manifest(staging, 'manifests/{}.manifest'.format(run_prefix), manifest)
+        self.log.info("Wrote a manifest of {} files to {}".format(len(manifest['entries']), manifest_url))
+
+        return manifest_url, 'MANIFEST GZIP' if manifest['gzip'] else 'MANIFEST'
@@ -0,0 +1,67 @@
+import json
+import argparse
+
+
+def get_change(before, after):
+    if before is None or after is None:
+        return 'n/a'
+    if before == 0:
+        return 'n/a' if after == 0 else 'new'
+    return '{:+.1f}%'.format((after - before) * 100.0 / before)
+
+
+def compare(before, after):
+    """
+    Returns the lines of a comparison of two results files: the wall time, rows per second
+    and peak RSS of each target, and the time spent in each stage.
+    """
+    lines = ['{} ({}) -> {} ({})'.format(before['label'], before['created_at'], after['label'], after['created_at'])]
+
+    if before['dataset']['parameters'] != after['dataset']['parameters']:
+        lines.append('WARNING: the runs used different data sets: {} and {}'.format(
+            json.dumps(before['dataset']['parameters'], sort_keys=True),
+            json.dumps(after['dataset']['parameters'], sort_keys=True)))
+
+    row_format = '  {:<32} {:>14} {:>14} {:>9}'
+    for target in sorted(set(before['targets']) | set(after['targets'])):
+        old = before['targets'].get(target, {})
+        new = after['targets'].get(target, {})
+        lines.append('')
+        lines.append(target)
+
+        if 'error' in old or 'error' in new or not old or not new:
+            lines.append('  cannot compare: {} / {}'.format(old.get('error', 'ok' if old else 'missing'),
+                                                            new.get('error', 'ok' if new else 'missing')))
+            continue
+
+        lines.append(row_format.format('', 'before', 'after', 'change'))
+        for metric in ['wall_seconds', 'rows_per_second', 'peak_rss_mb']:
+            lines.append(row_format.format(metric, old[metric], new[metric], get_change(old[metric], new[metric])))
+
+        old_stages = old.get('stages', {})
+        new_stages = new.get('stages', {})
+        for stage in sorted(set(old_stages) | set(new_stages)):
+            old_seconds = old_stages.get(stage, {}).get('seconds')
+            new_seconds = new_stages.get(stage, {}).get('seconds')
+            lines.append(row_format.format('stage ' + stage[:26], '-' if old_seconds is None else old_seconds,
+                                           '-' if new_seconds is None else new_seconds, get_change(old_seconds, new_seconds)))
+
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two results files written by run_benchmark.py.')
+    parser.add_argument('before', help='results file of the baseline run')
+    parser.add_argument('after', help='results file of the new run')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print('\n'.join(compare(before, after)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+import os
+import csv
+import json
+import argparse
+from datetime import datetime, timezone
+import numpy as np
+
+
+# Sizes of the sample data sets, which make up the 1x scale
+BASE_SONGS = 71
+BASE_USERS = 96
+BASE_EVENTS = 8056
+
+# Pages of the events that are not song plays, weighted as in the sample log data
+OTHER_PAGES = {
+    'Home': 806, 'Login': 92, 'Logout': 90, 'Downgrade': 60, 'Settings': 56, 'Help': 47, 'About': 36,
+    'Upgrade': 21, 'Save Settings': 10, 'Error': 9, 'Submit Upgrade': 8, 'Submit Downgrade': 1,
+}
+SONG_PLAY_SHARE = 6820 / 8056
+
+# Word lists used to make up names.  A few words contain quotes, ampersands and accents
+# so that the loaders' escaping is exercised.
+WORDS = ['Love', 'Night', 'Blue', 'Fire', 'Heart', 'Dream', 'Rain', 'City', 'Gold', 'Shadow', 'River',
+         'Dance', 'Storm', 'Light', 'Ghost', 'Summer', 'Road', 'Moon', 'Wild', 'Echo', 'Stone', 'Silver',
+         'Electric', 'Paper', 'Broken', 'Golden', 'Lonely', 'Midnight', 'Sweet', 'Crazy', "Don't",
+         'Rock & Roll', 'Café', 'Señorita', 'Über', "O'Connor"]
+FIRST_NAMES = ['Walter', 'Kaylee', 'Jacob', 'Lily', 'Tegan', 'Aleena', 'Jayden', 'Chloe', 'Mohammad',
+               'Ryan', 'Avery', 'Kate', 'Layla', 'Sara', 'Lucas', 'Jordan', 'Noah', 'Emily', 'Connar', 'Anabelle']
+LAST_NAMES = ['Frye', 'Summers', 'Klein', 'Koch', 'Levine', 'Kirby', 'Graves', 'Cuevas', 'Rodriguez',
+              'Smith', 'Martinez', 'Harrell', 'Griffin', 'Johnson', "O'Brien", 'Moreno', 'Simpson', 'Lynch']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Lansing-East Lansing, MI',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Tampa-St. Petersburg-Clearwater, FL', 'Portland-South Portland, ME', 'Houston-The Woodlands-Sugar Land, TX']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"',
+]
+
+ID_CHARS = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+
+# Columns of the event CSV files, in the order of the sample files
+EVENT_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level',
+                 'location', 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userId']
+
+
+def get_weights(n, skew):
+    """
+    Returns Zipf-like weights for n items: the item of rank r gets a weight of 1 / r^skew.
+    A skew of 0 gives uniform weights.
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def sample(rng, cdf, size=None):
+    """
+    Draws item indexes from the cumulative weights of the items.  Unlike rng.choice with p,
+    the cumulative weights are only computed once, which matters for large data sets.
+    """
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side='right'), len(cdf) - 1)
+
+
+def get_ids(rng, prefix, n):
+    """
+    Returns n distinct random ids, e.g. 'SOGVQGJ12AB017F169' for the prefix 'SO'.
+    """
+    ids = set()
+    while len(ids) < n:
+        chars = rng.choice(ID_CHARS, size=(n - len(ids), 16))
+        ids.update(prefix + ''.join(row) for row in chars)
+    return sorted(ids)
+
+
+def get_names(rng, n, min_words=1, max_words=4):
+    """
+    Returns n names made up of words from the word list.  Names can repeat.
+    """
+    lengths = rng.integers(min_words, max_words + 1, size=n)
+    words = rng.choice(WORDS, size=lengths.sum())
+    names = []
+    i = 0
+    for length in lengths:
+        names.append(' '.join(words[i:i + length]))
+        i += length
+    return names
+
+
+def generate_songs(rng, output, num_songs, skew, write=True):
+    """
+    Generates the songs, and writes one song file per song in the song_data/A/B/C folder
+    layout of the sample data (unless write is False).  The songs are spread over the artists
+    with the given skew, so that a few artists have many songs.  Returns the song records,
+    and the number of artists.
+    """
+    num_artists = max(1, int(num_songs * 0.95))
+    artist_ids = get_ids(rng, 'AR', num_artists)
+    artist_names = get_names(rng, num_artists)
+    has_location = rng.random(num_artists) < 0.4
+    latitudes = np.round(rng.uniform(-60, 70, num_artists), 5)
+    longitudes = np.round(rng.uniform(-150, 150, num_artists), 5)
+    locations = rng.choice(LOCATIONS, size=num_artists)
+
+    song_ids = get_ids(rng, 'SO', num_songs)
+    track_ids = get_ids(rng, 'TR', num_songs)
+    titles = get_names(rng, num_songs)
+    artists = rng.choice(num_artists, size=num_songs, p=get_weights(num_artists, skew))
+    durations = np.round(rng.uniform(60, 600, num_songs), 5)
+    years = np.where(rng.random(num_songs) < 0.5, 0, rng.integers(1960, 2011, num_songs))
+
+    songs = []
+    for i in range(num_songs):
+        a = artists[i]
+        song = {
+            'num_songs': 1,
+            'artist_id': artist_ids[a],
+            'artist_latitude': float(latitudes[a]) if has_location[a] else None,
+            'artist_longitude': float(longitudes[a]) if has_location[a] else None,
+            'artist_location': str(locations[a]) if has_location[a] else '',
+            'artist_name': artist_names[a],
+            'song_id': song_ids[i],
+            'title': titles[i],
+            'duration': float(durations[i]),
+            'year': int(years[i]),
+        }
+        songs.append(song)
+        if not write:
+            continue
+
+        track_id = track_ids[i]
+        folder = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+
+    return songs, num_artists
+
+
+def generate_users(rng, num_users):
+    """
+    Returns the user records.  About 1 in 20 users changes level during the month, so that
+    the loaders have to keep the latest level.
+    """
+    users = []
+    for user_id in range(1, num_users + 1):
+        level = 'paid' if rng.random() < 0.6 else 'free'
+        users.append({
+            'userId': str(user_id),
+            'firstName': str(rng.choice(FIRST_NAMES)),
+            'lastName': str(rng.choice(LAST_NAMES)),
+            'gender': 'F' if rng.random() < 0.5 else 'M',
+            'level': level,
+            'new_level': ('free' if level == 'paid' else 'paid') if rng.random() < 0.05 else level,
+            'location': str(rng.choice(LOCATIONS)),
+            'userAgent': str(rng.choice(USER_AGENTS)),
+            'registration': float(1540000000000 + int(rng.integers(0, 2000000000))),
+        })
+    return users
+
+
+def generate_day(rng, day_start, num_events, users, user_cdf, songs, song_cdf, unmatched, match_rate, session_id):
+    """
+    Generates the events of one day, as sessions of consecutive events by the same user.
+    Returns the events sorted by timestamp, and the last session id.
+    """
+    pages = list(OTHER_PAGES)
+    page_cdf = np.cumsum(list(OTHER_PAGES.values())) / sum(OTHER_PAGES.values())
+
+    events = []
+    while len(events) < num_events:
+        length = min(int(rng.geometric(1 / 8.5)), num_events - len(events))
+        ts = day_start + int(rng.integers(0, 86400000))
+        session_id += 1
+
+        # about 1 in 30 sessions is from a logged out visitor, without a user id
+        if rng.random() < 1 / 30:
+            for item in range(length):
+                events.append({
+                    'artist': None, 'auth': 'Logged Out', 'firstName': None, 'gender': None,
+                    'itemInSession': item, 'lastName': None, 'length': None, 'level': 'free',
+                    'location': None, 'method': 'GET', 'page': 'Home', 'registration': None,
+                    'sessionId': session_id, 'song': None, 'status': 200, 'ts': ts,
+                    'userAgent': None, 'userId': '',
+                })
+                ts += int(rng.integers(1000, 60000))
+            continue
+
+        user = users[sample(rng, user_cdf)]
+        level = user['new_level'] if day_start >= user['level_change'] else user['level']
+        plays = rng.random(length) < SONG_PLAY_SHARE
+        matched = rng.random(length) < match_rate
+        song_picks = sample(rng, song_cdf, length)
+        unmatched_picks = rng.integers(0, len(unmatched), size=length)
+
+        for item in range(length):
+            event = {
+                'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                'itemInSession': item, 'lastName': user['lastName'], 'length': None, 'level': level,
+                'location': user['location'], 'method': 'GET', 'page': None,
+                'registration': user['registration'], 'sessionId': session_id, 'song': None, 'status': 200,
+                'ts': ts, 'userAgent': user['userAgent'], 'userId': user['userId'],
+            }
+
+            if plays[item]:
+                song = songs[song_picks[item]] if matched[item] else unmatched[unmatched_picks[item]]
+                event.update(artist=song['artist_name'], song=song['title'], length=song['duration'],
+                             method='PUT', page='NextSong')
+                ts += int(song['duration'] * 1000)
+            else:
+                event['page'] = pages[sample(rng, page_cdf)]
+                if event['page'] in ('Logout', 'Submit Upgrade', 'Submit Downgrade', 'Save Settings'):
+                    event['method'], event['status'] = 'PUT', 307
+                elif event['page'] == 'Error':
+                    event['status'] = 404
+                ts += int(rng.integers(1000, 60000))
+
+            events.append(event)
+
+    events.sort(key=lambda event: event['ts'])
+    return events, session_id
+
+
+def write_events(output, day, events, formats):
+    """
+    Writes the events of a day as a log JSON file and/or an event CSV file, named like
+    the sample files.  Returns the number of bytes written.
+    """
+    name = day.strftime('%Y-%m-%d') + '-events'
+    num_bytes = 0
+
+    if 'log' in formats:
+        folder = os.path.join(output, 'log_data', day.strftime('%Y'), day.strftime('%m'))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name + '.json')
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(event) for event in events))
+        num_bytes += os.path.getsize(path)
+
+    if 'csv' in formats:
+        folder = os.path.join(output, 'event_data')
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name + '.csv')
+        with open(path, 'w', encoding='utf8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(EVENT_COLUMNS)
+            for event in events:
+                writer.writerow(['' if event[column] is None else event[column] for column in EVENT_COLUMNS])
+        num_bytes += os.path.getsize(path)
+
+    return num_bytes
+
+
+def get_folder_size(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def generate(output, scale=1.0, skew=1.0, match_rate=0.5, days=30, seed=0, formats=('song', 'log', 'csv')):
+    """
+    Generates a synthetic Sparkify data set with the schemas of the sample data:
+    - song_data: one JSON file per song, with the songs spread over artists
+    - log_data: one JSON lines file of events per day, starting on 2018-11-01
+    - event_data: the same events as CSV files, in the format of the Cassandra project
+    The data set holds scale times as many songs, users and events as the sample data.
+    Song popularity, user activity and the number of songs per artist follow a Zipf-like
+    distribution with the given skew (0 for uniform).  match_rate is the share of song
+    plays that refer to a song in song_data; the others refer to unknown songs, as most
+    of the sample song plays do.
+    The same parameters and seed always give the same files.  A dataset.json file with
+    the parameters and the row counts is written next to the data.
+    Returns the contents of dataset.json.
+    """
+    rng = np.random.default_rng(seed)
+
+    num_songs = max(1, int(round(BASE_SONGS * scale)))
+    num_users = max(1, int(round(BASE_USERS * scale)))
+    num_events = int(round(BASE_EVENTS * scale))
+
+    print('Generating {} songs'.format(num_songs))
+    songs, num_artists = generate_songs(rng, output, num_songs, skew, write='song' in formats)
+    songs_size = get_folder_size(os.path.join(output, 'song_data'))
+
+    # songs that are played but are not in song_data
+    unmatched = [{'title': title, 'artist_name': name, 'duration': float(duration)} for title, name, duration in
+                 zip(get_names(rng, num_songs * 10), get_names(rng, num_songs * 10), np.round(rng.uniform(60, 600, num_songs * 10), 5))]
+
+    start = datetime(2018, 11, 1, tzinfo=timezone.utc)
+    day_ms = 86400000
+    start_ms = int(start.timestamp() * 1000)
+
+    users = generate_users(rng, num_users)
+    for user in users:
+        user['level_change'] = start_ms + int(rng.integers(0, days)) * day_ms
+    user_cdf = np.cumsum(get_weights(num_users, skew))
+    song_cdf = np.cumsum(get_weights(num_songs, skew))
+
+    counts = {'songs': num_songs, 'artists': num_artists, 'users': num_users, 'events': 0,
+              'song_plays': 0, 'matched_song_plays': 0, 'log_files': 0, 'event_files': 0}
+    events_size = 0
+    session_id = 0
+    titles = {(song['title'], song['artist_name'], song['duration']) for song in songs}
+
+    # spread the events evenly over the days, with the remainder on the last day
+    per_day = [num_events // days] * days
+    per_day[-1] += num_events - sum(per_day)
+
+    for i in range(days):
+        day_start = start_ms + i * day_ms
+        events, session_id = generate_day(rng, day_start, per_day[i], users, user_cdf, songs, song_cdf,
+                                          unmatched, match_rate, session_id)
+        if not events:
+            continue
+
+        day = datetime.fromtimestamp(day_start / 1000, timezone.utc)
+        events_size += write_events(output, day, events, formats)
+
+        plays = [event for event in events if event['page'] == 'NextSong']
+        counts['events'] += len(events)
+        counts['song_plays'] += len(plays)
+        counts['matched_song_plays'] += sum((e['song'], e['artist'], e['length']) in titles for e in plays)
+        counts['log_files'] += 'log' in formats
+        counts['event_files'] += 'csv' in formats
+        print('{}: {} events'.format(day.strftime('%Y-%m-%d'), len(events)))
+
+    dataset = {
+        'parameters': {'scale': scale, 'skew': skew, 'match_rate': match_rate, 'days': days, 'seed': seed,
+                       'formats': sorted(formats)},
+        'counts': counts,
+        'bytes': {'song_data': songs_size, 'events': events_size},
+    }
+    with open(os.path.join(output, 'dataset.json'), 'w') as f:
+        json.dump(dataset, f, indent=2, sort_keys=True)
+
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Sparkify data set.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='size of the data set relative to the sample data, e.g. 1 to 1000 (default: 1)')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of the song, user and artist distributions, 0 for uniform (default: 1)')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='share of the song plays that refer to a generated song (default: 0.5)')
+    parser.add_argument('--days', type=int, default=30, help='number of days of events (default: 30)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--formats', default='song,log,csv',
+                        help='comma separated list of song, log and csv (default: song,log,csv)')
+    parser.add_argument('--output', default=None,
+                        help='output folder (default: data/<scale>x next to this script)')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', '{:g}x'.format(args.scale))
+    if os.path.exists(os.path.join(output, 'dataset.json')):
+        parser.error('{} already contains a data set'.format(output))
+
+    dataset = generate(output, scale=args.scale, skew=args.skew, match_rate=args.match_rate, days=args.days,
+                       seed=args.seed, formats=args.formats.split(','))
+    print('Data set written to {}: {}'.format(output, json.dumps(dataset['counts'], sort_keys=True)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+TARGETS = ['postgres', 'cassandra', 'datalake']
+
+
+def get_commands(target, data, workdir, args):
+    """
+    Returns the folder to run a target's commands in, the setup commands (not timed) and
+    the timed command, for a data set folder.
+    - postgres: recreates the sparkify database, then runs the ETL on the song and log data
+    - cassandra: runs the loader on the event CSV files
+    - datalake: runs the Spark ETL in local mode, writing the tables to a scratch folder
+    The number of input rows of the target is returned too, to compute the rows per second.
+    """
+    counts = data['counts']
+
+    if target == 'postgres':
+        command = [sys.executable, 'etl.py', '--data', data['path']] + shlex.split(args.postgres_args)
+        return ('DataModelingPostgreSQL', [[sys.executable, 'create_tables.py']], command,
+                counts['songs'] + counts['events'])
+
+    if target == 'cassandra':
+        command = [sys.executable, 'cassandra_loader.py', '--event-data', os.path.join(data['path'], 'event_data'),
+                   '--event-datafile', os.path.join(workdir, 'event_datafile_new.csv')] + shlex.split(args.cassandra_args)
+        return 'DataModelingCassandra', [], command, counts['events']
+
+    if target == 'datalake':
+        command = [sys.executable, 'etl.py', '--master', args.spark_master, '--input', data['path'] + os.sep,
+                   '--output', os.path.join(workdir, 'datalake') + os.sep] + shlex.split(args.datalake_args)
+        return 'DataLake', [], command, counts['songs'] + counts['events']
+
+    raise ValueError('unknown target: {}'.format(target))
+
+
+def run_command(command, cwd, env):
+    """
+    Runs a command, and returns its exit code, wall time in seconds and peak RSS in MB.
+    The peak RSS comes from wait4(), and is the largest of the process and of the
+    child processes it waited for.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - started
+
+    # the return code has been collected by wait4, so Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    peak_rss = rusage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    return process.returncode, wall_seconds, peak_rss
+
+
+def run_target(target, data, args):
+    """
+    Runs a target args.repeat times, and returns its results: the median wall time,
+    rows per second and peak RSS, the numbers of every run, and the stage report of the
+    last run (see instrumentation.py).
+    """
+    workdir = tempfile.mkdtemp(prefix='sparkify_benchmark_')
+    try:
+        folder, setup, command, rows = get_commands(target, data, workdir, args)
+        cwd = os.path.join(REPO_DIR, folder)
+
+        env = dict(os.environ)
+        env['ETL_REPORT'] = os.path.join(workdir, 'report.json')
+        env.pop('ETL_PROMETHEUS', None)
+
+        result = {'command': ' '.join(command[1:]), 'rows': rows, 'runs': []}
+        for i in range(args.repeat):
+            for setup_command in setup:
+                if subprocess.call(setup_command, cwd=cwd) != 0:
+                    result['error'] = 'setup failed: {}'.format(' '.join(setup_command[1:]))
+                    return result
+
+            print('{} run {}/{}: {}'.format(target, i + 1, args.repeat, result['command']))
+            returncode, wall_seconds, peak_rss = run_command(command, cwd, env)
+            if returncode != 0:
+                result['error'] = 'exit code {}'.format(returncode)
+                return result
+
+            result['runs'].append({'wall_seconds': round(wall_seconds, 3), 'peak_rss_mb': round(peak_rss, 1)})
+
+        wall_seconds = statistics.median(run['wall_seconds'] for run in result['runs'])
+        result['wall_seconds'] = round(wall_seconds, 3)
+        result['rows_per_second'] = round(rows / wall_seconds, 1)
+        result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in result['runs'])
+
+        if os.path.exists(env['ETL_REPORT']):
+            with open(env['ETL_REPORT']) as f:
+                stages = json.load(f)['stages']
+            result['stages'] = {name: {'calls': stats['calls'], 'rows': stats['rows'], 'seconds': round(stats['seconds'], 3)}
+                                for name, stats in stages.items()}
+
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """
+    Runs the ETL of the PostgreSQL, Cassandra and Spark projects against a data set made by
+    generate_data.py, and writes the results to a JSON file which can be compared with the
+    results of another run with compare_results.py.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the ETL scripts on a synthetic data set.')
+    parser.add_argument('data', help='folder of a data set made by generate_data.py')
+    parser.add_argument('--targets', default=','.join(TARGETS),
+                        help='comma separated list of {} (default: all)'.format(', '.join(TARGETS)))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of runs of each target; the median wall time is reported (default: 1)')
+    parser.add_argument('--label', default=None, help='name of the run (default: the git commit)')
+    parser.add_argument('--output', default=None,
+                        help='results file (default: results/<label>-<scale>x.json next to this script)')
+    parser.add_argument('--postgres-args', default='', help="extra arguments of the PostgreSQL ETL, e.g. '--mode copy'")
+    parser.add_argument('--cassandra-args', default='', help='extra arguments of the Cassandra loader')
+    parser.add_argument('--datalake-args', default='', help='extra arguments of the Spark ETL')
+    parser.add_argument('--spark-master', default='local[*]', help="Spark master of the Spark ETL (default: local[*])")
+    args = parser.parse_args()
+
+    data_path = os.path.abspath(args.data)
+    with open(os.path.join(data_path, 'dataset.json')) as f:
+        data = json.load(f)
+    data['path'] = data_path
+
+    targets = args.targets.split(',')
+    for target in targets:
+        if target not in TARGETS:
+            parser.error('unknown target: {}'.format(target))
+
+    git_commit = get_git_commit()
+    label = args.label or git_commit or 'run'
+
+    results = {
+        'label': label,
+        'git_commit': git_commit,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'dataset': {'parameters': data['parameters'], 'counts': data['counts']},
+        'arguments': {'postgres': args.postgres_args, 'cassandra': args.cassandra_args,
+                      'datalake': args.datalake_args, 'spark_master': args.spark_master, 'repeat': args.repeat},
+        'targets': {},
+    }
+
+    for target in targets:
+        result = run_target(target, data, args)
+        results['targets'][target] = result
+        if 'error' in result:
+            print('{} failed: {}'.format(target, result['error']))
+        else:
+            print('{}: {} rows in {}s, {} rows/s, peak RSS {} MB'.format(
+                target, result['rows'], result['wall_seconds'], result['rows_per_second'], result['peak_rss_mb']))
+
+    output = args.output or os.path.join(BENCHMARK_DIR, 'results',
+                                         '{}-{:g}x.json'.format(label, data['parameters']['scale']))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Results written to {}'.format(output))
+
+    if any('error' in result for result in results['targets'].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+from datetime import datetime, timedelta, timezone
+
+from pyspark.sql import SparkSession, functions as F, types as T
+
+# the spark_time module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from spark_time import set_timezone, epoch_millis_to_timestamp, sas_date_to_date
+
+
+# First song play of the synthetic data sets, in milliseconds since the epoch
+FIRST_TS = 1541030400000
+
+
+def convert_datetime(x):
+    """
+    The SAS date conversion of the Capstone notebook, before spark_time.py.
+    """
+    try:
+        start = datetime(1960, 1, 1)
+        return start + timedelta(days=int(x))
+    except:
+        return None
+
+
+def get_conversions():
+    """
+    Returns the conversions to time: the Python UDFs the Spark jobs used before spark_time.py,
+    and the native expressions that replace them.
+    """
+    get_timestamp = F.udf(lambda x: datetime.fromtimestamp(x / 1000.0), T.TimestampType())
+    udf_datetime_from_sas = F.udf(lambda x: convert_datetime(x), T.DateType())
+
+    return {
+        'timestamp_udf': get_timestamp('ts'),
+        'timestamp_native': epoch_millis_to_timestamp('ts'),
+        'sas_date_udf': udf_datetime_from_sas('sas_days'),
+        'sas_date_native': sas_date_to_date('sas_days'),
+    }
+
+
+def time_conversion(df, conversion, repeat):
+    """
+    Returns the wall time in seconds of each of repeat runs of a conversion over every row.
+    The largest value is aggregated, so that every row must be converted.
+    """
+    seconds = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        df.select(conversion.alias('converted')).agg(F.max('converted')).collect()
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+def main():
+    """
+    Times the conversion of the log timestamps and of the Capstone SAS dates with the Python
+    UDFs the Spark jobs used to have, and with the native expressions of spark_time.py, on
+    Spark in local mode.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Python UDF and the native conversions of times in Spark.')
+    parser.add_argument('--rows', type=int, default=10000000, help='number of rows converted (default: 10000000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each conversion; the median wall time is reported (default: 3)')
+    parser.add_argument('--spark-master', default='local[*]', help='Spark master (default: local[*])')
+    parser.add_argument('--timezone', default='UTC', help='timezone of the Spark session (default: UTC)')
+    parser.add_argument('--output', default=None, help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.master(args.spark_master).appName('spark_timestamps').getOrCreate()
+    set_timezone(spark, args.timezone)
+
+    # One song play every 0.997s, and a SAS date between 2016 and 2018 with a few missing ones
+    df = spark.range(args.rows) \
+        .withColumn('ts', F.lit(FIRST_TS) + F.col('id') * 997) \
+        .withColumn('sas_days', F.when(F.col('id') % 100 != 0, (F.col('id') % 1000 + 20454).cast('double'))) \
+        .cache()
+    df.count()
+
+    results = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'spark': spark.version},
+        'arguments': {'rows': args.rows, 'repeat': args.repeat, 'spark_master': args.spark_master,
+                      'timezone': args.timezone},
+        'conversions': {},
+    }
+
+    for name, conversion in sorted(get_conversions().items()):
+        seconds = time_conversion(df, conversion, args.repeat)
+        wall_seconds = statistics.median(seconds)
+        results['conversions'][name] = {'runs': [round(s, 3) for s in seconds], 'wall_seconds': round(wall_seconds, 3),
+                                        'rows_per_second': round(args.rows / wall_seconds, 1)}
+        print('{}: {} rows in {:.3f}s, {:.0f} rows/s'.format(name, args.rows, wall_seconds, args.rows / wall_seconds))
+
+    for name in ['timestamp', 'sas_date']:
+        before = results['conversions'][name + '_udf']['wall_seconds']
+        after = results['conversions'][name + '_native']['wall_seconds']
+        print('{}: {:.1f}x faster with the native expression'.format(name, before / after))
+
+    spark.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Results written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
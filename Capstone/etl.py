@@ -1,6 +1,10 @@
 import configparser
 import psycopg2
 import os
+import sys
+# the instrumentation module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrumentation import configure, stage, instrument_cursor, finish
 from sql_queries import staging_copy, truncate_table_queries, delete_duplicate_queries, insert_table_queries
 from sql_queries import visit_key, demographics_key, oilprice_key, tempbystate_key
 
@@ -15,8 +19,9 @@ def load_staging_tables(cur, conn):
     
     # Truncate tables
     for query in truncate_table_queries:
-        cur.execute(query)
-        conn.commit()
+        with stage('truncate staging'):
+            cur.execute(query)
+            conn.commit()
 
     # Get the bucket name
     s3_bucket = config.get('S3', 'S3_BUCKET')
@@ -27,8 +32,9 @@ def load_staging_tables(cur, conn):
     for key in keys:
         query = staging_copy.format(key[0], os.path.join(s3_bucket, key[1] + '/'), config.get('IAM_ROLE', 'ARN'))
         print(query)
-        cur.execute(query)
-        conn.commit()
+        with stage('copy staging'):
+            cur.execute(query)
+            conn.commit()
 
 
 def insert_tables(cur, conn):
@@ -37,13 +43,15 @@ def insert_tables(cur, conn):
     """
     # 1. Upsert: first delete duplicates in the staging table
     for query in delete_duplicate_queries:
-        cur.execute(query)
-        conn.commit()
+        with stage('delete duplicates'):
+            cur.execute(query)
+            conn.commit()
 
     # 2. Upsert: then insert the rows from the staging table into the database tables
     for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+        with stage('insert tables'):
+            cur.execute(query)
+            conn.commit()
 
 
 def imp_update_tables():
@@ -54,9 +62,12 @@ def imp_update_tables():
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
+    # Time the stages and statements of the run if ETL_REPORT is set
+    configure('capstone_etl')
+
     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
 
-    cur = conn.cursor()
+    cur = instrument_cursor(conn.cursor())
 
     # Truncate the staging tables, and then load the parquet files into the staging tables
     load_staging_tables(cur, conn)
@@ -65,6 +76,7 @@ def imp_update_tables():
     insert_tables(cur, conn)
 
     conn.close()
+    finish()
 
 
 if __name__ == "__main__":
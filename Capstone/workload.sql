@@ -0,0 +1,44 @@
+-- Analytic queries run against the data warehouse, registered for table_advisor.py.
+-- The weight of a query is the number of times it runs per load.
+
+-- International visitor counts and average temperatures in NY for each month of 2016
+-- weight: 5
+SELECT visit_count_table.month, visitcount, monthly_average_temp
+FROM
+(
+    SELECT datetime.month, count(*) AS visitcount
+    FROM visit
+    INNER JOIN datetime on visit.arrival_date = datetime.event
+    WHERE (visit.destination_state = 'NY') AND (datetime.year = 2016)
+    GROUP BY visit.destination_state, datetime.month
+    ORDER BY datetime.month
+) visit_count_table
+INNER JOIN
+(
+    SELECT month, monthly_average_temp
+    FROM tempbystate
+    WHERE year = 2016
+    ORDER BY month
+) temp_table
+ON visit_count_table.month = temp_table.month
+ORDER BY temp_table.month;
+
+-- International visitor counts to the US and oil prices each month between 2005 and 2016
+-- weight: 5
+SELECT visit_count_table.year, visit_count_table.month, visitcount, monthly_average_price
+FROM
+(
+    SELECT year, month, count(*) AS visitcount
+    FROM visit
+    INNER JOIN datetime ON visit.arrival_date = datetime.event
+    WHERE year BETWEEN 2005 AND 2016
+    GROUP BY year, month
+) visit_count_table
+INNER JOIN
+(
+    SELECT year, month, monthly_average_price
+    FROM oilprice
+    WHERE year BETWEEN 2005 AND 2016
+) oil_price_table
+ON visit_count_table.year = oil_price_table.year AND visit_count_table.month = oil_price_table.month
+ORDER BY visit_count_table.year, visit_count_table.month;
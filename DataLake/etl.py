@@ -1,11 +1,21 @@
 import configparser
-from datetime import datetime
 import os
+import sys
+import argparse
+import uuid
+from datetime import datetime
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from pyspark.sql.utils import AnalysisException
+from pyspark.sql.functions import col, year, month, to_utc_timestamp
 from pyspark.sql.types import StructType as R, StructField as Fld, DoubleType as Dbl, StringType as Str, IntegerType as Int, DateType as Date, LongType as Lng
-from pyspark.sql.types import TimestampType
+
+# the instrumentation and spark_time modules are shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrumentation import configure, stage, finish
+from spark_time import set_timezone, epoch_millis_to_timestamp, add_calendar_columns
+from output_layout import DEFAULT_TARGET_FILE_SIZE, get_layout, write_table, replace_path, parse_columns
+from load_state import list_files, list_log_files, list_month_log_files, get_adjacent_months, get_file_day, get_file_month
+from load_state import read_state, write_state, UTC_TIMEZONES
 
 
 config = configparser.ConfigParser()
@@ -15,22 +25,84 @@ os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
 
-def create_spark_session():
-    spark = SparkSession \
+def create_spark_session(master=None, timezone='UTC'):
+    """
+    create_spark_session - Creates the Spark session.  A master URL such as 'local[*]' can be
+    given to run Spark locally, e.g. against the files of the benchmark data generator.  The
+    times are converted, and their date/time fields computed, in the given timezone.
+    """
+    builder = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0")
+    if master is not None:
+        builder = builder.master(master)
+    spark = builder.getOrCreate()
+    set_timezone(spark, timezone)
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def read_parquet_if_exists(spark, path):
+    """
+    read_parquet_if_exists - Returns the data frame of a parquet table, or None if it has not been
+    written yet.
+    """
+    try:
+        return spark.read.parquet(path)
+    except AnalysisException as e:
+        if 'Path does not exist' not in str(e):
+            raise e
+        return None
+
+
+def merge_users(spark, users_table, users_path, layout, target_file_size=DEFAULT_TARGET_FILE_SIZE):
+    """
+    merge_users - Merges the users of the log data read by this run into the existing users table:
+    the users seen in the logs replace their rows, and the rows of the other users are kept as they
+    are, so the logs of earlier runs do not need to be read again.  As Spark cannot overwrite a table
+    it is reading from, the merged rows are written next to the table, and then moved in its place
+    (see output_layout.replace_path), so the table is kept if the write fails.
+    """
+    existing = read_parquet_if_exists(spark, users_path)
+    if existing is None:
+        write_table(users_table, users_path, layout, target_file_size)
+        return
+
+    unchanged = existing.join(users_table.select('user_id'), 'user_id', 'left_anti')
+    merged = unchanged.unionByName(users_table.select(existing.columns))
+    staging = '{}.merging-{}'.format(users_path.rstrip('/'), uuid.uuid4().hex[:8])
+    write_table(merged, staging, layout, target_file_size)
+    replace_path(spark, staging, users_path.rstrip('/'))
+
+
+def get_new_rows(spark, table, path, keys=None):
+    """
+    get_new_rows - Returns the rows of a data frame that are not in the parquet table of a path yet: those whose
+    keys are not in the table, or without keys, those that are not rows of the table.
+    """
+    existing = read_parquet_if_exists(spark, path)
+    if existing is None:
+        return table
+    if keys:
+        return table.join(existing.select(keys), keys, 'left_anti')
+    return table.subtract(existing.select(table.columns))
+
+
+def process_song_data(spark, input_data, output_data, layouts=None, target_file_size=DEFAULT_TARGET_FILE_SIZE,
+                      song_files=None, append=False):
     """
     process_song_data - Loads the song data files from S3, and saves the song information to a parquet file
-    (parititioned by year and artist_id), and then extracts the distinct artists and saves them to a parquet file.
+    (parititioned by year, and sorted by artist_id), and then extracts the distinct artists and saves them to
+    a parquet file.  The files are written with the layouts of the tables (see output_layout.py), with the
+    options of layouts (by table) overriding them.
+    The songs and artists data frames are cached and returned, so that the song plays are joined with them
+    without reading the parquet files back.
+    With song_files, only these files are read, and with append, the songs and artists that are not in the
+    tables yet are appended to them, and the whole tables are returned.
     """
+    layouts = layouts or {}
     
     # Get filepath to song data file
-    song_data = os.path.join(input_data,'song_data/*/*/*/*.json')
+    song_data = song_files if song_files is not None else os.path.join(input_data,'song_data/*/*/*/*.json')
 #    song_data = os.path.join(input_data,'song_data/A/A/A/TRAAAAK128F9318786.json')
     
     songSchema = R([
@@ -46,37 +118,63 @@ def process_song_data(spark, input_data, output_data):
         Fld("year",Int())
     ])
     
-    # Read song data file
-    df = spark.read.json(song_data, schema=songSchema)
+    # Read song data file.  It is cached, as both tables are extracted from it
+    df = spark.read.json(song_data, schema=songSchema).cache()
 
     # Extract columns to create songs table
-    songs_table = df.select(['song_id', 'title', 'artist_id', 'year', 'duration'])
+    songs_table = df.select(['song_id', 'title', 'artist_id', 'year', 'duration']).cache()
     
-    # Write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year", "artist_id").mode('overwrite').parquet(os.path.join(output_data,'songs.parquet'))
+    # Write songs table to parquet files partitioned by year, in files of the target size sorted by artist.
+    # Partitioning by artist too made one directory of tiny files per artist.
+    songs_path = os.path.join(output_data,'songs.parquet')
+    with stage('write songs'):
+        if append:
+            songs_table = get_new_rows(spark, songs_table, songs_path, ['song_id'])
+        write_table(songs_table, songs_path, get_layout('songs', **layouts.get('songs', {})),
+                    target_file_size, 'append' if append else 'overwrite')
 
     # Extract columns to create artists table, and find the distinct artists
     artists_table = df.select(['artist_id',
                                'artist_name',
                                'artist_location',
                                'artist_latitude',
-                               'artist_longitude']).withColumnRenamed('artist_name', 'name').withColumnRenamed('artist_location', 'location').withColumnRenamed('artist_latitude', 'latitude').withColumnRenamed('artist_longitude', 'longitude').distinct()
+                               'artist_longitude']).withColumnRenamed('artist_name', 'name').withColumnRenamed('artist_location', 'location').withColumnRenamed('artist_latitude', 'latitude').withColumnRenamed('artist_longitude', 'longitude').distinct().cache()
     
     # Write artists table to parquet files
-    artists_table.write.mode('overwrite').parquet(os.path.join(output_data,'artists.parquet'))
+    artists_path = os.path.join(output_data,'artists.parquet')
+    with stage('write artists'):
+        if append:
+            artists_table = get_new_rows(spark, artists_table, artists_path)
+        write_table(artists_table, artists_path, get_layout('artists', **layouts.get('artists', {})),
+                    target_file_size, 'append' if append else 'overwrite')
+
+    if append:
+        return spark.read.parquet(songs_path), spark.read.parquet(artists_path)
+    return songs_table, artists_table
 
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, merge=False, songs_table=None, artists_table=None,
+                     max_broadcast_rows=1000000, layouts=None, target_file_size=DEFAULT_TARGET_FILE_SIZE,
+                     log_files=None, months=None):
     """
     process_log_data - This function loads the event log data (the songs played by the user), and extracts the
     following tables, which are saved to parquet files:
-    users: user information (saving it to a parquet file)
+    users: user information (saving it to a parquet file), merged into the existing users with merge
     time: the start times and various date/time field extracted from it
     songplays: the event log data with foreign keys to the song and artist tables
+    The songs and artists tables are those returned by process_song_data, or read from their parquet files.
+    They are joined once into a song lookup, with one row per title, artist name and duration, which is
+    broadcast to the executors for the songplays join when it has at most max_broadcast_rows rows.
+    The files are written with the layouts of the tables (see output_layout.py), with the options of layouts
+    (by table) overriding them.
+    With log_files, only these files are read, and with months, a list of (year, month) of log_data folders, only
+    the song plays of the months of the song plays of these folders, in the session timezone, are kept, so that
+    the partitions of other months are not overwritten.
     """
+    layouts = layouts or {}
     
     # Get filepath to log data file
-    log_data = os.path.join(input_data,'log_data/*/*/*.json')
+    log_data = log_files if log_files is not None else os.path.join(input_data,'log_data/*/*/*.json')
 #    log_data = os.path.join(input_data,'log_data/2018/11/2018-11-01-events.json')
 
     # Read log data file
@@ -90,72 +188,218 @@ def process_log_data(spark, input_data, output_data):
     df.createOrReplaceTempView("event_log")
     
     # The select statement finds the latest user information, so that the 'level' field is most up-to-date.
+    # The song plays of each user are ranked by time in a single pass, and only the first one is kept, so
+    # there is exactly one row per user, even when two song plays have the same ts.
     users_table = spark.sql('''
-        SELECT
-            EL1.userid AS user_id,
-            EL1.firstname AS first_name,
-            EL1.lastname AS last_name,
-            EL1.gender,
-            EL1.level
-        FROM event_log EL1
-        WHERE EL1.ts = (SELECT MAX(EL2.ts) FROM event_log EL2 WHERE EL1.userid = EL2.userid)''')
+        SELECT user_id, first_name, last_name, gender, level
+        FROM (
+            SELECT
+                EL.userid AS user_id,
+                EL.firstname AS first_name,
+                EL.lastname AS last_name,
+                EL.gender,
+                EL.level,
+                ROW_NUMBER() OVER (PARTITION BY EL.userid ORDER BY EL.ts DESC, EL.sessionid DESC, EL.iteminsession DESC) AS user_row
+            FROM event_log EL) U
+        WHERE user_row = 1''')
     
     # Write users table to parquet files
-    users_table.write.mode('overwrite').parquet(os.path.join(output_data,'users.parquet'))
+    users_path = os.path.join(output_data,'users.parquet')
+    users_layout = get_layout('users', **layouts.get('users', {}))
+    with stage('write users'):
+        if merge:
+            merge_users(spark, users_table, users_path, users_layout, target_file_size)
+        else:
+            write_table(users_table, users_path, users_layout, target_file_size)
 
-    # Create a user defined function to convert milliseconds to seconds for 'fromtimestamp()', and then convert the seconds to local time
-    get_timestamp = udf(lambda x: datetime.fromtimestamp(x / 1000.0), TimestampType())
-    
-    # Create timestamp column from original timestamp column
-    df = df.withColumn('start_time', get_timestamp(df.ts))
+    # Create timestamp column from original timestamp column (milliseconds since the epoch), with a native
+    # Spark expression rather than a Python UDF, so that the rows are not sent through a Python worker
+    df = df.withColumn('start_time', epoch_millis_to_timestamp('ts'))
+    if months is not None:
+        # The months are those of the log folders, in UTC, and the partitions those of the session timezone:
+        # the partitions replaced are the months of the song plays of the log folders of months, in the session
+        # timezone, and all the song plays of these months are kept.
+        utc_time = to_utc_timestamp('start_time', spark.conf.get('spark.sql.session.timeZone'))
+        utc_month = year(utc_time) * 100 + month(utc_time)
+        local_month = year('start_time') * 100 + month('start_time')
+        local_months = [row[0] for row in df.filter(utc_month.isin([y * 100 + m for y, m in months]))
+                        .select(local_month).distinct().collect()]
+        df = df.filter(local_month.isin(local_months))
     
     # Extract columns to create time table. Use built-in functions to get the specific date/time fields from 'start_time'
-    time_table = df.select('start_time').distinct()
-    time_table = time_table.withColumn('hour', hour('start_time')).withColumn('day', dayofmonth('start_time')).withColumn('week', weekofyear('start_time')).withColumn('month', month('start_time')).withColumn('year', year('start_time')).withColumn('weekday', date_format(col("start_time"), "u"))
+    # The weekday is the ISO day of the week, stored as a string ('1' for Monday) like the 'u' pattern of
+    # date_format the table was first written with, so that every partition of the table has the same type
+    time_table = add_calendar_columns(df.select('start_time').distinct(), 'start_time', 'iso')
+    time_table = time_table.withColumn('weekday', col('weekday').cast('string'))
     
     # Write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year", "month").mode('overwrite').parquet(os.path.join(output_data,'time.parquet'))
+    with stage('write time'):
+        write_table(time_table, os.path.join(output_data,'time.parquet'), get_layout('time', **layouts.get('time', {})),
+                    target_file_size)
 
-    # Read in song data to use for songplays table
-    songs_df = spark.read.parquet(os.path.join(output_data,'songs.parquet'))
-    artists_df = spark.read.parquet(os.path.join(output_data,'artists.parquet'))
+    # Use the song data of this run to build the songplays table, or read it in if it was not processed
+    if songs_table is None:
+        songs_table = spark.read.parquet(os.path.join(output_data,'songs.parquet'))
+    if artists_table is None:
+        artists_table = spark.read.parquet(os.path.join(output_data,'artists.parquet'))
 
     # First create temp tables to query using Spark SQL
     df.createOrReplaceTempView("event_log")
-    songs_df.createOrReplaceTempView("songs")
-    artists_df.createOrReplaceTempView("artists")
+    songs_table.createOrReplaceTempView("songs")
+    artists_table.createOrReplaceTempView("artists")
+
+    # The song lookup: the songs joined with their artists once, with one row per title, artist name and
+    # duration, the keys of the song plays, and the lowest song id when several songs share them, like the
+    # song_lookup_stage table of DataWarehouse.  It is small next to the song plays: when it fits, it is
+    # broadcast to the executors, so that the song plays are joined where they are, without shuffling them.
+    song_lookup = spark.sql('''
+        SELECT title, artist_name, duration, song_id, artist_id
+        FROM (
+            SELECT S.title, A.name AS artist_name, S.duration, S.song_id, S.artist_id,
+                ROW_NUMBER() OVER (PARTITION BY S.title, A.name, S.duration ORDER BY S.song_id) AS song_rank
+            FROM songs S
+            JOIN artists A ON S.artist_id = A.artist_id
+        ) SL
+        WHERE song_rank = 1''').cache()
+    song_lookup.createOrReplaceTempView("song_lookup")
+    broadcast_hint = '/*+ BROADCAST(SL) */' if song_lookup.count() <= max_broadcast_rows else ''
     
-    # Extract columns from joined song and log datasets to create songplays table
-    songplays_table = spark.sql('''
-        SELECT
+    # Extract columns from joined song and log datasets to create songplays table.  The year and month the
+    # table is partitioned by are derived from the start time, like those of the time table, instead of
+    # joining the song plays back to the time table.  Song plays without a start time are left out, as
+    # they have no time row.
+    songplays_output = spark.sql('''
+        SELECT {}
             EL.start_time,
             EL.userid AS user_id,
             EL.level,
-            S.song_id,
-            A.artist_id,
+            SL.song_id,
+            SL.artist_id,
             EL.sessionId AS session_id,
             EL.location,
             EL.useragent AS user_agent
         FROM event_log EL
-        LEFT JOIN songs S ON (EL.song = S.title) and (EL.length = S.duration)
-        LEFT JOIN artists A on (EL.artist = A.name) and (S.artist_id = A.artist_id)''')
-
-    # Write songplays table to parquet files partitioned by year and month
-    # This requires joining with the 'time' data frame to get the year and month fields
-    
-    songplays_output = songplays_table.alias('songplays').join(time_table.alias('time'), col('songplays.start_time') == col('time.start_time'), 'inner').select(col('songplays.start_time'),col('songplays.user_id'),col('songplays.level'),col('songplays.song_id'),col('songplays.artist_id'),col('songplays.session_id'),col('songplays.location'),col('songplays.user_agent'),col('time.year'),col('time.month'))
+        LEFT JOIN song_lookup SL ON (EL.song = SL.title) AND (EL.artist = SL.artist_name) AND (EL.length = SL.duration)
+        WHERE EL.start_time IS NOT NULL'''.format(broadcast_hint))
+    songplays_output = songplays_output.withColumn('year', year('start_time')).withColumn('month', month('start_time'))
 
     # Write the songplays to a parquet file
-    songplays_output.write.partitionBy("year", "month").mode('overwrite').parquet(os.path.join(output_data,'songplays.parquet'))
-    
+    with stage('write songplays'):
+        write_table(songplays_output, os.path.join(output_data,'songplays.parquet'),
+                    get_layout('songplays', **layouts.get('songplays', {})), target_file_size)
+    song_lookup.unpersist()
+
+
+def load_incremental(spark, input_data, output_data, state_path, state, song_files, start_date, end_date,
+                     max_broadcast_rows=1000000, layouts=None, target_file_size=DEFAULT_TARGET_FILE_SIZE):
+    """
+    load_incremental - Loads only the files that are not in the state yet (see load_state.py), and adds them to
+    the state file once the tables are written:
+    1. The new song files: the songs and artists that are not in the tables yet are appended to them.
+    2. The new log files of the days from start_date to end_date: the months of these files are read again in
+    full, and their partitions of the time and songplays tables are replaced with dynamic partition overwrite,
+    which keeps the other months.  The users of these months are merged into the users table.
+    Returns the log and song files loaded.
+    """
+    processed = set(state['log_files']) | set(state['song_files'])
+    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+
+    new_song_files = [path for path in song_files if path not in processed]
+    print('{} new song files'.format(len(new_song_files)))
+    songs_table = artists_table = None
+    if new_song_files:
+        songs_table, artists_table = process_song_data(spark, input_data, output_data, layouts, target_file_size,
+                                                       new_song_files, append=True)
+
+    log_files = list_log_files(spark, input_data, start_date, end_date)
+    new_log_files = [path for path in log_files if path not in processed and
+                     (get_file_day(path) is None or start_date <= get_file_day(path) <= end_date)]
+    months = sorted(set(get_file_month(path) for path in new_log_files))
+    print('{} new log files from {} to {}, in {} months'.format(len(new_log_files), start_date, end_date, len(months)))
+    if new_log_files:
+        # In a timezone other than UTC, the song plays at the ends of the months are in the folders of the
+        # months before and after
+        read_months = months
+        if spark.conf.get('spark.sql.session.timeZone') not in UTC_TIMEZONES:
+            read_months = get_adjacent_months(months)
+        process_log_data(spark, input_data, output_data, True, songs_table, artists_table, max_broadcast_rows, layouts,
+                         target_file_size, list_month_log_files(spark, input_data, read_months), months)
+
+    write_state(spark, state_path, state, new_log_files, new_song_files)
+    return new_log_files, new_song_files
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
 def main():
     
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://dataengineering-nano-dwh-bucket/"
+    # Time the stages of the run if ETL_REPORT is set.  Spark evaluates lazily, so each
+    # write stage includes the reads and transformations it depends on.
+    configure('datalake_etl')
+
+    parser = argparse.ArgumentParser(description='Load the song and log data into the data lake.')
+    parser.add_argument('--input', default="s3a://udacity-dend/",
+                        help='location of the song_data and log_data folders (default: s3a://udacity-dend/)')
+    parser.add_argument('--output', default="s3a://dataengineering-nano-dwh-bucket/",
+                        help='location the tables are written to (default: s3a://dataengineering-nano-dwh-bucket/)')
+    parser.add_argument('--master', default=None,
+                        help="Spark master URL, e.g. 'local[*]' to run locally (default: from the Spark configuration)")
+    parser.add_argument('--max-broadcast-rows', type=int, default=1000000,
+                        help='largest number of rows of the song lookup broadcast to the executors for the songplays join (default: 1000000)')
+    parser.add_argument('--target-file-size', type=int, default=DEFAULT_TARGET_FILE_SIZE // (1024 * 1024),
+                        help='size of the parquet files in MB, before compression (default: 128)')
+    parser.add_argument('--songs-partition-by', default=None,
+                        help="comma separated partition columns of the songs, e.g. 'year,artist_id' (default: year)")
+    parser.add_argument('--songs-sort-by', default=None,
+                        help='comma separated columns the song files are sorted by (default: artist_id)')
+    parser.add_argument('--songs-buckets', type=int, default=None,
+                        help='hash the songs into this number of files per partition by artist_id (default: no buckets)')
+    parser.add_argument('--merge-users', action='store_true',
+                        help='merge the users of the log data into the existing users table, instead of replacing it')
+    parser.add_argument('--incremental', action='store_true',
+                        help='load only the log files of the given days and the new song files, and merge them into the tables')
+    parser.add_argument('--start-date', type=parse_date, default=None,
+                        help='with --incremental, first day of log data to load, YYYY-MM-DD')
+    parser.add_argument('--end-date', type=parse_date, default=None,
+                        help='with --incremental, last day of log data to load, YYYY-MM-DD (default: the start date)')
+    parser.add_argument('--state', default=None,
+                        help='state file of the files already loaded (default: etl_state.json in the output location)')
+    parser.add_argument('--timezone', default='UTC',
+                        help='timezone of the start times and of their date/time fields (default: UTC)')
+    args = parser.parse_args()
+
+    if args.incremental and args.start_date is None:
+        parser.error('--incremental needs the --start-date of the log data to load')
+    if not args.incremental and (args.start_date or args.end_date):
+        parser.error('--start-date and --end-date are only used with --incremental')
+    if args.end_date is not None and args.end_date < args.start_date:
+        parser.error('the end date is before the start date')
+
+    spark = create_spark_session(args.master, args.timezone)
+    input_data = args.input
+    output_data = args.output
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    layouts = {'songs': {'partition_by': parse_columns(args.songs_partition_by), 'sort_by': parse_columns(args.songs_sort_by),
+                         'bucket_by': 'artist_id' if args.songs_buckets else None, 'buckets': args.songs_buckets}}
+    target_file_size = args.target_file_size * 1024 * 1024
+
+    state_path = args.state or os.path.join(output_data, 'etl_state.json')
+    state = read_state(spark, state_path)
+    song_files = list_files(spark, os.path.join(input_data,'song_data/*/*/*/*.json'))
+
+    if args.incremental:
+        load_incremental(spark, input_data, output_data, state_path, state, song_files, args.start_date,
+                         args.end_date or args.start_date, args.max_broadcast_rows, layouts, target_file_size)
+    else:
+        log_files = list_files(spark, os.path.join(input_data,'log_data/*/*/*.json'))
+        songs_table, artists_table = process_song_data(spark, input_data, output_data, layouts, target_file_size)
+        process_log_data(spark, input_data, output_data, args.merge_users, songs_table, artists_table,
+                         args.max_broadcast_rows, layouts, target_file_size)
+        write_state(spark, state_path, state, log_files, song_files)
+
+    finish()
 
 
 if __name__ == "__main__":
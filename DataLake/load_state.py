@@ -0,0 +1,144 @@
+"""
+Input files and state of the incremental runs of the data lake ETL.
+
+A run with --incremental only reads the log files of a range of days, and the song files it
+has not loaded yet.  The state file (JSON, next to the tables by default) records the song
+and log files loaded by every run, full or incremental, so that running the same range again
+has no effect, and the next run only picks up the new files:
+
+    {"log_files": ["s3a://udacity-dend/log_data/2018/11/2018-11-01-events.json", ...],
+     "song_files": [...], "updated_at": "2018-11-02T03:00:00+00:00"}
+
+The time and songplays tables are partitioned by month and written with dynamic partition
+overwrite, which replaces the partitions of the rows written and keeps the others: a month
+with new log files is read again in full (its log_data/YYYY/MM prefix), so that its
+partitions are complete.  The folders are months of UTC, and the partitions months of the
+timezone of the Spark session: in another timezone, the months before and after are read too,
+as the song plays at the ends of a month can be in their folders.
+
+The files are listed, read and written with the Hadoop file system of their path, so the
+same code works on S3 and on local files.
+"""
+import json
+import re
+from datetime import date, datetime, timezone
+
+
+FILE_DAY = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+# Session timezones in which the months of the tables are those of the log_data/YYYY/MM folders
+UTC_TIMEZONES = ('UTC', 'GMT', 'Etc/UTC', 'Etc/GMT', 'Z')
+
+
+def get_path(spark, path):
+    """
+    Returns the Hadoop path of a path, and its file system.
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path, hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration())
+
+
+def list_files(spark, pattern):
+    """
+    Returns the sorted, fully qualified paths of the files matching a glob pattern.
+    """
+    hadoop_path, fs = get_path(spark, pattern)
+    statuses = fs.globStatus(hadoop_path) or []
+    return sorted(status.getPath().toString() for status in statuses if status.isFile())
+
+
+def get_months(start_date, end_date):
+    """
+    Returns the (year, month) of every month from start_date to end_date.
+    """
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def get_adjacent_months(months):
+    """
+    Returns the (year, month) of the months, and of the month before and after each of them.
+    """
+    adjacent = set()
+    for year, month in months:
+        adjacent.add((year - 1, 12) if month == 1 else (year, month - 1))
+        adjacent.add((year, month))
+        adjacent.add((year + 1, 1) if month == 12 else (year, month + 1))
+    return sorted(adjacent)
+
+
+def get_file_day(path):
+    """
+    Returns the day of a log file from its name, e.g. 2018-11-01 for 2018-11-01-events.json,
+    or None if its name has no date.
+    """
+    match = FILE_DAY.search(path.rsplit('/', 1)[-1])
+    return date(*map(int, match.groups())) if match else None
+
+
+def get_file_month(path):
+    """
+    Returns the (year, month) of a log file from its log_data/YYYY/MM folder.
+    """
+    year, month = path.rstrip('/').split('/')[-3:-1]
+    return int(year), int(month)
+
+
+def list_month_log_files(spark, input_data, months):
+    """
+    Returns the log files of the months, a list of (year, month), under their log_data/YYYY/MM
+    prefixes.
+    """
+    files = []
+    for year, month in months:
+        files += list_files(spark, '{}/log_data/{:04d}/{:02d}/*.json'.format(input_data.rstrip('/'), year, month))
+    return files
+
+
+def list_log_files(spark, input_data, start_date, end_date):
+    """
+    Returns the log files of the months from start_date to end_date.
+    """
+    return list_month_log_files(spark, input_data, get_months(start_date, end_date))
+
+
+def read_state(spark, path):
+    """
+    Returns the state of the runs, or an empty state if there is no state file yet.
+    """
+    hadoop_path, fs = get_path(spark, path)
+    if not fs.exists(hadoop_path):
+        return {'log_files': [], 'song_files': [], 'updated_at': None}
+
+    jvm = spark._jvm
+    reader = jvm.java.io.BufferedReader(jvm.java.io.InputStreamReader(fs.open(hadoop_path), 'UTF-8'))
+    lines = []
+    try:
+        line = reader.readLine()
+        while line is not None:
+            lines.append(line)
+            line = reader.readLine()
+    finally:
+        reader.close()
+    return json.loads('\n'.join(lines))
+
+
+def write_state(spark, path, state, log_files=(), song_files=()):
+    """
+    Adds the files loaded by a run to the state, and writes it.  The state is written once the
+    tables are, so a failed run is done again.
+    """
+    state['log_files'] = sorted(set(state['log_files']) | set(log_files))
+    state['song_files'] = sorted(set(state['song_files']) | set(song_files))
+    state['updated_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+    hadoop_path, fs = get_path(spark, path)
+    stream = fs.create(hadoop_path, True)
+    try:
+        stream.write(bytearray(json.dumps(state, indent=1, sort_keys=True).encode('utf8')))
+    finally:
+        stream.close()
@@ -0,0 +1,191 @@
+"""
+Layout of the parquet files written by the data lake ETL, and compaction of existing output.
+
+Spark writes one file per task and per partition value, whatever their size: partitioning
+the songs by year and artist_id made one directory per artist, with tens of thousands of
+tiny files that make every read slow.  Each table has a layout instead:
+- partition_by: the partition columns (directories) of the table
+- sort_by: columns the rows are sorted by within each file, so that the min/max statistics of
+  the parquet row groups let readers skip the files and row groups of other values
+- bucket_by / buckets: hash the rows into a fixed number of files by a column, so that all the
+  rows of a value are in the same file (bucketBy needs a metastore table, so the buckets are
+  the tasks of a repartition instead)
+
+Before writing, the rows are repartitioned by ranges of the partition and sort columns (or by
+the bucket column), in as many tasks as files of target_file_size bytes the table needs, so that
+a large partition value is written by several tasks, and maxRecordsPerFile splits the files of
+the values too large for one file.  The size of the table is estimated from its
+number of rows and the width of its columns before compression, so the files on disk are
+smaller than the target.
+
+Usage, to rewrite existing output into files of about 128 MB with the layout of its table:
+
+    python3 output_layout.py /tmp/sparkify/songs.parquet --table songs --master 'local[*]'
+"""
+import argparse
+import math
+import uuid
+
+from pyspark.sql.functions import col, hash as hash_columns
+from pyspark.sql import types as T
+
+
+# Layout of each table of the data lake
+LAYOUTS = {
+    'songs': {'partition_by': ['year'], 'sort_by': ['artist_id']},
+    'artists': {'sort_by': ['artist_id']},
+    'users': {'sort_by': ['user_id']},
+    'time': {'partition_by': ['year', 'month'], 'sort_by': ['start_time']},
+    'songplays': {'partition_by': ['year', 'month'], 'sort_by': ['start_time']},
+}
+
+DEFAULT_TARGET_FILE_SIZE = 128 * 1024 * 1024
+
+# Estimated bytes of a value of each type, before compression
+TYPE_SIZES = {T.BooleanType: 1, T.ByteType: 1, T.ShortType: 2, T.IntegerType: 4, T.FloatType: 4, T.DateType: 4,
+              T.LongType: 8, T.DoubleType: 8, T.TimestampType: 8, T.DecimalType: 16}
+STRING_SIZE = 24
+
+
+def get_layout(table, **overrides):
+    """
+    Returns the layout of a table, with the options that are not None in overrides replacing
+    those of LAYOUTS.
+    """
+    layout = {'partition_by': [], 'sort_by': [], 'bucket_by': None, 'buckets': 0}
+    layout.update(LAYOUTS.get(table, {}))
+    layout.update((name, value) for name, value in overrides.items() if value is not None)
+    return layout
+
+
+def get_row_size(schema):
+    """
+    Returns the estimated size of a row of a schema, in bytes before compression.
+    """
+    return sum(TYPE_SIZES.get(type(field.dataType), STRING_SIZE) for field in schema.fields) or 1
+
+
+def arrange(df, layout, rows, target_file_size=DEFAULT_TARGET_FILE_SIZE):
+    """
+    Returns the rows of a data frame of a number of rows repartitioned and sorted for the
+    layout, and the largest number of rows of a file.
+    """
+    row_size = get_row_size(df.schema)
+    rows_per_file = max(1, target_file_size // row_size)
+    files = max(1, int(math.ceil(rows / float(rows_per_file))))
+
+    sort_by = list(layout['partition_by']) + [name for name in layout['sort_by'] if name not in layout['partition_by']]
+
+    if layout['bucket_by']:
+        df = df.repartition(layout['buckets'] or files, col(layout['bucket_by']))
+    elif layout['partition_by']:
+        # Ranges of the partition and sort columns, so that a partition value too large for one
+        # task is split over several, instead of hashing each value to a single task.  Without
+        # sort columns, a hash of the row splits the values.
+        keys = [col(name) for name in sort_by]
+        if len(sort_by) == len(layout['partition_by']):
+            keys.append(hash_columns(*[col(name) for name in df.columns]))
+        df = df.repartitionByRange(files, *keys)
+    else:
+        df = df.repartition(files)
+
+    if sort_by:
+        df = df.sortWithinPartitions(*sort_by)
+
+    return df, rows_per_file
+
+
+def write_table(df, path, layout, target_file_size=DEFAULT_TARGET_FILE_SIZE, mode='overwrite'):
+    """
+    Writes a data frame to a parquet table with a layout.  Returns the number of rows.  The data
+    frame is cached while it is written, if it is not already, so that counting its rows does
+    not compute it twice.
+    """
+    cached = df.is_cached
+    if not cached:
+        df = df.cache()
+    try:
+        rows = df.count()
+        arranged, rows_per_file = arrange(df, layout, rows, target_file_size)
+        writer = arranged.write.mode(mode).option('maxRecordsPerFile', rows_per_file)
+        if layout['partition_by']:
+            writer = writer.partitionBy(*layout['partition_by'])
+        writer.parquet(path)
+    finally:
+        if not cached:
+            df.unpersist()
+    return rows
+
+
+def replace_path(spark, source, target):
+    """
+    Replaces the files of a path by those of another path, with the Hadoop file system of the
+    path.  On S3 a rename is a copy, which can fail part way, so the target is first moved to a
+    backup path, and deleted only once the source is in its place.  If a move fails, nothing is
+    deleted, and the error names the paths the files are left at.
+    """
+    jvm = spark._jvm
+    source_path = jvm.org.apache.hadoop.fs.Path(source)
+    target_path = jvm.org.apache.hadoop.fs.Path(target)
+    backup = '{}.replaced-{}'.format(target.rstrip('/'), uuid.uuid4().hex[:8])
+    backup_path = jvm.org.apache.hadoop.fs.Path(backup)
+    fs = target_path.getFileSystem(spark._jsc.hadoopConfiguration())
+
+    exists = fs.exists(target_path)
+    if exists and not fs.rename(target_path, backup_path):
+        raise IOError('Could not move {} to {}: the table is unchanged, and the new files are in {}'.format(
+            target, backup, source))
+    if not fs.rename(source_path, target_path):
+        if exists:
+            raise IOError('Could not move {} to {}: the original files are in {}'.format(source, target, backup))
+        raise IOError('Could not move {} to {}'.format(source, target))
+    if exists:
+        fs.delete(backup_path, True)
+
+
+def compact(spark, path, layout, target_file_size=DEFAULT_TARGET_FILE_SIZE):
+    """
+    Rewrites a parquet table into files of about target_file_size bytes with a layout.  The
+    table is written next to the original first, as Spark cannot overwrite the path it is
+    reading, and then moved in its place with replace_path.  Returns the number of rows.
+    """
+    staging = '{}.compacting-{}'.format(path.rstrip('/'), uuid.uuid4().hex[:8])
+    rows = write_table(spark.read.parquet(path), staging, layout, target_file_size)
+    replace_path(spark, staging, path.rstrip('/'))
+    return rows
+
+
+def parse_columns(value):
+    return [name for name in value.split(',') if name] if value is not None else None
+
+
+def main():
+    """
+    Compacts existing output of the data lake ETL into files of the target size, with the
+    layout of its table, or with the layout given by the options.
+    """
+    from etl import create_spark_session
+
+    parser = argparse.ArgumentParser(description='Rewrite a parquet table of the data lake into right-sized files.')
+    parser.add_argument('path', help='path of the parquet table, e.g. s3a://bucket/songs.parquet')
+    parser.add_argument('--table', choices=sorted(LAYOUTS), default=None,
+                        help='table whose layout is used (default: no partitions, no sorting)')
+    parser.add_argument('--partition-by', default=None, help='comma separated partition columns, overriding the layout')
+    parser.add_argument('--sort-by', default=None, help='comma separated columns the files are sorted by, overriding the layout')
+    parser.add_argument('--bucket-by', default=None, help='column the rows are hashed into files by')
+    parser.add_argument('--buckets', type=int, default=None, help='number of files of --bucket-by (default: from the target size)')
+    parser.add_argument('--target-file-size', type=int, default=DEFAULT_TARGET_FILE_SIZE // (1024 * 1024),
+                        help='size of the files in MB, before compression (default: 128)')
+    parser.add_argument('--master', default=None,
+                        help="Spark master URL, e.g. 'local[*]' to run locally (default: from the Spark configuration)")
+    args = parser.parse_args()
+
+    layout = get_layout(args.table, partition_by=parse_columns(args.partition_by), sort_by=parse_columns(args.sort_by),
+                        bucket_by=args.bucket_by, buckets=args.buckets)
+    spark = create_spark_session(args.master)
+    rows = compact(spark, args.path, layout, args.target_file_size * 1024 * 1024)
+    print('Compacted {} rows of {}'.format(rows, args.path))
+
+
+if __name__ == "__main__":
+    main()
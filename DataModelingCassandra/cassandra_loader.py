@@ -0,0 +1,151 @@
+import os
+import sys
+import csv
+import glob
+import argparse
+from cassandra.cluster import Cluster
+
+# the instrumentation module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrumentation import configure, stage, finish
+
+
+# Columns of the denormalized event file, in the order of its header
+EVENT_COLUMNS = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                 'level', 'location', 'sessionId', 'song', 'userId']
+
+create_table_queries = [
+    "CREATE TABLE IF NOT EXISTS session_history "
+    "(sessionId INT, itemInSession INT, artist TEXT, song TEXT, length DECIMAL, PRIMARY KEY(sessionId, itemInSession))",
+    "CREATE TABLE IF NOT EXISTS user_play_history "
+    "(userId INT, sessionId INT, itemInSession INT, artist TEXT, song TEXT, firstName TEXT, lastName TEXT, "
+    "PRIMARY KEY((userId, sessionId), itemInSession))",
+    "CREATE TABLE IF NOT EXISTS song_play_history "
+    "(song TEXT, userId INT, firstName TEXT, lastName TEXT, PRIMARY KEY(song, userId))",
+]
+
+drop_table_queries = [
+    "DROP TABLE IF EXISTS session_history",
+    "DROP TABLE IF EXISTS user_play_history",
+    "DROP TABLE IF EXISTS song_play_history",
+]
+
+session_history_insert = ("INSERT INTO session_history (sessionId, itemInSession, artist, song, length)"
+                          " VALUES (%s, %s, %s, %s, %s)")
+user_play_history_insert = ("INSERT INTO user_play_history (userId, sessionId, itemInSession, artist, song, firstName, lastName)"
+                            " VALUES (%s, %s, %s, %s, %s, %s, %s)")
+song_play_history_insert = ("INSERT INTO song_play_history (song, userId, firstName, lastName)"
+                            " VALUES (%s, %s, %s, %s)")
+
+
+def get_event_files(filepath):
+    """
+    Finds all the CSV files in the event data folder.
+    """
+    file_path_list = []
+    for root, dirs, files in os.walk(filepath):
+        file_path_list.extend(glob.glob(os.path.join(root, '*.csv')))
+
+    return sorted(file_path_list)
+
+
+def write_event_datafile(file_path_list, event_datafile):
+    """
+    Combines the event files into one denormalized CSV file, keeping only the events
+    with an artist (i.e. the song plays) and the columns used by the Cassandra tables.
+    Returns the number of rows written.
+    """
+    csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+    num_rows = 0
+    with open(event_datafile, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(EVENT_COLUMNS)
+
+        for filepath in file_path_list:
+            with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+                csvreader = csv.reader(csvfile)
+                next(csvreader)
+
+                for row in csvreader:
+                    if (row[0] == ''):
+                        continue
+                    writer.writerow((row[0], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[12], row[13], row[16]))
+                    num_rows += 1
+
+    return num_rows
+
+
+def create_tables(session):
+    """
+    Drops and creates the tables used by the three queries of the project.
+    """
+    for query in drop_table_queries + create_table_queries:
+        session.execute(query)
+
+
+def insert_rows(session, event_datafile):
+    """
+    Inserts the rows of the denormalized event file into the three tables, the same way
+    as the notebook.  Returns the number of rows read.
+    """
+    num_rows = 0
+    with open(event_datafile, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        next(csvreader) # skip header
+        for line in csvreader:
+            session.execute(session_history_insert, (int(line[8]), int(line[3]), line[0], line[9], float(line[5])))
+            session.execute(user_play_history_insert, (int(line[10]), int(line[8]), int(line[3]), line[0], line[9], line[1], line[4]))
+            session.execute(song_play_history_insert, (line[9], int(line[10]), line[1], line[4]))
+            num_rows += 1
+
+    return num_rows
+
+
+def main():
+    """
+    Script version of the ETL pipeline in the notebook:
+    - Combines the files in the event data folder into the denormalized event file
+    - Connects to Cassandra, and creates the sparkify keyspace and the tables
+    - Inserts the rows of the event file into the tables
+    """
+    parser = argparse.ArgumentParser(description='Load the event data into the sparkify Cassandra keyspace.')
+    parser.add_argument('--event-data', default='event_data',
+                        help='folder containing the event CSV files (default: event_data)')
+    parser.add_argument('--event-datafile', default='event_datafile_new.csv',
+                        help='path of the denormalized event file (default: event_datafile_new.csv)')
+    parser.add_argument('--host', default='127.0.0.1', help='Cassandra host (default: 127.0.0.1)')
+    args = parser.parse_args()
+
+    # Time the stages of the run if ETL_REPORT is set
+    configure('cassandra_loader')
+
+    with stage('combine') as s:
+        file_path_list = get_event_files(args.event_data)
+        s.add(rows=write_event_datafile(file_path_list, args.event_datafile))
+    print('{} event files combined into {}'.format(len(file_path_list), args.event_datafile))
+
+    cluster = Cluster([args.host])
+    session = cluster.connect()
+
+    session.execute("""
+    CREATE KEYSPACE IF NOT EXISTS sparkify
+    WITH REPLICATION =
+    { 'class' : 'SimpleStrategy', 'replication_factor' : 1 }""")
+    session.set_keyspace('sparkify')
+
+    with stage('create tables'):
+        create_tables(session)
+
+    with stage('insert') as s:
+        num_rows = insert_rows(session, args.event_datafile)
+        s.add(rows=num_rows)
+    print('{} rows inserted into each table'.format(num_rows))
+
+    session.shutdown()
+    cluster.shutdown()
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_batch
+from instrumentation import worker_task, worker_result
+from sql_queries import songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert
+from sql_queries import time_table_insert, songplay_file_delete
+
+
+TABLE_INSERTS = {
+    'songplays': songplay_table_insert,
+    'users': user_table_insert,
+    'songs': song_table_insert,
+    'artists': artist_table_insert,
+    'time': time_table_insert,
+}
+
+
+class StageStats:
+    """
+    Counts the items and rows that went through a stage of the pipeline, and the time
+    from when the stage started its first item to when it finished its last one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        if self.started_at is None:
+            self.started_at = time.time()
+
+    def finish(self, items=1, rows=0):
+        self.items += items
+        self.rows += rows
+        self.finished_at = time.time()
+
+    def report(self):
+        if self.started_at is None:
+            return '{}: no items'.format(self.name)
+
+        elapsed = max(self.finished_at - self.started_at, 1e-9)
+        return '{}: {} items, {} rows in {:.2f}s ({:.1f} items/s, {:.1f} rows/s)'.format(
+            self.name, self.items, self.rows, elapsed, self.items / elapsed, self.rows / elapsed)
+
+
+def write_tables(conn, tables, batch):
+    """
+    Writes the rows of a batch for the given tables on one connection, and commits.
+    The songplays of the batch's files from an earlier load are deleted first.
+    """
+    cur = conn.cursor()
+    for table in tables:
+        if table == 'songplays':
+            for filepath, row_count in batch['files']:
+                cur.execute(songplay_file_delete, (filepath,))
+        execute_batch(cur, TABLE_INSERTS[table], batch['rows'][table])
+    conn.commit()
+
+
+class AsyncPipeline:
+    """
+    Loads the data files through a pipeline of asyncio stages connected by bounded queues,
+    so that reading the files, resolving the lookups and writing to the database overlap.
+    - parse: the files are read and their records extracted in a pool of worker processes.
+      At most queue_depth files are in flight, which holds back the reading when the later
+      stages fall behind.
+    - transform: in this process, the records are turned into table rows (e.g. the songplay
+      keys are resolved with the song lookup) and grouped into batches of batch_size rows.
+    - write: the tables are spread over pool_size connections from a connection pool, and
+      each connection writes the rows of its tables in a thread, batch after batch.  Each
+      table is always written by the same connection in file order, so the result is the
+      same as a sequential load.
+    - manifest: once all the tables of a batch are committed, its files are recorded in the
+      load manifest.
+    The throughput of each stage is printed at the end of each pass.
+    """
+
+    def __init__(self, dsn, conn, pool_size=3, queue_depth=64, batch_size=10000, workers=2, manifest=None):
+        self.conn = conn
+        self.pool_size = pool_size
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+        self.workers = workers
+        self.manifest = manifest
+        self.pool = ThreadedConnectionPool(1, pool_size, dsn)
+
+    def close(self):
+        self.pool.closeall()
+
+    def run(self, files, extract_func, transform_func, tables):
+        """
+        Runs one pass of the pipeline over the files.
+        - extract_func(filepath) runs in the worker processes and returns the file's records
+        - transform_func(records) runs in this process and returns (row_count, {table: rows})
+        """
+        return asyncio.run(self._run(files, extract_func, transform_func, tables))
+
+    async def _run(self, files, extract_func, transform_func, tables):
+        loop = asyncio.get_running_loop()
+
+        num_lanes = min(self.pool_size, len(tables))
+        lanes = [tables[i::num_lanes] for i in range(num_lanes)]
+
+        parsed = asyncio.Queue(maxsize=self.queue_depth)
+        lane_queues = [asyncio.Queue(maxsize=self.queue_depth) for lane in lanes]
+        written = asyncio.Queue(maxsize=self.queue_depth)
+
+        stats = [StageStats('parse'), StageStats('transform')]
+        stats += [StageStats('write ' + ', '.join(lane)) for lane in lanes]
+        stats.append(StageStats('manifest'))
+        parse_stats, transform_stats, manifest_stats = stats[0], stats[1], stats[-1]
+
+        processes = ProcessPoolExecutor(max_workers=self.workers)
+        threads = ThreadPoolExecutor(max_workers=num_lanes + 1)
+
+        # the stages timed in the worker processes are returned with the records, and added to the run report
+        extract_task = worker_task(extract_func)
+
+        async def parse():
+            for filepath in files:
+                parse_stats.start()
+                await parsed.put((filepath, loop.run_in_executor(processes, extract_task, filepath)))
+            await parsed.put(None)
+
+        async def dispatch(batch):
+            batch['done'] = [loop.create_future() for lane in lanes]
+            await written.put(batch)
+            for queue in lane_queues:
+                await queue.put(batch)
+
+        async def transform():
+            batch = {'files': [], 'rows': {table: [] for table in tables}, 'row_count': 0}
+            while True:
+                item = await parsed.get()
+                if item is None:
+                    break
+
+                filepath, future = item
+                records = worker_result(await future)
+                parse_stats.finish()
+
+                transform_stats.start()
+                row_count, rows = transform_func(records)
+                batch['files'].append((filepath, row_count))
+                for table in tables:
+                    batch['rows'][table].extend(rows[table])
+                batch['row_count'] += row_count
+                transform_stats.finish(rows=row_count)
+
+                if batch['row_count'] >= self.batch_size:
+                    await dispatch(batch)
+                    batch = {'files': [], 'rows': {table: [] for table in tables}, 'row_count': 0}
+
+            if batch['files']:
+                await dispatch(batch)
+
+            await written.put(None)
+            for queue in lane_queues:
+                await queue.put(None)
+
+        async def write(index):
+            lane_stats = stats[2 + index]
+            conn = self.pool.getconn()
+            try:
+                while True:
+                    batch = await lane_queues[index].get()
+                    if batch is None:
+                        break
+
+                    lane_stats.start()
+                    try:
+                        await loop.run_in_executor(threads, write_tables, conn, lanes[index], batch)
+                    except Exception as e:
+                        conn.rollback()
+                        batch['done'][index].set_exception(e)
+                        raise
+                    batch['done'][index].set_result(True)
+                    lane_stats.finish(rows=sum(len(batch['rows'][table]) for table in lanes[index]))
+            finally:
+                self.pool.putconn(conn)
+
+        def record_files(batch):
+            cur = self.conn.cursor()
+            for filepath, row_count in batch['files']:
+                self.manifest.record(cur, filepath, row_count)
+            self.conn.commit()
+
+        async def record():
+            num_files = 0
+            while True:
+                batch = await written.get()
+                if batch is None:
+                    break
+
+                await asyncio.gather(*batch['done'])
+                manifest_stats.start()
+                if self.manifest is not None:
+                    await loop.run_in_executor(threads, record_files, batch)
+                manifest_stats.finish(items=len(batch['files']))
+
+                num_files += len(batch['files'])
+                print('{}/{} files processed.'.format(num_files, len(files)))
+
+        tasks = [asyncio.ensure_future(coro) for coro in
+                 [parse(), transform(), record()] + [write(i) for i in range(num_lanes)]]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            processes.shutdown()
+            threads.shutdown()
+
+        for stage in stats:
+            print(stage.report())
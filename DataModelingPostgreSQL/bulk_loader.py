@@ -0,0 +1,71 @@
+import csv
+import io
+from instrumentation import stage
+from sql_queries import stage_table_create_queries, stage_copy_queries, stage_merge_queries
+
+
+# Marker used for NULL values in the CSV buffers (see the COPY queries in sql_queries.py)
+NULL_MARKER = r'\N'
+
+
+class BulkLoader:
+    """
+    Loads rows into the sparkify tables in bulk instead of one INSERT per row.
+    - Rows are accumulated in in-memory CSV buffers, one per table
+    - On flush, each buffer is sent with COPY ... FROM STDIN into a temp staging table
+    - The staging tables are then merged into the final tables with set-based
+      INSERT ... ON CONFLICT statements, and the transaction is committed
+    """
+
+    def __init__(self, cur, conn, batch_size=50000):
+        self.cur = cur
+        self.conn = conn
+        self.batch_size = batch_size
+        self.seq = 0
+        self.pending = 0
+        self.buffers = {}
+
+        for query in stage_table_create_queries:
+            self.cur.execute(query)
+        self.conn.commit()
+
+        self._reset_buffers()
+
+    def _reset_buffers(self):
+        self.buffers = {table: io.StringIO() for table in stage_copy_queries}
+        self.writers = {table: csv.writer(buf) for table, buf in self.buffers.items()}
+        self.pending = 0
+
+    def add(self, table, rows):
+        """
+        Buffers the rows for a table.  The row values must be in the column order of the
+        table's COPY query, without the leading 'seq' column.
+        """
+        writer = self.writers[table]
+        for row in rows:
+            self.seq += 1
+            writer.writerow([self.seq] + [NULL_MARKER if value is None else value for value in row])
+            self.pending += 1
+
+    def is_full(self):
+        return self.pending >= self.batch_size
+
+    def flush(self):
+        """
+        Copies the buffered rows into the staging tables, merges them into the final tables,
+        and commits.  The staging tables are emptied on commit.
+        """
+        if self.pending == 0:
+            return
+
+        with stage('flush', rows=self.pending):
+            for table, buf in self.buffers.items():
+                if buf.tell() > 0:
+                    buf.seek(0)
+                    self.cur.copy_expert(stage_copy_queries[table], buf)
+
+            for query in stage_merge_queries:
+                self.cur.execute(query)
+
+            self.conn.commit()
+        self._reset_buffers()
@@ -1,6 +1,12 @@
+import os
+import sys
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
 
+# the query cache module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from query_cache import bump_data_version
+
 
 def create_database():
     """
@@ -63,6 +69,10 @@ def main():
     drop_tables(cur, conn)
     create_tables(cur, conn)
 
+    # The tables are empty: drop the dashboard results cached before
+    bump_data_version(cur, 'create_tables')
+    conn.commit()
+
     conn.close()
 
 
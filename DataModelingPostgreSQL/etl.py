@@ -1,115 +1,628 @@
 import os
+import io
 import glob
+import time
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import psycopg2
+from psycopg2.extras import execute_batch
 import pandas as pd
+
+# the instrumentation module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrumentation import configure, stage, instrument_cursor, finish, worker_task, worker_result
 from sql_queries import *
+from bulk_loader import BulkLoader
+from song_lookup import SongLookup
+from load_manifest import LoadManifest
+from song_reader import read_song_batches
+from time_dimension import TimeDimension
+from log_stream import LogTail, StreamMetrics, tail_log_files, micro_batches
+from async_pipeline import AsyncPipeline
+from query_cache import bump_data_version
+
+
+# Columns of a resolved songplay data frame, in the order of songplay_table_insert
+SONGPLAY_COLUMNS = ['ts', 'userId', 'level', 'song_id', 'artist_id', 'sessionId', 'location', 'userAgent', 'source_file']
 
 
-def process_song_file(cur, filepath):
+def get_song_records(df):
     """
-    Processes a song file containing song and artist information.
-    - Extract the appropriate fields for each table
-    - Insert the fields into the 'songs' and 'artists' tables
+    Extracts the song and artist records from a data frame of song data.
+    Artists appearing more than once are only kept once (the first record wins, the
+    same as the artist_table_insert query).
+    Returns the list of song rows and the list of artist rows.
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    song_data = df.loc[:,['song_id', 'title', 'artist_id', 'year', 'duration']].values.tolist()
+    artist_df = df.loc[:,['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']]
+    artist_data = artist_df.drop_duplicates('artist_id').values.tolist()
 
-    # insert song record
-    song_data = df.loc[:,['song_id', 'title', 'artist_id', 'year', 'duration']].values[0].tolist()
-    cur.execute(song_table_insert, song_data)
-    
-    # insert artist record
-    artist_data = df.loc[:,['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values[0].tolist()
-    cur.execute(artist_table_insert, artist_data)
+    return song_data, artist_data
 
 
-def process_log_file(cur, filepath):
+def get_log_records(df):
     """
-    Processes a log file containing information about the songs user listened to.
+    Extracts the user and songplay records from a data frame of log data.
     - Filter only rows with song selection information denoted by page = 'NextSong'
-    - Extract the start time information and add time attributes to the 'time' table
-    - Extract user information fields and insert them into the 'users' table
-    - Finally, extract and insert fields into the 'songplay' table.  Two of the fields are
-      foreign keys into the songs and artists tables.  These keys can be obtained by
-      using the song_select query based on the song name, artist name, and song duration.
+    - The songplay rows contain the song name, artist name and song length in place of the
+      song and artist foreign keys, which still need to be looked up.
+    The time records are built from the songplay start times by the time dimension when
+    the records are written.
+    Returns the user and songplay data frames.
     """
-    
-    # open log file
-    df = pd.read_json(filepath, lines=True)
 
     # filter by NextSong action
     df = df.loc[df['page'] == 'NextSong',:]
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    time_data = (df.ts, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame.from_dict(dict(zip(column_labels, time_data)))
+    # user records
+    user_df = df.loc[:,['userId', 'firstName', 'lastName', 'gender', 'level']]
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    # songplay records
+    songplay_df = df.loc[:,['ts', 'userId', 'level', 'song', 'artist', 'length', 'sessionId', 'location', 'userAgent']]
+
+    return user_df, songplay_df
+
+
+def extract_song_file(filepath):
+    """
+    Reads a song file and extracts its song and artist records.
+    In parallel mode this runs in the worker processes.
+    """
+    with stage('parse') as s:
+        df = pd.read_json(filepath, lines=True)
+        s.add(rows=len(df))
+        s.add_file(filepath)
+
+    with stage('transform', rows=len(df)):
+        return get_song_records(df)
+
+
+def extract_log_file(filepath):
+    """
+    Reads a log file and extracts its user and songplay records.  The songplays
+    are tagged with the file they came from, so that they can be replaced if the file
+    is loaded again.
+    In parallel mode this runs in the worker processes.
+    """
+    with stage('parse') as s:
+        df = pd.read_json(filepath, lines=True)
+        s.add(rows=len(df))
+        s.add_file(filepath)
+
+    with stage('transform', rows=len(df)):
+        user_df, songplay_df = get_log_records(df)
+        songplay_df = songplay_df.assign(source_file=filepath)
+    return filepath, user_df.values.tolist(), songplay_df
 
-    # load user table
-    user_df = df.loc[:,['userId', 'firstName', 'lastName', 'gender', 'level']]
+
+def extract_log_events(events):
+    """
+    Parses a batch of log lines read by the streaming mode, and extracts their user and
+    songplay records.  The lines can come from several files, and each songplay is tagged
+    with the file it came from.
+    """
+    with stage('parse', rows=len(events), bytes=sum(len(event.line) for event in events)):
+        df = pd.read_json(io.StringIO('\n'.join(event.line for event in events)), lines=True)
+        df['source_file'] = [event.path for event in events]
+
+    with stage('transform', rows=len(df)):
+        user_df, songplay_df = get_log_records(df)
+        songplay_df = songplay_df.assign(source_file=df['source_file'])
+    return None, user_df.values.tolist(), songplay_df
+
+
+def insert_song_records(cur, records, lookup=None):
+    """
+    Inserts the song and artist records extracted from a song file.
+    - Insert the fields into the 'songs' and 'artists' tables
+    - If a song lookup is given, add the songs to it so that it stays current
+    Returns the number of songs.
+    """
+    song_data, artist_data = records
+
+    # insert song records
+    execute_batch(cur, song_table_insert, song_data)
+
+    # insert artist records
+    execute_batch(cur, artist_table_insert, artist_data)
+
+    if lookup is not None:
+        lookup.add_songs(song_data, artist_data)
+
+    return len(song_data)
+
+
+def insert_log_records(cur, records, lookup=None, time_dimension=None):
+    """
+    Inserts the time, user and songplay records extracted from a log file.
+    - Delete the songplays of the file from an earlier load, if any
+    - Add the time attributes of the start times to the 'time' table.  If a time dimension
+      is given, only the start times it has not seen before in this run are inserted.
+    - Insert the user information fields into the 'users' table
+    - Finally, insert the fields into the 'songplay' table.  Two of the fields are
+      foreign keys into the songs and artists tables.  These keys can be obtained by
+      using the song_select query based on the song name, artist name, and song duration,
+      or, if a song lookup is given, by resolving all the song plays at once in memory.
+    Returns the number of songplays.
+    """
+    filepath, user_data, songplay_df = records
+
+    # remove the songplays of a previous load of this file.  Records from the streaming
+    # mode do not cover a whole file (filepath is None), so there is nothing to replace.
+    if filepath is not None:
+        cur.execute(songplay_file_delete, (filepath,))
+
+    # insert time data records
+    if time_dimension is None:
+        time_dimension = TimeDimension()
+    with stage('time dimension', rows=len(songplay_df)):
+        time_rows = time_dimension.get_new_rows(songplay_df['ts'].values)
+    execute_batch(cur, time_table_insert, time_rows)
 
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    execute_batch(cur, user_table_insert, user_data)
+
+    # insert songplay records, with the songid and artistid from the lookup
+    if lookup is not None:
+        with stage('lookup', rows=len(songplay_df)):
+            songplay_df = lookup.resolve(songplay_df)
+        execute_batch(cur, songplay_table_insert, songplay_df.loc[:, SONGPLAY_COLUMNS].values.tolist())
+        return len(songplay_df)
 
     # insert songplay records
-    for index, row in df.iterrows():
-        
+    for ts, user_id, level, song, artist, length, session_id, location, user_agent, source_file in songplay_df.values.tolist():
+
         # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
+        cur.execute(song_select, (song, artist, length))
         results = cur.fetchone()
-        
+
         if results:
             songid, artistid = results
         else:
             songid, artistid = None, None
 
         # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+        songplay_record = (ts, user_id, level, songid, artistid, session_id, location, user_agent, source_file)
+        cur.execute(songplay_table_insert, songplay_record)
+
+    return len(songplay_df)
 
 
-def process_data(cur, conn, filepath, func):
+def load_song_records(loader, records):
     """
-    Process the song/log files in the file path by finding all the files in the path,
-    and then iterating over the files with the function passed in (func).
+    Bulk load version of insert_song_records: the song and artist records are added to
+    the loader's buffers instead of being inserted one at a time.
+    """
+    song_data, artist_data = records
+
+    loader.add('songs', song_data)
+    loader.add('artists', artist_data)
+
+    return len(song_data)
+
+
+def load_log_records(loader, records, time_dimension=None):
+    """
+    Bulk load version of insert_log_records: the time, user and songplay records are added
+    to the loader's buffers.  The song and artist keys of the songplays are resolved with a
+    join when the buffers are merged into the final tables.
+    """
+    filepath, user_data, songplay_df = records
+
+    # the delete runs in the loader's transaction, before the buffers are merged
+    if filepath is not None:
+        loader.cur.execute(songplay_file_delete, (filepath,))
+
+    if time_dimension is None:
+        time_dimension = TimeDimension()
+    with stage('time dimension', rows=len(songplay_df)):
+        loader.add('time', time_dimension.get_new_rows(songplay_df['ts'].values))
+    loader.add('users', user_data)
+    loader.add('songplays', songplay_df.values.tolist())
+
+    return len(songplay_df)
+
+
+def get_song_table_rows(records, lookup=None):
+    """
+    Async pipeline version of insert_song_records: returns the number of songs, and the
+    rows to write to each table.
+    """
+    song_data, artist_data = records
+
+    if lookup is not None:
+        lookup.add_songs(song_data, artist_data)
+
+    return len(song_data), {'songs': song_data, 'artists': artist_data}
+
+
+def get_log_table_rows(records, lookup, time_dimension):
+    """
+    Async pipeline version of insert_log_records: resolves the songplay keys with the song
+    lookup, builds the new time rows, and returns the number of songplays and the rows to
+    write to each table.
+    """
+    filepath, user_data, songplay_df = records
+
+    with stage('lookup', rows=len(songplay_df)):
+        songplay_df = lookup.resolve(songplay_df)
+
+    with stage('time dimension', rows=len(songplay_df)):
+        time_rows = time_dimension.get_new_rows(songplay_df['ts'].values)
+
+    rows = {
+        'time': time_rows,
+        'users': user_data,
+        'songplays': songplay_df.loc[:, SONGPLAY_COLUMNS].values.tolist(),
+    }
+
+    return len(songplay_df), rows
+
+
+def process_song_file(cur, filepath, lookup=None):
+    """
+    Processes a song file containing song and artist information.
+    - Extract the appropriate fields for each table
+    - Insert the fields into the 'songs' and 'artists' tables
+    """
+    return insert_song_records(cur, extract_song_file(filepath), lookup)
+
+
+def process_log_file(cur, filepath, lookup=None, time_dimension=None):
+    """
+    Processes a log file containing information about the songs user listened to.
+    - Filter only rows with song selection information denoted by page = 'NextSong'
+    - Extract the time, user and songplay fields
+    - Insert them into the 'time', 'users' and 'songplay' tables
+    """
+    return insert_log_records(cur, extract_log_file(filepath), lookup, time_dimension)
+
+
+def bulk_process_song_file(loader, filepath):
+    """
+    Bulk load version of process_song_file.
+    """
+    return load_song_records(loader, extract_song_file(filepath))
+
+
+def bulk_process_log_file(loader, filepath, time_dimension=None):
+    """
+    Bulk load version of process_log_file.
+    """
+    return load_log_records(loader, extract_log_file(filepath), time_dimension)
+
+
+def commit(conn):
+    """
+    Commits the transaction of the connection, timed as the 'commit' stage.
+    """
+    with stage('commit'):
+        conn.commit()
+
+
+def get_files(filepath):
+    """
+    Finds all the JSON files in the file path, and returns their absolute paths.
     """
-    
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
 
+    return all_files
+
+
+def get_files_to_process(filepath, manifest=None):
+    """
+    Finds all the JSON files in the file path.  If a load manifest is given, only
+    the files that are new or have changed since the last load are returned.
+    """
+    with stage('discover') as s:
+        all_files = get_files(filepath)
+        s.add(rows=len(all_files))
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    if manifest is not None:
+        with stage('manifest check', rows=len(all_files)):
+            all_files = manifest.get_new_files(all_files)
+        print('{} new or changed files to process'.format(len(all_files)))
+
+    return all_files
+
+
+def process_data(cur, conn, filepath, func, manifest=None):
+    """
+    Process the song/log files in the file path by finding all the files in the path,
+    and then iterating over the files with the function passed in (func).
+    If a load manifest is given, files that have already been loaded are skipped, and
+    each processed file is recorded in the manifest.
+    """
+
+    # get all files matching extension from directory
+    all_files = get_files_to_process(filepath, manifest)
+
     # get total number of files found
     num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
 
     # iterate over files and process
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+        row_count = func(cur, datafile)
+        if manifest is not None:
+            manifest.record(cur, datafile, row_count)
+        commit(conn)
+        print('{}/{} files processed.'.format(i, num_files))
+
+
+def bulk_process_data(loader, filepath, func, manifest=None):
+    """
+    Bulk load version of process_data.  The files are added to the loader with the
+    function passed in (func), and the loader is flushed each time its buffers reach
+    the batch size, and once more after the last file.
+    """
+    all_files = get_files_to_process(filepath, manifest)
+
+    num_files = len(all_files)
+
+    for i, datafile in enumerate(all_files, 1):
+        row_count = func(loader, datafile)
+        if manifest is not None:
+            manifest.record(loader.cur, datafile, row_count)
+        if loader.is_full():
+            loader.flush()
         print('{}/{} files processed.'.format(i, num_files))
 
+    loader.flush()
+
+
+def process_song_batches(cur, conn, filepath, write_func, batch_size, loader=None, manifest=None):
+    """
+    Batched version of process_data for the song files.  The song data set is made up of a
+    large number of small files, so rather than reading each file into its own data frame,
+    the files are read in batches of batch_size records, and the songs and artists of each
+    batch are written at once with the function passed in (write_func).
+    - In the default mode each batch is committed after it is written.  When a bulk loader is
+      given, the records are added to it, and it is flushed when full and after the last batch.
+    """
+    all_files = get_files_to_process(filepath, manifest)
+
+    num_files = len(all_files)
+    num_processed = 0
+
+    for files, df in read_song_batches(all_files, batch_size):
+        with stage('transform', rows=len(df)):
+            records = get_song_records(df)
+        write_func(cur if loader is None else loader, records)
+
+        if manifest is not None:
+            for datafile, row_count in files:
+                manifest.record(cur, datafile, row_count)
+
+        if loader is None:
+            commit(conn)
+        elif loader.is_full():
+            loader.flush()
+
+        num_processed += len(files)
+        print('{}/{} files processed.'.format(num_processed, num_files))
+
+    if loader is not None:
+        loader.flush()
+
+
+def parallel_process_data(cur, conn, filepath, extract_func, write_func, workers, loader=None, manifest=None):
+    """
+    Parallel version of process_data and bulk_process_data.
+    - The files are read and their records extracted (extract_func) in a pool of worker processes
+    - The records are written by this process only, one file at a time and in the same order as
+      the sequential run, with the function passed in (write_func)
+    - In the default mode each file is committed after it is written.  When a bulk loader is given,
+      the records are added to it, and it is flushed when full and after the last file.
+    """
+    all_files = get_files_to_process(filepath, manifest)
+
+    num_files = len(all_files)
+
+    # hand the files to the workers in chunks to keep the inter-process overhead down
+    chunksize = max(1, num_files // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # the stages timed in the workers are returned with the records, and added to the run report
+        results = executor.map(worker_task(extract_func), all_files, chunksize=chunksize)
+        for i, (datafile, result) in enumerate(zip(all_files, results), 1):
+            records = worker_result(result)
+            if loader is None:
+                row_count = write_func(cur, records)
+                if manifest is not None:
+                    manifest.record(cur, datafile, row_count)
+                commit(conn)
+            else:
+                row_count = write_func(loader, records)
+                if manifest is not None:
+                    manifest.record(loader.cur, datafile, row_count)
+                if loader.is_full():
+                    loader.flush()
+            print('{}/{} files processed.'.format(i, num_files))
+
+    if loader is not None:
+        loader.flush()
+
+
+def stream_log_data(cur, conn, filepath, write_func, tail, interval, batch_size, batch_seconds, loader=None):
+    """
+    Streaming version of process_data for the log files.  Runs until interrupted.
+    - The log files are polled for new or appended lines every interval seconds
+    - The lines are grouped into micro-batches of up to batch_size events, or of the
+      events received within batch_seconds
+    - Each batch is written with the function passed in (write_func), and committed together
+      with the file offsets it reached, so that a restart does not load any line twice
+    - The end-to-end latency of each batch is printed, with a summary when the stream stops
+    """
+    print('Streaming the log files in {}'.format(filepath))
+
+    metrics = StreamMetrics()
+    events = tail_log_files(partial(get_files, filepath), tail, interval)
+
+    try:
+        for batch in micro_batches(events, batch_size, batch_seconds):
+            records = extract_log_events(batch)
+            write_func(cur if loader is None else loader, records)
+            tail.save_offsets(cur, batch)
+            bump_data_version(cur, 'postgres_stream')
+
+            if loader is not None:
+                loader.flush()
+            commit(conn)
+
+            songplay_df = records[2]
+            max_ts = int(songplay_df['ts'].max()) if len(songplay_df) else None
+            metrics.record(batch, time.time(), max_ts)
+    except KeyboardInterrupt:
+        print('Stopping the stream')
+    finally:
+        metrics.summary()
+
 
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
+    """
+    - Parses the command line arguments to select the load mode:
+      'insert' inserts the records one row at a time, 'copy' loads them in bulk
+      with COPY into staging tables which are then merged into the final tables.
+    - With more than one worker, the files are read in parallel by a pool of processes.
+    - With a song batch size, the song files are read in batches rather than one at a time.
+    - Only files that are new or have changed since the last run are processed,
+      unless a full refresh is requested.
+    - Processes the song data, and then the log data.  In streaming mode, the log files
+      are watched for new data until the script is interrupted.
+    - With the async pipeline, reading, lookups and writes run as concurrent stages, and
+      the writes are spread over a pool of connections.
+    """
+    parser = argparse.ArgumentParser(description='Load the song and log data into the sparkify database.')
+    parser.add_argument('--data', default='data',
+                        help='folder containing the song_data and log_data folders (default: data)')
+    parser.add_argument('--mode', choices=['insert', 'copy'], default='insert',
+                        help='insert one row at a time, or bulk load with COPY (default: insert)')
+    parser.add_argument('--batch-size', type=int, default=50000,
+                        help='number of rows buffered before a bulk load is flushed (default: 50000)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes used to read the files (default: 1, no parallelism)')
+    parser.add_argument('--song-batch-size', type=int, default=0,
+                        help='read the song files in batches of this many records (default: 0, one file at a time)')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='process all the files, including the ones already in the load manifest')
+    parser.add_argument('--stream', action='store_true',
+                        help='after the song data, keep watching the log files and load new events as they arrive')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between polls of the log files in streaming mode (default: 1)')
+    parser.add_argument('--stream-batch-size', type=int, default=1000,
+                        help='maximum number of events in a streaming micro-batch (default: 1000)')
+    parser.add_argument('--stream-batch-seconds', type=float, default=5.0,
+                        help='maximum seconds an event waits for its micro-batch to be written (default: 5)')
+    parser.add_argument('--async-pipeline', action='store_true',
+                        help='run the reads, lookups and writes as concurrent stages of an asyncio pipeline')
+    parser.add_argument('--pool-size', type=int, default=3,
+                        help='number of database connections used by the async pipeline (default: 3)')
+    parser.add_argument('--queue-depth', type=int, default=64,
+                        help='maximum number of items waiting between two async pipeline stages (default: 64)')
+    args = parser.parse_args()
+
+    song_path = os.path.join(args.data, 'song_data')
+    log_path = os.path.join(args.data, 'log_data')
+
+    if args.async_pipeline and (args.mode == 'copy' or args.stream):
+        parser.error('--async-pipeline cannot be combined with --mode copy or --stream')
+
+    # Time the stages and statements of the run if ETL_REPORT is set
+    configure('postgres_etl')
+
+    dsn = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+    conn = psycopg2.connect(dsn)
+    cur = instrument_cursor(conn.cursor())
+
+    manifest = LoadManifest(cur, full_refresh=args.full_refresh)
+    conn.commit()
+
+    # The start times already in the time table, so that only new ones are inserted
+    time_dimension = TimeDimension()
+    time_dimension.refresh(cur)
+
+    if args.async_pipeline:
+        lookup = SongLookup()
+        lookup.refresh(cur)
+
+        pipeline = AsyncPipeline(dsn, conn, pool_size=args.pool_size, queue_depth=args.queue_depth,
+                                 batch_size=args.batch_size, workers=args.workers, manifest=manifest)
+
+        # Process the song data, and then the user log data
+        pipeline.run(get_files_to_process(song_path, manifest), extract_song_file,
+                     partial(get_song_table_rows, lookup=lookup), ['songs', 'artists'])
+        pipeline.run(get_files_to_process(log_path, manifest), extract_log_file,
+                     partial(get_log_table_rows, lookup=lookup, time_dimension=time_dimension),
+                     ['songplays', 'users', 'time'])
+
+        pipeline.close()
+
+        # Drop the dashboard results cached before this load
+        bump_data_version(cur, 'postgres_etl')
+        conn.commit()
+        conn.close()
+        finish()
+        return
+
+    if args.mode == 'copy':
+        loader = BulkLoader(cur, conn, batch_size=args.batch_size)
+        write_songs = load_song_records
+        write_logs = partial(load_log_records, time_dimension=time_dimension)
+    else:
+        # Build the song lookup from the songs already loaded.  It is kept up to date with
+        # the new songs as they are processed, and shared across all the log files.
+        loader = None
+        lookup = SongLookup()
+        lookup.refresh(cur)
+        write_songs = partial(insert_song_records, lookup=lookup)
+        write_logs = partial(insert_log_records, lookup=lookup, time_dimension=time_dimension)
+
+    # Process the song data.  The song data is fully written before the log data is read,
+    # so that the songs are available to look up the songplay keys.
+    if args.song_batch_size > 0:
+        process_song_batches(cur, conn, song_path, write_songs, args.song_batch_size,
+                             loader=loader, manifest=manifest)
+    elif args.workers > 1:
+        parallel_process_data(cur, conn, song_path, extract_song_file, write_songs, args.workers,
+                              loader=loader, manifest=manifest)
+    elif loader is not None:
+        bulk_process_data(loader, filepath=song_path, func=bulk_process_song_file, manifest=manifest)
+    else:
+        process_data(cur, conn, filepath=song_path, func=partial(process_song_file, lookup=lookup),
+                     manifest=manifest)
 
-    # Process the song data
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    
     # Process the user log data
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if args.stream:
+        # Files already loaded by the batch ETL are only read from where the manifest says they ended
+        initial_offsets = {path: entry[0] for path, entry in manifest.entries.items()}
+        tail = LogTail(cur, initial_offsets=initial_offsets)
+        conn.commit()
+
+        stream_log_data(cur, conn, log_path, write_logs, tail, args.poll_interval,
+                        args.stream_batch_size, args.stream_batch_seconds, loader=loader)
+    elif args.workers > 1:
+        parallel_process_data(cur, conn, log_path, extract_log_file, write_logs, args.workers,
+                              loader=loader, manifest=manifest)
+    elif loader is not None:
+        bulk_process_data(loader, filepath=log_path,
+                          func=partial(bulk_process_log_file, time_dimension=time_dimension), manifest=manifest)
+    else:
+        process_data(cur, conn, filepath=log_path,
+                     func=partial(process_log_file, lookup=lookup, time_dimension=time_dimension), manifest=manifest)
+
+    # Drop the dashboard results cached before this load
+    bump_data_version(cur, 'postgres_etl')
+    conn.commit()
 
     conn.close()
+    finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+import hashlib
+import os
+from sql_queries import load_manifest_create, load_manifest_select, load_manifest_upsert
+
+
+def get_file_hash(filepath):
+    """
+    Returns the MD5 hash of the contents of a file.
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+class LoadManifest:
+    """
+    Keeps track of the files that have been loaded in the load_manifest table, so that
+    the ETL only needs to process new or changed files.
+    - A file is skipped when its size and modification time match the manifest, or, if they
+      do not, when its content hash still matches
+    - With full_refresh, every file is processed again (and the manifest is still updated)
+    """
+
+    def __init__(self, cur, full_refresh=False):
+        self.full_refresh = full_refresh
+        self.pending = {}
+
+        cur.execute(load_manifest_create)
+        cur.execute(load_manifest_select)
+        self.entries = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur.fetchall()}
+
+    def get_new_files(self, all_files):
+        """
+        Returns the files that are new or have changed since they were last loaded.
+        """
+        new_files = []
+        for path in all_files:
+            stat = os.stat(path)
+            entry = self.entries.get(path)
+
+            if not self.full_refresh and entry is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+                continue
+
+            content_hash = get_file_hash(path)
+            if not self.full_refresh and entry is not None and entry[2] == content_hash:
+                continue
+
+            self.pending[path] = (stat.st_size, stat.st_mtime, content_hash)
+            new_files.append(path)
+
+        return new_files
+
+    def record(self, cur, path, row_count):
+        """
+        Records a loaded file in the manifest.  This runs in the same transaction as the
+        file's records, so the file is only marked as loaded once its data is committed.
+        """
+        size, mtime, content_hash = self.pending.pop(path)
+        cur.execute(load_manifest_upsert, (path, size, mtime, content_hash, row_count))
+        self.entries[path] = (size, mtime, content_hash)
@@ -0,0 +1,143 @@
+import os
+import time
+from collections import deque, namedtuple
+from sql_queries import stream_offset_create, stream_offset_select, stream_offset_upsert
+
+
+# A line of a log file, with the byte offset just past it and the time it was first seen
+LogEvent = namedtuple('LogEvent', ['path', 'end_offset', 'detected_at', 'line'])
+
+
+class LogTail:
+    """
+    Reads the lines that have been appended to the log files since they were last read.
+    - The read position of each file is kept as a byte offset.  The offsets are saved in the
+      stream_offsets table in the same transaction as the events, so that after a restart
+      the files are read from where the last committed batch ended.
+    - Only complete lines (ending with a newline) are read, unless the file has not been
+      modified for settle_seconds, in which case its last line is assumed to be complete.
+    """
+
+    def __init__(self, cur, initial_offsets=None, settle_seconds=5.0):
+        self.settle_seconds = settle_seconds
+
+        cur.execute(stream_offset_create)
+        cur.execute(stream_offset_select)
+
+        # files loaded by other means (e.g. the batch ETL) start at the given offsets.  A file
+        # the stream stopped part way through may have been loaded by the batch ETL since, so
+        # the furthest of the two offsets is kept, and its song plays are not loaded again.
+        self.offsets = dict(initial_offsets or {})
+        for path, offset in cur.fetchall():
+            self.offsets[path] = max(offset, self.offsets.get(path, 0))
+
+    def read_new_lines(self, path):
+        """
+        Yields a LogEvent for each new line of the file.
+        """
+        offset = self.offsets.get(path, 0)
+        size = os.path.getsize(path)
+
+        if size < offset:
+            print('{} is smaller than its last offset, reading it from the start'.format(path))
+            offset = 0
+
+        if size == offset:
+            return
+
+        detected_at = time.time()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+
+        end = data.rfind(b'\n') + 1
+        if end < len(data) and detected_at - os.path.getmtime(path) >= self.settle_seconds:
+            end = len(data)
+
+        self.offsets[path] = offset + end
+
+        position = offset
+        for line in data[:end].splitlines(keepends=True):
+            position += len(line)
+            line = line.strip()
+            if line:
+                yield LogEvent(path, position, detected_at, line.decode('utf8'))
+
+    def save_offsets(self, cur, events):
+        """
+        Saves the offsets reached by a batch of events.  The caller commits them together with the events.
+        """
+        offsets = {}
+        for event in events:
+            offsets[event.path] = max(event.end_offset, offsets.get(event.path, 0))
+
+        for path, offset in offsets.items():
+            cur.execute(stream_offset_upsert, (path, offset))
+
+
+def tail_log_files(list_files, tail, interval):
+    """
+    Polls the log files every interval seconds, and yields the new lines as LogEvents.
+    After each poll None is yielded, so that consumers can act on time even when no new
+    lines arrive.  list_files is called on every poll, so new files are picked up.
+    """
+    while True:
+        for path in list_files():
+            yield from tail.read_new_lines(path)
+
+        yield None
+        time.sleep(interval)
+
+
+def micro_batches(events, max_events, max_seconds):
+    """
+    Groups the events into batches, which are yielded when they hold max_events events, or
+    when the oldest event in the batch has been waiting for max_seconds.
+    """
+    batch = []
+    for event in events:
+        if event is not None:
+            batch.append(event)
+
+        if batch and (len(batch) >= max_events or time.time() - batch[0].detected_at >= max_seconds):
+            yield batch
+            batch = []
+
+
+class StreamMetrics:
+    """
+    Tracks the end-to-end latency of the streaming mode, i.e. the time from when a line
+    was first seen in a log file to when it was committed to the database, as well as how
+    far the committed events lag behind their own timestamps.
+    """
+
+    def __init__(self, window=10000):
+        self.started_at = time.time()
+        self.events = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, batch, committed_at, max_ts):
+        """
+        Records a committed batch, and prints its metrics.  max_ts is the latest event
+        timestamp (in milliseconds) in the batch, or None if it had no song plays.
+        """
+        latencies = [committed_at - event.detected_at for event in batch]
+        self.latencies.extend(latencies)
+        self.events += len(batch)
+        self.batches += 1
+
+        lag = 'n/a' if max_ts is None else '{:.1f}s'.format(committed_at - max_ts / 1000.0)
+        print('batch {}: {} events, latency max {:.3f}s, event time lag {}'.format(
+            self.batches, len(batch), max(latencies), lag))
+
+    def percentile(self, p):
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+    def summary(self):
+        elapsed = time.time() - self.started_at
+        print('{} events in {} batches, {:.1f} events/s'.format(self.events, self.batches, self.events / elapsed))
+        if self.latencies:
+            print('latency p50 {:.3f}s, p95 {:.3f}s, max {:.3f}s'.format(
+                self.percentile(50), self.percentile(95), max(self.latencies)))
@@ -0,0 +1,90 @@
+import pandas as pd
+from sql_queries import song_lookup_select, artist_lookup_select
+
+
+SONG_COLUMNS = ['song_id', 'title', 'artist_id', 'duration']
+ARTIST_COLUMNS = ['artist_id', 'name']
+KEY_COLUMNS = ['title', 'name', 'duration']
+
+
+class SongLookup:
+    """
+    In-memory index used to find the song id and artist id of a song play, keyed on
+    (song title, artist name, song duration).  This replaces running the song_select
+    query once per event.
+    - The index is built from the songs and artists tables with refresh(), and new songs
+      can be added from parsed song files with add_songs()
+    - resolve() looks up the keys for a whole data frame of song plays at once
+    As with the songs and artists tables, the first record seen for a song id or an artist
+    id is the one that is kept.
+    """
+
+    def __init__(self):
+        self.songs = [pd.DataFrame(columns=SONG_COLUMNS)]
+        self.artists = [pd.DataFrame(columns=ARTIST_COLUMNS)]
+        self.index = None
+
+    def refresh(self, cur):
+        """
+        Rebuilds the index from the songs and artists tables.
+        """
+        cur.execute(song_lookup_select)
+        songs = pd.DataFrame(cur.fetchall(), columns=SONG_COLUMNS)
+
+        cur.execute(artist_lookup_select)
+        artists = pd.DataFrame(cur.fetchall(), columns=ARTIST_COLUMNS)
+
+        # NUMERIC values are returned as Decimal
+        songs['duration'] = songs['duration'].astype(float)
+
+        self.songs = [songs]
+        self.artists = [artists]
+        self.index = None
+
+    def add_songs(self, song_data, artist_data):
+        """
+        Adds song and artist records, in the column order of the songs and artists tables,
+        to the index.
+        """
+        songs = pd.DataFrame(song_data, columns=['song_id', 'title', 'artist_id', 'year', 'duration'])
+        artists = pd.DataFrame(artist_data, columns=['artist_id', 'name', 'location', 'latitude', 'longitude'])
+
+        self.songs.append(songs.loc[:, SONG_COLUMNS])
+        self.artists.append(artists.loc[:, ARTIST_COLUMNS])
+        self.index = None
+
+    def _build(self):
+        songs = pd.concat(self.songs, ignore_index=True).drop_duplicates('song_id')
+        artists = pd.concat(self.artists, ignore_index=True).drop_duplicates('artist_id')
+        self.songs = [songs]
+        self.artists = [artists]
+
+        index = songs.merge(artists, on='artist_id', how='inner')
+
+        # NULL keys never match in SQL, so leave them out of the index
+        index = index.dropna(subset=KEY_COLUMNS)
+        index['duration'] = index['duration'].astype(float)
+        self.index = index.drop_duplicates(KEY_COLUMNS).loc[:, KEY_COLUMNS + ['song_id', 'artist_id']]
+
+    def resolve(self, df, title='song', name='artist', duration='length'):
+        """
+        Looks up the song id and artist id for every row of the data frame, based on the song
+        title, artist name and song duration columns.  Returns a copy of the data frame with
+        'song_id' and 'artist_id' columns added, which are None when there is no match.
+        """
+        if self.index is None:
+            self._build()
+
+        keys = df.loc[:, [title, name, duration]]
+        keys.columns = KEY_COLUMNS
+        keys = keys.astype({'duration': float})
+
+        matches = keys.merge(self.index, on=KEY_COLUMNS, how='left')
+
+        resolved = df.copy()
+        for column in ['song_id', 'artist_id']:
+            values = matches[column].astype(object)
+            values = values.where(values.notnull(), None)
+            resolved[column] = pd.Series(values.values, index=df.index, dtype=object)
+
+        return resolved
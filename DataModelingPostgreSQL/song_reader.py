@@ -0,0 +1,51 @@
+import pandas as pd
+
+# orjson is considerably faster than the standard library parser, but is optional
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+SONG_FIELDS = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location',
+               'artist_name', 'song_id', 'title', 'duration', 'year']
+
+# Numeric fields that may be null, cast to float so that they match what pd.read_json returns
+FLOAT_FIELDS = {'artist_latitude': float, 'artist_longitude': float, 'duration': float}
+
+
+def read_song_batches(all_files, batch_size=1000):
+    """
+    Reads the song files and yields them in batches, instead of calling pd.read_json once per file.
+    - Each line of a file is parsed as a JSON record, and its fields are appended to
+      columnar buffers (one list per field)
+    - Once the buffers hold at least batch_size records, a data frame is built from them
+    Batches always end on a file boundary.  Yields tuples of (files, df), where files is a
+    list of (filepath, number of records) for the files in the batch.
+    """
+    columns = {field: [] for field in SONG_FIELDS}
+    files = []
+    num_records = 0
+
+    for filepath in all_files:
+        file_records = 0
+        with open(filepath, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = loads(line)
+                for field in SONG_FIELDS:
+                    columns[field].append(record.get(field))
+                file_records += 1
+
+        files.append((filepath, file_records))
+        num_records += file_records
+
+        if num_records >= batch_size:
+            yield files, pd.DataFrame(columns).astype(FLOAT_FIELDS)
+            columns = {field: [] for field in SONG_FIELDS}
+            files = []
+            num_records = 0
+
+    if files:
+        yield files, pd.DataFrame(columns).astype(FLOAT_FIELDS)
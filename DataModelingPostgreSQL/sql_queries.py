@@ -5,10 +5,15 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_manifest_drop = "DROP TABLE IF EXISTS load_manifest;"
+stream_offset_drop = "DROP TABLE IF EXISTS stream_offsets;"
 
 # CREATE TABLES
 
-songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL PRIMARY KEY, start_time BIGINT NOT NULL, user_id INT NOT NULL, level VARCHAR NOT NULL, song_id VARCHAR, artist_id VARCHAR, session_id INT, location VARCHAR, user_agent VARCHAR);
+songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL PRIMARY KEY, start_time BIGINT NOT NULL, user_id INT NOT NULL, level VARCHAR NOT NULL, song_id VARCHAR, artist_id VARCHAR, session_id INT, location VARCHAR, user_agent VARCHAR, source_file VARCHAR);
+""")
+
+songplay_source_file_index = ("""CREATE INDEX IF NOT EXISTS songplays_source_file_idx ON songplays (source_file);
 """)
 
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users (user_id INT PRIMARY KEY, first_name VARCHAR NOT NULL, last_name VARCHAR NOT NULL, gender CHAR(1), level VARCHAR NOT NULL);
@@ -23,10 +28,18 @@ artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists (artist_id VARCHAR
 time_table_create = ("""CREATE TABLE IF NOT EXISTS time (start_time BIGINT PRIMARY KEY, hour INT NOT NULL, day INT NOT NULL, week INT NOT NULL, month INT NOT NULL, year INT NOT NULL, weekday INT NOT NULL);
 """)
 
+# Records the files that have been loaded, so that a re-run only loads new or changed files
+load_manifest_create = ("""CREATE TABLE IF NOT EXISTS load_manifest (path VARCHAR PRIMARY KEY, size BIGINT NOT NULL, mtime DOUBLE PRECISION NOT NULL, content_hash VARCHAR NOT NULL, row_count INT NOT NULL, loaded_at TIMESTAMP NOT NULL);
+""")
+
+# Records how far each log file has been read in streaming mode, so that a restart resumes where it left off
+stream_offset_create = ("""CREATE TABLE IF NOT EXISTS stream_offsets (path VARCHAR PRIMARY KEY, byte_offset BIGINT NOT NULL, updated_at TIMESTAMP NOT NULL);
+""")
+
 # INSERT RECORDS
 
-songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) \
-                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent, source_file) \
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
 """)
 
 user_table_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level) \
@@ -49,6 +62,32 @@ time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, ye
                  ON CONFLICT (start_time) DO NOTHING;
 """)
 
+# DELETE RECORDS
+
+# Removes the songplays of a log file before it is loaded again
+songplay_file_delete = ("""DELETE FROM songplays WHERE source_file = %s;
+""")
+
+# LOAD MANIFEST
+
+load_manifest_select = ("""SELECT path, size, mtime, content_hash FROM load_manifest;
+""")
+
+load_manifest_upsert = ("""INSERT INTO load_manifest (path, size, mtime, content_hash, row_count, loaded_at) \
+                 VALUES (%s, %s, %s, %s, %s, NOW()) \
+                 ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, content_hash = EXCLUDED.content_hash, row_count = EXCLUDED.row_count, loaded_at = EXCLUDED.loaded_at;
+""")
+
+# STREAM OFFSETS
+
+stream_offset_select = ("""SELECT path, byte_offset FROM stream_offsets;
+""")
+
+stream_offset_upsert = ("""INSERT INTO stream_offsets (path, byte_offset, updated_at) \
+                 VALUES (%s, %s, NOW()) \
+                 ON CONFLICT (path) DO UPDATE SET byte_offset = EXCLUDED.byte_offset, updated_at = EXCLUDED.updated_at;
+""")
+
 # FIND SONGS
 
 song_select = ("""SELECT songs.song_id, artists.artist_id \
@@ -56,7 +95,104 @@ FROM songs JOIN artists ON songs.artist_id = artists.artist_id \
 WHERE (songs.title = %s) AND (artists.name = %s) AND (songs.duration = %s);
 """)
 
+# Used to build the in-memory song lookup (see song_lookup.py)
+song_lookup_select = ("""SELECT song_id, title, artist_id, duration FROM songs;
+""")
+
+artist_lookup_select = ("""SELECT artist_id, name FROM artists;
+""")
+
+# Used to find the start times that are already in the time table (see time_dimension.py)
+time_key_select = ("""SELECT start_time FROM time;
+""")
+
+# BULK LOAD STAGING TABLES
+# Temp tables used by the bulk (COPY) load mode.  The 'seq' column records the order the rows were read in,
+# so that the merges below keep the same first/last row wins semantics as the row-by-row inserts.
+
+songplay_stage_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplays_stage (seq BIGINT NOT NULL, start_time BIGINT NOT NULL, user_id INT NOT NULL, level VARCHAR NOT NULL, song VARCHAR, artist VARCHAR, length NUMERIC, session_id INT, location VARCHAR, user_agent VARCHAR, source_file VARCHAR) ON COMMIT DELETE ROWS;
+""")
+
+user_stage_create = ("""CREATE TEMP TABLE IF NOT EXISTS users_stage (seq BIGINT NOT NULL, user_id INT NOT NULL, first_name VARCHAR, last_name VARCHAR, gender CHAR(1), level VARCHAR) ON COMMIT DELETE ROWS;
+""")
+
+song_stage_create = ("""CREATE TEMP TABLE IF NOT EXISTS songs_stage (seq BIGINT NOT NULL, song_id VARCHAR NOT NULL, title VARCHAR, artist_id VARCHAR, year INT, duration NUMERIC) ON COMMIT DELETE ROWS;
+""")
+
+artist_stage_create = ("""CREATE TEMP TABLE IF NOT EXISTS artists_stage (seq BIGINT NOT NULL, artist_id VARCHAR NOT NULL, name VARCHAR, location VARCHAR, latitude NUMERIC, longitude NUMERIC) ON COMMIT DELETE ROWS;
+""")
+
+time_stage_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_stage (seq BIGINT NOT NULL, start_time BIGINT NOT NULL, hour INT, day INT, week INT, month INT, year INT, weekday INT) ON COMMIT DELETE ROWS;
+""")
+
+# BULK LOAD COPY
+# Rows are streamed as CSV, with NULL values written as \N so that empty strings are kept as empty strings.
+
+songplay_stage_copy = ("""COPY songplays_stage (seq, start_time, user_id, level, song, artist, length, session_id, location, user_agent, source_file) \
+                 FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+user_stage_copy = ("""COPY users_stage (seq, user_id, first_name, last_name, gender, level) \
+                 FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+song_stage_copy = ("""COPY songs_stage (seq, song_id, title, artist_id, year, duration) \
+                 FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+artist_stage_copy = ("""COPY artists_stage (seq, artist_id, name, location, latitude, longitude) \
+                 FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+time_stage_copy = ("""COPY time_stage (seq, start_time, hour, day, week, month, year, weekday) \
+                 FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+# BULK LOAD MERGES
+# Set-based equivalents of the INSERT RECORDS queries above.  A single INSERT ... ON CONFLICT cannot touch the
+# same key twice, so each merge first reduces the staged rows to one row per key.
+
+songplay_stage_merge = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent, source_file) \
+                 SELECT sp.start_time, sp.user_id, sp.level, m.song_id, m.artist_id, sp.session_id, sp.location, sp.user_agent, sp.source_file \
+                 FROM songplays_stage sp \
+                 LEFT JOIN LATERAL (SELECT songs.song_id, artists.artist_id \
+                                    FROM songs JOIN artists ON songs.artist_id = artists.artist_id \
+                                    WHERE (songs.title = sp.song) AND (artists.name = sp.artist) AND (songs.duration = sp.length) \
+                                    LIMIT 1) m ON TRUE \
+                 ORDER BY sp.seq;
+""")
+
+# New users keep the fields of their first row, while 'level' is taken from the latest row
+user_stage_merge = ("""INSERT INTO users (user_id, first_name, last_name, gender, level) \
+                 SELECT f.user_id, f.first_name, f.last_name, f.gender, l.level \
+                 FROM (SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender FROM users_stage ORDER BY user_id, seq) f \
+                 JOIN (SELECT DISTINCT ON (user_id) user_id, level FROM users_stage ORDER BY user_id, seq DESC) l \
+                 ON f.user_id = l.user_id \
+                 ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level;
+""")
+
+song_stage_merge = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) \
+                 SELECT DISTINCT ON (song_id) song_id, title, artist_id, year, duration \
+                 FROM songs_stage ORDER BY song_id, seq \
+                 ON CONFLICT (song_id) DO NOTHING;
+""")
+
+artist_stage_merge = ("""INSERT INTO artists (artist_id, name, location, latitude, longitude) \
+                 SELECT DISTINCT ON (artist_id) artist_id, name, location, latitude, longitude \
+                 FROM artists_stage ORDER BY artist_id, seq \
+                 ON CONFLICT (artist_id) DO NOTHING;
+""")
+
+time_stage_merge = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) \
+                 SELECT DISTINCT ON (start_time) start_time, hour, day, week, month, year, weekday \
+                 FROM time_stage ORDER BY start_time, seq \
+                 ON CONFLICT (start_time) DO NOTHING;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, songplay_source_file_index, user_table_create, song_table_create, artist_table_create, time_table_create, load_manifest_create, stream_offset_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_manifest_drop, stream_offset_drop]
+stage_table_create_queries = [songplay_stage_create, user_stage_create, song_stage_create, artist_stage_create, time_stage_create]
+stage_copy_queries = {'songplays': songplay_stage_copy, 'users': user_stage_copy, 'songs': song_stage_copy, 'artists': artist_stage_copy, 'time': time_stage_copy}
+stage_merge_queries = [song_stage_merge, artist_stage_merge, time_stage_merge, user_stage_merge, songplay_stage_merge]
\ No newline at end of file
@@ -0,0 +1,87 @@
+import os
+import sys
+import numpy as np
+from sql_queries import time_key_select
+
+# the week and weekday of the time tables are defined by the calendar dimension module, shared by
+# the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from calendar_dimension import EPOCH, get_weekday
+
+# the time table numbers the weekdays from 0 for Monday, like the pandas datetime accessors it was
+# first built with
+WEEKDAY_NUMBERING = 'monday'
+
+# 1970-01-01 was a Thursday, which is weekday 3 when Monday is 0
+EPOCH_WEEKDAY = get_weekday(EPOCH.date(), WEEKDAY_NUMBERING)
+
+
+def get_calendar_attributes(ts):
+    """
+    Computes the calendar attributes of an array of timestamps (in milliseconds since the
+    epoch, UTC) with vectorized NumPy date arithmetic.
+    The week and weekday are those of get_week() and get_weekday() in calendar_dimension.py,
+    with the weekday numbering of the time table, WEEKDAY_NUMBERING:
+    - hour, day, month and year
+    - week: the ISO 8601 week number, where weeks start on Monday and week 1 is the week
+      containing the first Thursday of the year
+    - weekday: the day of the week, with Monday = 0 and Sunday = 6, like pandas' dt.weekday
+    Returns a dict of arrays keyed by the columns of the time table.
+    """
+    ts = np.asarray(ts, dtype='int64')
+
+    timestamps = ts.astype('datetime64[ms]')
+    days = timestamps.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = days.astype('datetime64[Y]')
+
+    weekday = (days.astype('int64') + EPOCH_WEEKDAY) % 7
+
+    # the ISO week belongs to the year of its Thursday
+    thursdays = days - weekday + 3
+    iso_year_start = thursdays.astype('datetime64[Y]').astype('datetime64[D]')
+    week = (thursdays - iso_year_start).astype('int64') // 7 + 1
+
+    return {
+        'start_time': ts,
+        'hour': (timestamps - days).astype('timedelta64[h]').astype('int64'),
+        'day': (days - months).astype('int64') + 1,
+        'week': week,
+        'month': (months - years).astype('int64') + 1,
+        'year': years.astype('int64') + 1970,
+        'weekday': weekday,
+    }
+
+
+class TimeDimension:
+    """
+    Builds the rows of the time table.
+    - The timestamps are de-duplicated, and the calendar attributes are computed for all of them at once
+    - The start times that have already been loaded are kept in memory for the whole run, so only
+      timestamps that are not in the time table yet are returned
+    """
+
+    def __init__(self):
+        self.loaded = set()
+
+    def refresh(self, cur):
+        """
+        Loads the start times that are already in the time table.
+        """
+        cur.execute(time_key_select)
+        self.loaded = {start_time for start_time, in cur.fetchall()}
+
+    def get_new_rows(self, ts):
+        """
+        Returns the time table rows for the timestamps that have not been loaded yet, and marks
+        them as loaded.
+        """
+        new_keys = [key for key in np.unique(np.asarray(ts, dtype='int64')).tolist() if key not in self.loaded]
+        self.loaded.update(new_keys)
+
+        ts = np.array(new_keys, dtype='int64')
+
+        attributes = get_calendar_attributes(ts)
+        columns = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+        return np.column_stack([attributes[column] for column in columns]).tolist()
@@ -0,0 +1,37 @@
+-- Dashboard queries run against the sparkifydb database, e.g. through the result cache of
+-- query_cache.py.  The weight of a query is the number of times it runs between two loads.
+
+-- Song plays per hour of the day
+-- weight: 20
+SELECT t.hour, COUNT(*) AS plays
+FROM songplays sp
+JOIN time t ON sp.start_time = t.start_time
+GROUP BY t.hour
+ORDER BY t.hour;
+
+-- Most played songs
+-- weight: 10
+SELECT s.title, a.name, COUNT(*) AS plays
+FROM songplays sp
+JOIN songs s ON sp.song_id = s.song_id
+JOIN artists a ON sp.artist_id = a.artist_id
+GROUP BY s.title, a.name
+ORDER BY plays DESC
+LIMIT 10;
+
+-- Song plays of paid and free users, per day of the week
+-- weight: 10
+SELECT t.weekday, sp.level, COUNT(*) AS plays
+FROM songplays sp
+JOIN time t ON sp.start_time = t.start_time
+GROUP BY t.weekday, sp.level
+ORDER BY t.weekday, sp.level;
+
+-- Most active users
+-- weight: 5
+SELECT u.first_name, u.last_name, u.level, COUNT(*) AS plays
+FROM songplays sp
+JOIN users u ON sp.user_id = u.user_id
+GROUP BY u.user_id, u.first_name, u.last_name, u.level
+ORDER BY plays DESC
+LIMIT 10;
@@ -0,0 +1,485 @@
+import os
+import sys
+import csv
+import json
+import zlib
+import random
+import struct
+import argparse
+import configparser
+from datetime import datetime, date, timedelta
+from sql_queries import create_table_queries
+
+# the advisor and manifest modules are shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from table_advisor import parse_create_table, render_create_table, TYPE_WIDTHS, TEXT_TYPES, FLOAT_TYPES
+from staging_manifest import read_json_records, format_epoch_millis
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Redshift stores the values of a column in blocks of 1 MB
+BLOCK_SIZE = 1024 * 1024
+
+# AZ64 packs groups of values as offsets from the smallest value of the group
+AZ64_GROUP_SIZE = 128
+
+INTEGER_TYPES = {'smallint', 'int2', 'int', 'integer', 'int4', 'bigint', 'int8'}
+DECIMAL_TYPES = {'decimal', 'numeric'}
+TIME_TYPES = {'date', 'timestamp', 'timestamptz'}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_candidates(column):
+    """
+    get_candidates - Returns the encodings Redshift supports for the type of a column, in the
+    order of preference when two of them give the same size.
+    """
+    base_type = column['base_type']
+    if base_type in ('boolean', 'bool'):
+        return ['raw', 'runlength', 'zstd']
+    if base_type in FLOAT_TYPES:
+        return ['raw', 'bytedict', 'runlength', 'zstd']
+    if base_type in TEXT_TYPES:
+        return ['raw', 'bytedict', 'runlength', 'lzo', 'zstd']
+
+    candidates = ['raw', 'az64', 'bytedict', 'delta', 'delta32k', 'runlength', 'lzo', 'zstd']
+    if base_type in ('int', 'integer', 'int4', 'bigint', 'int8') or base_type in DECIMAL_TYPES:
+        candidates += ['mostly8', 'mostly16']
+    if base_type in ('bigint', 'int8') or base_type in DECIMAL_TYPES:
+        candidates += ['mostly32']
+    return candidates
+
+
+def get_raw_width(column):
+    """
+    get_raw_width - Returns the bytes of a value of a fixed width column, or None for text.
+    """
+    if column['base_type'] in TEXT_TYPES:
+        return None
+    if column['base_type'] in DECIMAL_TYPES and column['length'] and column['length'] > 18:
+        return 16
+    return TYPE_WIDTHS.get(column['base_type'], 8)
+
+
+def get_scale(column):
+    """
+    get_scale - Returns the number of digits after the decimal point of a DECIMAL column.
+    """
+    parts = column['type'].replace(' ', '').rstrip(')').split(',')
+    return int(parts[1]) if len(parts) == 2 else 0
+
+
+def parse_value(column, value):
+    """
+    parse_value - Converts a sample value (a string, empty for NULL) to the value Redshift stores:
+    integers for the integer, DECIMAL (scaled), DATE (days) and TIMESTAMP (microseconds) columns,
+    floats, booleans, and UTF-8 bytes for text.
+    """
+    if value == '':
+        return None
+    base_type = column['base_type']
+    if base_type in INTEGER_TYPES:
+        return int(float(value))
+    if base_type in DECIMAL_TYPES:
+        return int(round(float(value) * 10 ** get_scale(column)))
+    if base_type == 'date':
+        return date.fromisoformat(value[:10]).toordinal()
+    if base_type in TIME_TYPES:
+        moment = datetime.fromisoformat(value[:26].replace('T', ' ')).replace(tzinfo=None)
+        return (moment - EPOCH) // timedelta(microseconds=1)
+    if base_type in FLOAT_TYPES:
+        return float(value)
+    if base_type in ('boolean', 'bool'):
+        return value.lower() in ('t', 'true', '1')
+    return value.encode('utf8')
+
+
+def get_value_size(column, value):
+    width = get_raw_width(column)
+    if width is not None:
+        return width
+    if column['base_type'] in ('char', 'nchar', 'character', 'bpchar') and column['length']:
+        return column['length']
+    # VARCHAR values are stored with a 4 byte length
+    return len(value) + 4
+
+
+def serialize(column, values):
+    """
+    serialize - Returns the raw bytes of a block of values, as compressed by LZO and ZSTD.
+    """
+    width = get_raw_width(column)
+    if column['base_type'] in TEXT_TYPES:
+        return b''.join(struct.pack('<i', len(value)) + value for value in values)
+    if column['base_type'] in FLOAT_TYPES:
+        return b''.join(struct.pack('<d' if width == 8 else '<f', value) for value in values)
+    if column['base_type'] in ('boolean', 'bool'):
+        return bytes(int(value) for value in values)
+    return b''.join(value.to_bytes(width, 'little', signed=True) for value in values)
+
+
+def split_blocks(column, values):
+    """
+    split_blocks - Splits the values of a column into blocks of BLOCK_SIZE raw bytes.
+    """
+    blocks = [[]]
+    size = 0
+    for value in values:
+        value_size = get_value_size(column, value)
+        if size + value_size > BLOCK_SIZE and blocks[-1]:
+            blocks.append([])
+            size = 0
+        blocks[-1].append(value)
+        size += value_size
+    return blocks
+
+
+def fits(value, bits):
+    return -(1 << (bits - 1)) <= value < (1 << (bits - 1))
+
+
+def estimate_block(column, encoding, values):
+    """
+    estimate_block - Returns the estimated bytes of a block of values with an encoding:
+    - raw: the values as they are
+    - bytedict: a dictionary of the first 256 distinct values of the block, and one byte per
+      value in the dictionary (the other values are stored raw)
+    - delta, delta32k: the difference with the previous value in 1 or 2 bytes, or a flag and the
+      raw value when the difference is larger
+    - mostly8, mostly16, mostly32: the values in 1, 2 or 4 bytes, or raw when they do not fit
+    - runlength: one raw value and a one byte count per run of repeated values
+    - az64: groups of AZ64_GROUP_SIZE values, stored as the raw smallest value of the group and
+      the bit-packed offsets from it (an approximation of the actual AZ64 algorithm)
+    - lzo, zstd: the raw bytes compressed with zlib at level 1 (for LZO), and with zstandard if
+      it is installed, or zlib at level 9 otherwise (for ZSTD)
+    """
+    sizes = [get_value_size(column, value) for value in values]
+
+    if encoding == 'raw':
+        return sum(sizes)
+
+    if encoding == 'bytedict':
+        dictionary = {}
+        size = 0
+        for value, value_size in zip(values, sizes):
+            if value not in dictionary and len(dictionary) < 256:
+                dictionary[value] = value_size
+            size += 1 if value in dictionary else value_size
+        return size + sum(dictionary.values())
+
+    if encoding in ('delta', 'delta32k'):
+        width, bits = (1, 8) if encoding == 'delta' else (2, 16)
+        size = sizes[0]
+        for previous, value, value_size in zip(values, values[1:], sizes[1:]):
+            size += width if fits(value - previous, bits) else width + value_size
+        return size
+
+    if encoding.startswith('mostly'):
+        bits = int(encoding[len('mostly'):])
+        return sum(bits // 8 if fits(value, bits) else value_size for value, value_size in zip(values, sizes))
+
+    if encoding == 'runlength':
+        size = 0
+        previous = object()
+        for value, value_size in zip(values, sizes):
+            if value != previous:
+                size += value_size + 1
+            previous = value
+        return size
+
+    if encoding == 'az64':
+        size = 0
+        for start in range(0, len(values), AZ64_GROUP_SIZE):
+            group = values[start:start + AZ64_GROUP_SIZE]
+            bits = (max(group) - min(group)).bit_length()
+            size += sizes[start] + 1 + (bits * len(group) + 7) // 8
+        return size
+
+    data = serialize(column, values)
+    if encoding == 'lzo':
+        return len(zlib.compress(data, 1))
+    if zstandard is not None:
+        return len(zstandard.ZstdCompressor(level=3).compress(data))
+    return len(zlib.compress(data, 9))
+
+
+def profile_column(column, values):
+    """
+    profile_column - Returns the estimated bytes of the non NULL sample values of a column with
+    each of its candidate encodings.
+    """
+    values = [value for value in values if value is not None]
+    if not values:
+        return {}
+
+    blocks = split_blocks(column, values)
+    return {encoding: sum(estimate_block(column, encoding, block) for block in blocks)
+            for encoding in get_candidates(column)}
+
+
+def read_sample(path, table):
+    """
+    read_sample - Reads the sample rows of a table from a CSV file with a header row, in which
+    NULL is an empty field.  Returns the values of each column, parsed with parse_value.
+    """
+    with open(path, newline='', encoding='utf8') as f:
+        reader = csv.DictReader(f)
+        rows = [{name.lower(): value for name, value in row.items()} for row in reader]
+
+    return {column['name']: [parse_value(column, row.get(column['name'], '')) for row in rows]
+            for column in table['columns']}
+
+
+def sort_sample(table, values):
+    """
+    sort_sample - Sorts the sample rows on the sort key of the table, as they are stored, since
+    the run-length and delta encodings depend on the order of the values.
+    """
+    sortkey = [name for name in table['layout']['sortkey'] if name in values]
+    if not sortkey or not values:
+        return values
+
+    names = list(values)
+    rows = list(zip(*(values[name] for name in names)))
+    positions = [names.index(name) for name in sortkey]
+    # NULLs are stored last
+    rows.sort(key=lambda row: [(row[i] is None, row[i] if row[i] is not None else 0) for i in positions])
+    return {name: [row[i] for row in rows] for i, name in enumerate(names)}
+
+
+def choose_encodings(table, profiles, compress_sortkey=False):
+    """
+    choose_encodings - Returns the encoding of each column: the candidate with the smallest
+    estimated size.  Like ANALYZE COMPRESSION, the leading sort key column is left RAW (unless
+    compress_sortkey is set), so that range-restricted scans skip the same rows in every column.
+    Columns without sample values keep their current encoding.
+    """
+    encodings = {}
+    sortkey = table['layout']['sortkey']
+    for column in table['columns']:
+        sizes = profiles.get(column['name'])
+        if sortkey and column['name'] == sortkey[0] and not compress_sortkey:
+            encodings[column['name']] = 'raw'
+        elif sizes:
+            candidates = get_candidates(column)
+            encodings[column['name']] = min(candidates, key=lambda encoding: (sizes[encoding], candidates.index(encoding)))
+        else:
+            encodings[column['name']] = table['layout']['encodings'][column['name']]
+    return encodings
+
+
+def get_tables():
+    """
+    get_tables - Returns the tables of sql_queries.py, parsed by the table advisor.
+    """
+    tables = [parse_create_table(query) for query in create_table_queries]
+    return {table['name']: table for table in tables}
+
+
+def write_sample(path, table, rows):
+    with open(path, 'w', newline='', encoding='utf8') as f:
+        writer = csv.writer(f)
+        writer.writerow([column['name'] for column in table['columns']])
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+
+
+def write_samples_info(samples, info):
+    with open(os.path.join(samples, 'samples.json'), 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+
+def sample_records(paths, rows, rng):
+    """
+    sample_records - Returns up to rows JSON records of the files, drawn at random (reservoir
+    sampling), and the number of records in the files.
+    """
+    sample = []
+    count = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            for record in read_json_records(f.read()):
+                count += 1
+                if len(sample) < rows:
+                    sample.append(record)
+                else:
+                    i = rng.randrange(count)
+                    if i < rows:
+                        sample[i] = record
+    return sample, count
+
+
+def sample_data(data, samples, rows, seed):
+    """
+    sample_data - Writes samples of the staging tables from local song and log files (e.g. a
+    data set of the benchmark), loaded the way the COPY commands load them: the JSON fields
+    matched to the columns ignoring case, and the log timestamps converted from epoch
+    milliseconds.  No cluster is needed.
+    """
+    tables = get_tables()
+    rng = random.Random(seed)
+    info = {'source': os.path.abspath(data), 'tables': {}}
+
+    sources = [('logs_stage', os.path.join(data, 'log_data'), ['ts']), ('songs_stage', os.path.join(data, 'song_data'), [])]
+    for name, folder, epoch_millis_columns in sources:
+        paths = sorted(os.path.join(root, filename) for root, dirs, files in os.walk(folder)
+                       for filename in files if filename.endswith('.json'))
+        records, count = sample_records(paths, rows, rng)
+
+        table = tables[name]
+        sample = []
+        for record in records:
+            record = {field.lower(): value for field, value in record.items()}
+            row = []
+            for column in table['columns']:
+                value = record.get(column['name'])
+                if value is not None and column['name'] in epoch_millis_columns:
+                    value = format_epoch_millis(value)
+                row.append(value)
+            sample.append(row)
+
+        write_sample(os.path.join(samples, name + '.csv'), table, sample)
+        info['tables'][name] = {'rows': count, 'sampled': len(sample)}
+        print('{}: {} of {} rows sampled from {} files'.format(name, len(sample), count, len(paths)))
+
+    write_samples_info(samples, info)
+
+
+def export_samples(samples, rows):
+    """
+    export_samples - Writes samples of every table of the cluster in dwh.cfg, so that the
+    profiler can then run offline.
+    """
+    import psycopg2
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    cur = conn.cursor()
+
+    info = {'source': config.get('CLUSTER', 'DB_ENDPOINT'), 'tables': {}}
+    for name, table in get_tables().items():
+        columns = ', '.join(column['name'] for column in table['columns'])
+        cur.execute("SELECT COUNT(*) FROM {};".format(name))
+        count = cur.fetchone()[0]
+        cur.execute("SELECT {} FROM {} ORDER BY RANDOM() LIMIT {};".format(columns, name, rows))
+        sample = cur.fetchall()
+
+        write_sample(os.path.join(samples, name + '.csv'), table, sample)
+        info['tables'][name] = {'rows': count, 'sampled': len(sample)}
+        print('{}: {} of {} rows sampled'.format(name, len(sample), count))
+
+    conn.close()
+    write_samples_info(samples, info)
+
+
+def profile_samples(samples, output, report, compress_sortkey=False):
+    """
+    profile_samples - Profiles the samples of the tables, prints the estimated size of each
+    column with its current and its best encoding, and writes the CREATE TABLE statements of
+    sql_queries.py with explicit encodings.  Tables without a sample keep the encodings Redshift
+    gives them by default, written out explicitly.
+    """
+    info_path = os.path.join(samples, 'samples.json')
+    info = {'tables': {}}
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+
+    results = {}
+    statements = []
+    for name, table in get_tables().items():
+        path = os.path.join(samples, name + '.csv')
+        profiles = {}
+        if os.path.exists(path):
+            values = sort_sample(table, read_sample(path, table))
+            profiles = {column['name']: profile_column(column, values[column['name']]) for column in table['columns']}
+
+        encodings = choose_encodings(table, profiles, compress_sortkey)
+        layout = dict(table['layout'], encodings=encodings)
+        statements.append(render_create_table(table, layout))
+
+        if not profiles:
+            continue
+
+        sampled = info['tables'].get(name, {}).get('sampled') or len(next(iter(values.values()), []))
+        scale = info['tables'].get(name, {}).get('rows', sampled) / float(max(sampled, 1))
+        results[name] = {'rows': info['tables'].get(name, {}).get('rows'), 'sampled': sampled, 'columns': {}}
+
+        print('\n{} ({} sampled rows)'.format(name, sampled))
+        row_format = '  {:<18} {:>10} {:>10} {:>10} {:>10}   {}'
+        print(row_format.format('column', 'current', 'best', 'raw MB', 'best MB', 'candidates (MB)'))
+        totals = {'raw': 0.0, 'current': 0.0, 'recommended': 0.0}
+        for column in table['columns']:
+            sizes = {encoding: size * scale / 1e6 for encoding, size in profiles[column['name']].items()}
+            if not sizes:
+                continue
+            current = table['layout']['encodings'][column['name']]
+            chosen = encodings[column['name']]
+            totals['raw'] += sizes['raw']
+            totals['current'] += sizes.get(current, sizes['raw'])
+            totals['recommended'] += sizes[chosen]
+            results[name]['columns'][column['name']] = {'current': current, 'recommended': chosen, 'mb': sizes}
+            candidates = ' '.join('{}={:.2f}'.format(encoding, size) for encoding, size in sorted(sizes.items(), key=lambda item: item[1])[:4])
+            print(row_format.format(column['name'], current, chosen, '{:.2f}'.format(sizes['raw']),
+                                    '{:.2f}'.format(sizes[chosen]), candidates))
+        results[name]['mb'] = totals
+        print('  total: {:.2f} MB raw, {:.2f} MB with the default encodings, {:.2f} MB with the best encodings'.format(
+            totals['raw'], totals['current'], totals['recommended']))
+
+    with open(output, 'w') as f:
+        f.write('-- CREATE TABLE statements of sql_queries.py with the encodings chosen by compression_profiler.py\n\n')
+        f.write('\n\n'.join(statements) + '\n')
+    if report:
+        with open(report, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    print('\nCREATE TABLE statements written to {}'.format(output))
+
+
+def main():
+    """
+    main - Samples the staging data and profiles the compression of the columns:
+    - sample: writes samples of the staging tables from local song and log files (no cluster)
+    - export: writes samples of every table of the cluster
+    - profile: estimates the size of the sampled columns with each encoding, offline, and writes
+      the CREATE TABLE statements with the best encodings (see create_tables.py --ddl)
+    """
+    parser = argparse.ArgumentParser(description='Choose the column encodings of the data warehouse tables from samples.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sample = commands.add_parser('sample', help='sample the staging tables from local song and log files')
+    sample.add_argument('data', help='folder containing song_data and log_data, e.g. ../Benchmark/data/10x')
+    sample.add_argument('--seed', type=int, default=0, help='random seed of the sample (default: 0)')
+
+    export = commands.add_parser('export', help='sample every table of the cluster in dwh.cfg')
+
+    profile = commands.add_parser('profile', help='profile the samples offline and write the CREATE TABLE statements')
+    profile.add_argument('--output', default='encoded_tables.sql',
+                         help='file of CREATE TABLE statements to write (default: encoded_tables.sql)')
+    profile.add_argument('--report', default=None, help='JSON file to write the estimated sizes to')
+    profile.add_argument('--compress-sortkey', action='store_true', help='also compress the leading sort key column')
+
+    for command in (sample, export, profile):
+        command.add_argument('--samples', default='samples', help='folder of the samples (default: samples)')
+    for command in (sample, export):
+        command.add_argument('--rows', type=int, default=20000, help='rows to sample per table (default: 20000)')
+    args = parser.parse_args()
+
+    if args.command == 'profile':
+        profile_samples(args.samples, args.output, args.report, args.compress_sortkey)
+        return
+
+    os.makedirs(args.samples, exist_ok=True)
+    if args.command == 'sample':
+        sample_data(args.data, args.samples, args.rows, args.seed)
+    else:
+        export_samples(args.samples, args.rows)
+
+
+if __name__ == "__main__":
+    main()
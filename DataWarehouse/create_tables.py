@@ -1,13 +1,21 @@
 import configparser
+import argparse
+import os
+import sys
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
 
+# the query cache and rollups modules are shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from query_cache import bump_data_version
+from rollups import rollup_table_create_queries, rollup_table_drop_queries
+
 
 def drop_tables(cur, conn):
     """
     Iterates over all the tables in the database and drops each one.
     """
-    for query in drop_table_queries:
+    for query in drop_table_queries + rollup_table_drop_queries:
         cur.execute(query)
         conn.commit()
 
@@ -16,14 +24,32 @@ def create_tables(cur, conn):
     """
     Iterates over the list of tables to create and creates each one.
     The tables consist of two staging tables (songs_stage and logs_stage), four
-    dimension tables users, songs, artists, time) and a fact table (songplays).
+    dimension tables users, songs, artists, time), a fact table (songplays) and
+    the rollups of the fact table.
     """
-    for query in create_table_queries:
+    for query in create_table_queries + rollup_table_create_queries:
         cur.execute(query)
         conn.commit()
 
 
+def read_ddl(path):
+    """
+    Reads a file of CREATE TABLE statements, e.g. the statements with explicit column encodings
+    written by compression_profiler.py, or the recommended DDL of the table advisor.
+    """
+    with open(path) as f:
+        text = f.read()
+
+    lines = [line for line in text.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() + ';' for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Recreate the tables of the data warehouse.')
+    parser.add_argument('--ddl', default=None,
+                        help='file of CREATE TABLE statements to use instead of those of sql_queries.py, e.g. encoded_tables.sql')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
@@ -34,7 +60,16 @@ def main():
     drop_tables(cur, conn)
     
     # Then create the tables
-    create_tables(cur, conn)
+    if args.ddl:
+        for query in read_ddl(args.ddl) + rollup_table_create_queries:
+            cur.execute(query)
+            conn.commit()
+    else:
+        create_tables(cur, conn)
+
+    # The tables are empty: drop the dashboard results cached before
+    bump_data_version(cur, 'create_tables')
+    conn.commit()
 
     conn.close()
 
@@ -1,72 +1,101 @@
 import configparser
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+from functools import partial
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import staging_events_copy, staging_songs_copy, songs_pending_queries, artists_pending_queries
+from sql_queries import users_pending_queries, publish_queries, calendar_copy, staged_time_range_select, CALENDAR_GRAIN
+from sql_queries import load_watermark_table_create, staging_table_truncate_queries, staging_events_copy_prefix
+from sql_queries import staging_events_copy_manifest, staging_songs_copy_manifest, staging_events_count, staging_songs_count
+from sql_queries import song_lookup_count, song_merge_queries, song_lookup_refresh_queries, log_merge_queries
+from sql_queries import load_watermark_insert, load_watermark_select, user_merge_queries
+from sql_queries import staging_events_copy_manifest_gzip, staging_songs_copy_manifest_gzip, rollup_days_select
 
+# the instrumentation module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrumentation import configure, stage, instrument_cursor, finish
+from staging_manifest import S3Store, build_manifest, write_manifest, get_slice_count
+from query_cache import bump_data_version
+from rollups import refresh_rollups
+from calendar_dimension import load_calendar
+from load_runner import Step, LoadRunner
 
-def load_staging_tables(cur, conn):
+
+def stage_table(cur, conn, table, copy_query, copy_params=None):
     """
-    load_staging_tables - Uses the Redshift COPY command to copy data from S3 buckets into
-    the songs_stage and logs_stage tables.
+    stage_table - Empties a staging table, and uses the Redshift COPY command to copy data from
+    S3 into it, without committing: the table is emptied with DELETE, as TRUNCATE would commit
+    the transaction of the load step.  Returns the number of rows staged.
     """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    cur.execute('DELETE FROM {};'.format(table))
+    with stage('copy staging'):
+        cur.execute(copy_query, copy_params)
+    cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+    return cur.fetchone()[0]
+
+
+def split_s3_url(url):
+    """
+    split_s3_url - Returns the bucket and the key prefix of an S3 URL from dwh.cfg, e.g.
+    ('udacity-dend', 'log_data/') for 's3://udacity-dend/log_data'.
+    """
+    bucket, _, prefix = url.strip("'").replace('s3://', '', 1).partition('/')
+    return bucket, prefix.rstrip('/') + '/'
+
+
+def get_s3_client(config):
+    """
+    get_s3_client - Returns an S3 client with the credentials of dwh.cfg.
+    """
+    import boto3
+
+    return boto3.client('s3', region_name='us-west-2',
+                        aws_access_key_id=config.get('AWS', 'KEY'),
+                        aws_secret_access_key=config.get('AWS', 'SECRET'))
+
+
+def stage_table_manifest(cur, conn, config, table, url, copy_query, gzip_copy_query, compact=False,
+                         target_size=64 * 1024 * 1024):
+    """
+    stage_table_manifest - Manifest-driven version of stage_table.  The objects under the S3 url
+    are listed, and a COPY manifest of them is written to the staging bucket, so that the COPY
+    loads exactly the listed files.  With compact, the objects are first combined into gzip'd
+    files of about target_size bytes, in a multiple of the number of slices of the cluster, so that
+    every slice loads the same amount of data (instead of thousands of tiny song files).
+    """
+    client = get_s3_client(config)
+    staging = S3Store(config.get('S3', 'STAGING_BUCKET'), client)
+    slices = get_slice_count(cur)
+
+    bucket, prefix = split_s3_url(url)
+    with stage('build manifest'):
+        manifest = build_manifest(S3Store(bucket, client), prefix, slices,
+                                  compact_store=staging if compact else None,
+                                  compact_prefix='compacted/{}/'.format(table), target_size=target_size)
+        manifest_url = write_manifest(staging, 'manifests/{}.manifest'.format(table), manifest)
+    print('\t{}: {} files in {} ({} slices)'.format(table, len(manifest['entries']), manifest_url, slices))
+
+    return stage_table(cur, conn, table, gzip_copy_query if manifest['gzip'] else copy_query, (manifest_url,))
 
         
 def insert_users(cur, conn):
     """
     insert_users - Special handling for upserting user information.  Currently, it is just needed
-    for the 'level' field.  Because Redshift does not support upsert, this needs to be done manually.
-    Here ist he procedure:
-    1. Get the latest information for all users from the logs_stage table.  This will give us the
-    most current value for 'level'.  Copy this data into a temporary table: temp_users
-    2. Perform an update of the 'level' field from 'temp_users' into 'users'.
-    3. Perform an insert of users in 'temp_users' into 'users' which do not exist.
+    for the 'level' field.  Because Redshift does not support upsert, this needs to be done manually,
+    in one transaction:
+    1. Get the latest information for all users from the logs_stage table, with a window function
+    ranking each user's song plays by time.  This will give us the most current value for 'level'.
+    Copy this data into a temp table: temp_users (dropped automatically if the session ends).
+    2. Find the level changes in logs_stage, and add them to the user_level_history table (a type 2
+    slowly changing dimension), closing the current period of the users whose level changed.
+    3. Delete the users in 'temp_users' from 'users', and insert them again from 'temp_users'.
     """
     
     try:
-        # Step 1: Copy latest user information into the temp_users table. NOTE: Redshift does not seem
-        # to support TEMP tables, so create a regular table.
-        query = """
-        SELECT
-            LS.userid AS user_id,
-            LS.firstname AS first_name,
-            LS.lastname AS last_name,
-            LS.gender,
-            LS.level
-        INTO TABLE temp_users
-        FROM logs_stage LS
-        WHERE (LS.page = 'NextSong') AND LS.ts = (SELECT MAX(B.ts) FROM logs_stage B WHERE LS.userid = B.userid);
-        """
-        print('\t2.1 Copying latest user information to temp_users')
-        cur.execute(query)
-
-        # Step 2: Perform an update of the 'level' field from 'temp_users' into 'users'.
-        query = """
-        UPDATE users u
-        SET level = tu.level
-        FROM temp_users tu
-        WHERE u.user_id = tu.user_id;
-        """
-        print('\t2.2 Perform an update of the \'level\' field')
-        cur.execute(query)
-
-        # Step 3: Perform an insert of new users from 'temp_users' into 'users'.
-        query = """
-        INSERT INTO users
-        SELECT *
-        FROM temp_users
-        WHERE temp_users.user_id NOT IN (SELECT DISTINCT user_id FROM users);
-        """
-        print('\t2.3 Perform an insert of new users from \'temp_users\' into \'users\'')
-        cur.execute(query)
-
-        # Drop the temp table
-        query = """
-        DROP TABLE IF EXISTS temp_users;
-        """
-        print('\t2.4 Drop the temp table')
-        cur.execute(query)
+        for query in user_merge_queries:
+            cur.execute(query)
 
         conn.commit()
     
@@ -75,33 +104,313 @@ def insert_users(cur, conn):
         raise e
 
         
-def insert_tables(cur, conn):
+def extend_calendar(cur, conn, config):
+    """
+    extend_calendar - Makes sure that the time table covers the days of the staged song plays, and
+    the days from START_DATE to END_DATE of the CALENDAR section of dwh.cfg, if any.  The missing
+    days are generated by calendar_dimension.py and copied from the staging bucket, without
+    committing.  Returns the number of rows added.
+    """
+    cur.execute(staged_time_range_select)
+    first, last = cur.fetchone()
+    start_date = first.date() if first is not None else None
+    end_date = last.date() if last is not None else None
+
+    if config.get('CALENDAR', 'START_DATE', fallback=''):
+        configured = parse_date(config.get('CALENDAR', 'START_DATE'))
+        start_date = configured if start_date is None else min(start_date, configured)
+    if config.get('CALENDAR', 'END_DATE', fallback=''):
+        configured = parse_date(config.get('CALENDAR', 'END_DATE'))
+        end_date = configured if end_date is None else max(end_date, configured)
+
+    if start_date is None or end_date is None:
+        return 0
+
+    staging = S3Store(config.get('S3', 'STAGING_BUCKET'), get_s3_client(config))
+    with stage('load calendar'):
+        return load_calendar(cur, staging, 'calendar/', calendar_copy, start_date, end_date, CALENDAR_GRAIN)
+
+
+def run_queries(cur, conn, queries):
     """
-    insert_tables - Inserts data into the dimension and fact tables.
+    run_queries - Runs the queries of a load step, e.g. to prepare the new rows of a dimension in
+    its pending table.
     """
-    for query in insert_table_queries:
+    for query in queries:
+        cur.execute(query)
+
+
+def publish_tables(cur, conn):
+    """
+    publish_tables - Merges the pending rows of all the dimensions and the staged song plays into
+    the tables, refreshes the rollups, and bumps the data version, in the transaction of the step,
+    so that the reports never see new dimensions without their song plays.
+    """
+    with stage('insert tables'):
+        for query in publish_queries:
+            cur.execute(query)
+
+    with stage('refresh rollups'):
+        days = refresh_rollups(cur, rollup_days_select)
+    print('\t{} days refreshed in the rollups'.format(len(days)))
+
+    # Drop the dashboard results cached before this load
+    bump_data_version(cur, 'dwh_etl')
+
+
+def get_full_load_steps(config, manifest=False, compact=False, target_size=64 * 1024 * 1024):
+    """
+    get_full_load_steps - Returns the steps of a full load, for load_runner.py:
+    1. stage_logs and stage_songs copy the log and song data into the staging tables, at the
+    same time.
+    2. prepare_songs, prepare_artists and prepare_users select the new rows of each dimension into
+    its pending table, and load_calendar adds the days of the song plays missing from the time
+    table, at the same time, as soon as their staging table is loaded.
+    3. publish merges all of them and the song plays in one transaction.
+    """
+    if manifest:
+        stage_logs = partial(stage_table_manifest, config=config, table='logs_stage', url=config.get('S3', 'LOG_DATA'),
+                             copy_query=staging_events_copy_manifest, gzip_copy_query=staging_events_copy_manifest_gzip,
+                             compact=compact, target_size=target_size)
+        stage_songs = partial(stage_table_manifest, config=config, table='songs_stage', url=config.get('S3', 'SONG_DATA'),
+                              copy_query=staging_songs_copy_manifest, gzip_copy_query=staging_songs_copy_manifest_gzip,
+                              compact=compact, target_size=target_size)
+    else:
+        stage_logs = partial(stage_table, table='logs_stage', copy_query=staging_events_copy)
+        stage_songs = partial(stage_table, table='songs_stage', copy_query=staging_songs_copy)
+
+    return [
+        Step('stage_logs', stage_logs),
+        Step('stage_songs', stage_songs),
+        Step('prepare_songs', partial(run_queries, queries=songs_pending_queries), ['stage_songs']),
+        Step('prepare_artists', partial(run_queries, queries=artists_pending_queries), ['stage_songs']),
+        Step('load_calendar', partial(extend_calendar, config=config), ['stage_logs']),
+        Step('prepare_users', partial(run_queries, queries=users_pending_queries), ['stage_logs']),
+        Step('publish', publish_tables, ['prepare_songs', 'prepare_artists', 'load_calendar', 'prepare_users']),
+    ]
+
+
+def get_log_prefixes(log_data, start_date, end_date):
+    """
+    get_log_prefixes - Returns the S3 prefix of the log files of each day from start_date to
+    end_date (inclusive), e.g. s3://udacity-dend/log_data/2018/11/2018-11-05 for 2018-11-05.
+    """
+    prefixes = []
+    day = start_date
+    while day <= end_date:
+        prefixes.append('{}/{:%Y/%m/%Y-%m-%d}'.format(log_data.strip("'").rstrip('/'), day))
+        day += timedelta(days=1)
+    return prefixes
+
+
+def get_load_window(cur, start_date, end_date):
+    """
+    get_load_window - Returns the window of days to load.  Without a start date, the window
+    starts the day after the end of the last window in the load_watermarks table.  Without an
+    end date, only the start date is loaded.
+    """
+    if start_date is None:
+        cur.execute(load_watermark_select)
+        last_end_date = cur.fetchone()[0]
+        if last_end_date is None:
+            raise ValueError('No window has been loaded yet, the start date of the first window must be given')
+        start_date = last_end_date + timedelta(days=1)
+
+    if end_date is None:
+        end_date = start_date
+
+    if end_date < start_date:
+        raise ValueError('The window ends ({}) before it starts ({})'.format(end_date, start_date))
+
+    return start_date, end_date
+
+
+def copy_log_prefix(cur, conn, prefix):
+    """
+    copy_log_prefix - Copies the log files under an S3 prefix into logs_stage.  Days without
+    log files are skipped.  Returns False if there were no files.
+    """
+    try:
+        with stage('copy staging'):
+            cur.execute(staging_events_copy_prefix, (prefix,))
+            conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        # Redshift fails the COPY when no object matches the prefix
+        if 'does not exist' not in str(e):
+            raise e
+        print('\tNo log files under {}'.format(prefix))
+        return False
+
+    return True
+
+
+def load_staging_window(cur, conn, log_prefixes=None, log_manifest=None, song_manifest=None):
+    """
+    load_staging_window - Empties the staging tables, and copies only the new data into them:
+    the log files of each day of the window (or the log files listed in a manifest), and the
+    song files listed in a manifest, if any.
+    Returns the number of log and song rows staged.
+    """
+    for query in staging_table_truncate_queries:
         cur.execute(query)
         conn.commit()
 
+    if log_manifest is not None:
+        with stage('copy staging'):
+            cur.execute(staging_events_copy_manifest, (log_manifest,))
+            conn.commit()
+    for prefix in log_prefixes or []:
+        copy_log_prefix(cur, conn, prefix)
+
+    if song_manifest is not None:
+        with stage('copy staging'):
+            cur.execute(staging_songs_copy_manifest, (song_manifest,))
+            conn.commit()
+
+    cur.execute(staging_events_count)
+    log_rows = cur.fetchone()[0]
+    cur.execute(staging_songs_count)
+    song_rows = cur.fetchone()[0]
+
+    return log_rows, song_rows
+
+
+def merge_tables(cur, conn, config, song_rows, watermark):
+    """
+    merge_tables - Merges the staging tables into the songs, artists and songplays tables,
+    extends the time table, refreshes the rollups, records the load in the load_watermarks
+    table, and bumps the data version, in one transaction.
+    - Each table is merged by deleting the rows whose primary keys are staged, and then
+      inserting the staged rows, so the cost depends on the new data, not on the whole history.
+    - The song lookup is only rebuilt when new songs were staged (or when it is empty).
+    - Only the days of the staged song plays are aggregated again in the rollups.
+    """
+    try:
+        with stage('merge tables'):
+            if song_rows > 0:
+                for query in song_merge_queries:
+                    cur.execute(query)
+
+            cur.execute(song_lookup_count)
+            if song_rows > 0 or cur.fetchone()[0] == 0:
+                for query in song_lookup_refresh_queries:
+                    cur.execute(query)
+
+            for query in log_merge_queries:
+                cur.execute(query)
+
+        extend_calendar(cur, conn, config)
+
+        with stage('refresh rollups'):
+            refresh_rollups(cur, rollup_days_select)
+
+        with stage('merge tables'):
+            cur.execute(load_watermark_insert, watermark)
+
+        # Drop the dashboard results cached before this load, with the merge
+        bump_data_version(cur, 'dwh_etl')
+
+        with stage('commit'):
+            conn.commit()
+
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+
+def load_incremental(cur, conn, config, start_date=None, end_date=None, log_manifest=None, song_manifest=None):
+    """
+    load_incremental - Loads only new data: the log files of a window of days and/or the
+    objects listed in manifests, then merges them into the data warehouse tables.
+    """
+    cur.execute(load_watermark_table_create)
+    conn.commit()
+
+    log_prefixes = []
+    window_start = window_end = None
+    if log_manifest is None or start_date is not None:
+        window_start, window_end = get_load_window(cur, start_date, end_date)
+        log_prefixes = get_log_prefixes(config.get('S3', 'LOG_DATA'), window_start, window_end)
+        print('\tLoading the log files from {} to {}'.format(window_start, window_end))
+
+    print('1. Calling: load_staging_window')
+    log_rows, song_rows = load_staging_window(cur, conn, log_prefixes, log_manifest, song_manifest)
+    print('\t{} log rows and {} song rows staged'.format(log_rows, song_rows))
+
+    print('2. Calling: insert_users')
+    with stage('insert users'):
+        insert_users(cur, conn)
+
+    print('3. Calling: merge_tables')
+    merge_tables(cur, conn, config, song_rows, (window_start, window_end, log_manifest, song_manifest, log_rows, song_rows))
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
 
 def main():
+    """
+    Loads the data warehouse.  By default, all the song and log data is copied into the staging
+    tables and merged into the tables, by the steps of get_full_load_steps, resuming the last run
+    if it failed.  With --incremental, only a window of days of log data (and the objects listed
+    in manifests) is loaded and merged.
+    """
+    parser = argparse.ArgumentParser(description='Load the song and log data into the data warehouse.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='load only the given window of days or manifests, and merge them into the tables')
+    parser.add_argument('--start-date', type=parse_date, default=None,
+                        help='first day of log data to load, YYYY-MM-DD (default: the day after the last window loaded)')
+    parser.add_argument('--end-date', type=parse_date, default=None,
+                        help='last day of log data to load, YYYY-MM-DD (default: the start date)')
+    parser.add_argument('--log-manifest', default=None,
+                        help='S3 path of a COPY manifest listing new log files to load')
+    parser.add_argument('--song-manifest', default=None,
+                        help='S3 path of a COPY manifest listing new song files to load')
+    parser.add_argument('--manifest', action='store_true',
+                        help='list the song and log objects and COPY them through manifests written to STAGING_BUCKET')
+    parser.add_argument('--compact', action='store_true',
+                        help='with --manifest, combine the objects into gzip\'d files balanced over the cluster slices')
+    parser.add_argument('--target-file-size', type=int, default=64,
+                        help='size of the compacted files in MB, before compression (default: 64)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of steps of the full load run at the same time, each on its own connection (default: 4)')
+    parser.add_argument('--restart', action='store_true',
+                        help='start a new full load instead of resuming the last one if it failed')
+    args = parser.parse_args()
+
+    if not args.incremental and (args.start_date or args.end_date or args.log_manifest or args.song_manifest):
+        parser.error('--start-date, --end-date and the manifests are only used with --incremental')
+    if args.incremental and args.manifest:
+        parser.error('--manifest cannot be combined with --incremental, which takes --log-manifest and --song-manifest')
+    if args.compact and not args.manifest:
+        parser.error('--compact is only used with --manifest')
+    if args.incremental and args.restart:
+        parser.error('--restart is only used by the full load')
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    print('1. Calling: load_staging_tables')
-    load_staging_tables(cur, conn)
-    
-    print('2. Calling: insert_users')
-    insert_users(cur, conn)
-    
-    print('3. Calling: insert_tables')
-    insert_tables(cur, conn)
+    # Time the stages and statements of the run if ETL_REPORT is set
+    configure('dwh_etl')
+
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
 
-    conn.close()
+    if args.incremental:
+        conn = psycopg2.connect(dsn)
+        cur = instrument_cursor(conn.cursor())
+        load_incremental(cur, conn, config, args.start_date, args.end_date,
+                         args.log_manifest, args.song_manifest)
+        conn.close()
+        finish()
+        return
 
+    steps = get_full_load_steps(config, args.manifest, args.compact, args.target_file_size * 1024 * 1024)
+    try:
+        LoadRunner(partial(psycopg2.connect, dsn), steps, workers=args.workers, restart=args.restart).run()
+    finally:
+        finish()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+Transactional, resumable runner for the loads of the data warehouse.
+
+A load is a small DAG of steps (see get_full_load_steps in etl.py):
+- Each step runs in one transaction, on a connection of its own, and its checkpoint is
+  written to the load_checkpoints table in the same transaction: a step is either done and
+  checkpointed, or rolled back as if it had not run.
+- The steps whose dependencies are done run concurrently, up to a number of workers, e.g.
+  the COPY of the song data and of the log data.
+- When a step fails, the steps already running are finished, no other step is started, and
+  the failure is recorded.  The next run resumes the failed run: the steps checkpointed are
+  skipped, so the data already staged is not copied again.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from sql_queries import load_checkpoint_table_create, load_checkpoint_insert, load_checkpoint_last_run_select
+from sql_queries import load_checkpoint_done_select
+
+# the instrumentation module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrumentation import stage, instrument_cursor
+
+
+class Step:
+    """
+    A step of a load:
+    - name: name of the step, recorded in its checkpoint
+    - func: function called with a cursor and its connection, which must not commit (the
+      runner commits the step with its checkpoint).  It can return a number of rows.
+    - depends_on: names of the steps that must be done before it starts
+    """
+
+    def __init__(self, name, func, depends_on=()):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+
+
+class LoadRunner:
+    """
+    Runs the steps of a load in the order of their dependencies, with checkpoints.
+    """
+
+    def __init__(self, connect, steps, workers=4, restart=False):
+        """
+        - connect: function returning a new database connection
+        - workers: number of steps run at the same time, each on its own connection
+        - restart: start a new run even if the last one did not finish
+        """
+        self.connect = connect
+        self.steps = steps
+        self.workers = workers
+        self.restart = restart
+
+        names = set(step.name for step in steps)
+        for step in steps:
+            unknown = set(step.depends_on) - names
+            if unknown:
+                raise ValueError('Step {} depends on unknown steps: {}'.format(step.name, ', '.join(sorted(unknown))))
+
+    def get_run(self):
+        """
+        Returns the id of the run and the steps it has already done: those of the last run if
+        it did not finish, or none for a new run.
+        """
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute(load_checkpoint_table_create)
+        conn.commit()
+
+        cur.execute(load_checkpoint_last_run_select)
+        row = cur.fetchone()
+        done = set()
+        if row is not None and not self.restart:
+            cur.execute(load_checkpoint_done_select, (row[0],))
+            done = set(step for step, in cur.fetchall())
+        conn.close()
+
+        if row is None or self.restart or done >= set(step.name for step in self.steps):
+            return datetime.utcnow().strftime('%Y%m%dT%H%M%S'), set()
+        return row[0], done
+
+    def run_step(self, run_id, step):
+        """
+        Runs a step in one transaction with its checkpoint.  On failure, the transaction is
+        rolled back, and the failure is recorded in a transaction of its own.
+        """
+        conn = self.connect()
+        cur = instrument_cursor(conn.cursor())
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        print('\tStarting {}'.format(step.name))
+
+        try:
+            with stage(step.name):
+                rows = step.func(cur, conn)
+                cur.execute(load_checkpoint_insert, (run_id, step.name, 'done', rows, started_at, datetime.utcnow(), None))
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            try:
+                cur.execute(load_checkpoint_insert, (run_id, step.name, 'failed', None, started_at, datetime.utcnow(), str(e)[:1024]))
+                conn.commit()
+            except Exception:
+                # e.g. the connection was lost: the failure is still raised, only not recorded
+                conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        print('\tDone {} in {:.1f}s{}'.format(step.name, time.perf_counter() - started,
+                                              '' if rows is None else ' ({} rows)'.format(rows)))
+
+    def run(self):
+        """
+        Runs the steps that are not done yet.  Returns the id of the run; raises the error of
+        the first step that failed.
+        """
+        run_id, done = self.get_run()
+        if done:
+            print('Resuming run {}: {} already done'.format(run_id, ', '.join(sorted(done))))
+        else:
+            print('Starting run {}'.format(run_id))
+
+        pending = [step for step in self.steps if step.name not in done]
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                if error is None:
+                    for step in list(pending):
+                        if len(running) < self.workers and all(name in done for name in step.depends_on):
+                            running[executor.submit(self.run_step, run_id, step)] = step
+                            pending.remove(step)
+
+                if not running:
+                    if error is None:
+                        raise ValueError('The steps {} depend on each other'.format(', '.join(step.name for step in pending)))
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(step.name)
+                    except Exception as e:
+                        print('\tFailed {}: {}'.format(step.name, e))
+                        error = error or e
+
+        if error is not None:
+            raise error
+        return run_id
@@ -1,19 +1,33 @@
 import configparser
+import os
+import sys
 
+# the calendar dimension module is shared by the projects of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from calendar_dimension import get_time_key_sql
 
 # CONFIG
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
+# Period of a row of the time table (see calendar_dimension.py): day, hour, minute or second
+CALENDAR_GRAIN = config.get('CALENDAR', 'GRAIN', fallback='hour')
+
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS logs_stage;"
 staging_songs_table_drop = "DROP TABLE IF EXISTS songs_stage;"
+song_lookup_table_drop = "DROP TABLE IF EXISTS song_lookup_stage;"
+load_watermark_table_drop = "DROP TABLE IF EXISTS load_watermarks;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays;"
 user_table_drop = "DROP TABLE IF EXISTS users;"
+user_level_history_table_drop = "DROP TABLE IF EXISTS user_level_history;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_checkpoint_table_drop = "DROP TABLE IF EXISTS load_checkpoints;"
+pending_table_drops = ["DROP TABLE IF EXISTS songs_pending;", "DROP TABLE IF EXISTS artists_pending;",
+                       "DROP TABLE IF EXISTS users_pending;", "DROP TABLE IF EXISTS user_level_changes_pending;"]
 
 # CREATE TABLES
 
@@ -52,10 +66,35 @@ CREATE TABLE IF NOT EXISTS songs_stage (
     artist_location VARCHAR
 );""")
 
+# Pre-joined song/artist lookup used to resolve the song_id and artist_id of the song plays.
+# It is distributed and sorted on the join keys, and refreshed before each songplays load.
+song_lookup_table_create = ("""
+CREATE TABLE IF NOT EXISTS song_lookup_stage (
+    title VARCHAR NOT NULL DISTKEY,
+    artist_name VARCHAR NOT NULL,
+    duration DECIMAL(10,5),
+    song_id VARCHAR NOT NULL,
+    artist_id VARCHAR NOT NULL
+)
+SORTKEY (title, artist_name, duration);""")
+
+# One row per incremental load: the window of log days (or the manifests) that were loaded
+load_watermark_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_watermarks (
+    window_start DATE,
+    window_end DATE,
+    log_manifest VARCHAR,
+    song_manifest VARCHAR,
+    log_rows BIGINT NOT NULL,
+    song_rows BIGINT NOT NULL,
+    loaded_at TIMESTAMP NOT NULL
+);""")
+
 songplay_table_create = ("""
 CREATE TABLE IF NOT EXISTS songplays (
     songplay_id INT IDENTITY (0,1) PRIMARY KEY,
     start_time TIMESTAMP NOT NULL SORTKEY,
+    time_key INT NOT NULL,
     user_id INT NOT NULL,
     level VARCHAR NOT NULL,
     song_id VARCHAR,
@@ -74,6 +113,17 @@ CREATE TABLE IF NOT EXISTS users (
     level VARCHAR NOT NULL
 ) DISTSTYLE AUTO;""")
 
+# Type 2 slowly changing dimension of the user level: one row per period during which a
+# user had a level.  valid_to is NULL for the current period.
+user_level_history_table_create = ("""
+CREATE TABLE IF NOT EXISTS user_level_history (
+    user_id INT NOT NULL,
+    level VARCHAR NOT NULL,
+    valid_from TIMESTAMP NOT NULL,
+    valid_to TIMESTAMP
+) DISTSTYLE AUTO
+SORTKEY (user_id, valid_from);""")
+
 song_table_create = ("""
 CREATE TABLE IF NOT EXISTS songs (
     song_id VARCHAR PRIMARY KEY,
@@ -92,17 +142,72 @@ CREATE TABLE IF NOT EXISTS artists (
     longitude DECIMAL(6,3)
 ) DISTSTYLE ALL;""")
 
+# Calendar generated by calendar_dimension.py, one row per period of CALENDAR_GRAIN.  time_key is
+# the number of periods since 1970-01-01, and start_time the start of the period.
 time_table_create = ("""
 CREATE TABLE IF NOT EXISTS time (
-    start_time TIMESTAMP PRIMARY KEY,
+    time_key INT PRIMARY KEY,
+    start_time TIMESTAMP NOT NULL,
+    date DATE NOT NULL,
     hour SMALLINT NOT NULL,
     day SMALLINT NOT NULL,
     week SMALLINT NOT NULL,
     month SMALLINT NOT NULL,
+    quarter SMALLINT NOT NULL,
     year SMALLINT NOT NULL,
-    weekday SMALLINT NOT NULL
+    weekday SMALLINT NOT NULL,
+    is_weekend BOOLEAN NOT NULL
+) DISTSTYLE ALL
+SORTKEY (time_key);""")
+
+# One row per step of a full load run by load_runner.py, done or failed
+load_checkpoint_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_checkpoints (
+    run_id VARCHAR NOT NULL,
+    step VARCHAR NOT NULL,
+    status VARCHAR NOT NULL,
+    rows BIGINT,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL,
+    error VARCHAR(1024)
 );""")
 
+# New rows of the dimensions, prepared by the full load before they are all merged together
+# with the song plays.  They have the columns and the keys of their dimensions, spelled out so
+# that the table advisor and the compression profiler can parse them.
+pending_table_creates = [
+    ("""
+CREATE TABLE IF NOT EXISTS songs_pending (
+    song_id VARCHAR PRIMARY KEY,
+    title VARCHAR NOT NULL,
+    artist_id VARCHAR NOT NULL,
+    year SMALLINT,
+    duration DECIMAL(10,5)
+) DISTSTYLE ALL;"""),
+    ("""
+CREATE TABLE IF NOT EXISTS artists_pending (
+    artist_id VARCHAR PRIMARY KEY,
+    name VARCHAR NOT NULL,
+    location VARCHAR,
+    latitude DECIMAL(6,3),
+    longitude DECIMAL(6,3)
+) DISTSTYLE ALL;"""),
+    ("""
+CREATE TABLE IF NOT EXISTS users_pending (
+    user_id INT PRIMARY KEY,
+    first_name VARCHAR NOT NULL,
+    last_name VARCHAR NOT NULL,
+    gender CHAR(1),
+    level VARCHAR NOT NULL
+) DISTSTYLE AUTO;"""),
+    ("""
+CREATE TABLE IF NOT EXISTS user_level_changes_pending (
+    user_id INT NOT NULL,
+    level VARCHAR NOT NULL,
+    valid_from TIMESTAMP NOT NULL
+) DISTSTYLE AUTO;"""),
+]
+
 # STAGING TABLES
 
 staging_events_copy = """COPY logs_stage
@@ -120,29 +225,186 @@ COMPUPDATE OFF
 REGION 'us-west-2'
 JSON 'auto ignorecase';""".format(config.get('S3','SONG_DATA'), config.get('IAM_ROLE','ARN'))
 
+# Incremental loads: the S3 location is passed as a query parameter, either the prefix of the
+# log files of one day, or a manifest listing the new objects.
+
+staging_events_copy_prefix = """COPY logs_stage
+FROM %s
+CREDENTIALS 'aws_iam_role={}'
+COMPUPDATE OFF
+REGION 'us-west-2'
+JSON {}
+TIMEFORMAT 'epochmillisecs';""".format(config.get('IAM_ROLE','ARN'), config.get('S3','LOG_JSONPATH'))
+
+staging_events_copy_manifest = """COPY logs_stage
+FROM %s
+CREDENTIALS 'aws_iam_role={}'
+COMPUPDATE OFF
+REGION 'us-west-2'
+JSON {}
+TIMEFORMAT 'epochmillisecs'
+MANIFEST;""".format(config.get('IAM_ROLE','ARN'), config.get('S3','LOG_JSONPATH'))
+
+staging_songs_copy_manifest = """COPY songs_stage
+FROM %s
+CREDENTIALS 'aws_iam_role={}'
+COMPUPDATE OFF
+REGION 'us-west-2'
+JSON 'auto ignorecase'
+MANIFEST;""".format(config.get('IAM_ROLE','ARN'))
+
+# Calendar rows generated by calendar_dimension.py, as a gzip'd CSV file of the staging bucket
+calendar_copy = """COPY time
+FROM %s
+CREDENTIALS 'aws_iam_role={}'
+COMPUPDATE OFF
+REGION 'us-west-2'
+CSV
+GZIP
+TIMEFORMAT 'YYYY-MM-DD HH:MI:SS';""".format(config.get('IAM_ROLE','ARN'))
+
+# Manifests of compacted, gzip'd files (see staging_manifest.py)
+staging_events_copy_manifest_gzip = staging_events_copy_manifest.replace('MANIFEST;', 'MANIFEST\nGZIP;')
+staging_songs_copy_manifest_gzip = staging_songs_copy_manifest.replace('MANIFEST;', 'MANIFEST\nGZIP;')
+
+staging_table_truncate_queries = ["TRUNCATE logs_stage;", "TRUNCATE songs_stage;"]
+
+staging_events_count = "SELECT COUNT(*) FROM logs_stage;"
+staging_songs_count = "SELECT COUNT(*) FROM songs_stage;"
+song_lookup_count = "SELECT COUNT(*) FROM song_lookup_stage;"
+
 # FINAL TABLES
 
+# One row per (title, artist name, duration).  Should several songs share all three, the
+# lowest song_id is kept, so that the songplays join below matches at most one row.
+song_lookup_table_insert = ("""
+INSERT INTO song_lookup_stage (title, artist_name, duration, song_id, artist_id)
+SELECT
+    title,
+    artist_name,
+    duration,
+    song_id,
+    artist_id
+FROM (
+    SELECT
+        songs.title,
+        artists.name AS artist_name,
+        songs.duration,
+        songs.song_id,
+        songs.artist_id,
+        ROW_NUMBER() OVER (PARTITION BY songs.title, artists.name, songs.duration ORDER BY songs.song_id) AS duplicate_rank
+    FROM songs
+    JOIN artists ON songs.artist_id = artists.artist_id
+) AS candidates
+WHERE duplicate_rank = 1;""")
+
 songplay_table_insert = ("""
-INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+INSERT INTO songplays (start_time, time_key, user_id, level, song_id, artist_id, session_id, location, user_agent)
 SELECT
     LS.ts AS start_time,
+    {} AS time_key,
     LS.userid AS user_id,
     LS.level,
-    (SELECT songs.song_id FROM songs JOIN artists ON songs.artist_id = artists.artist_id WHERE (songs.title = LS.song) AND (artists.name = LS.artist) AND (songs.duration = LS.length)) AS song_id,
-    (SELECT artists.artist_id FROM songs JOIN artists ON songs.artist_id = artists.artist_id WHERE (songs.title = LS.song) AND (artists.name = LS.artist) AND (songs.duration = LS.length)) AS artist_id,
+    SL.song_id,
+    SL.artist_id,
     LS.sessionId AS session_id,
     LS.location,
     LS.useragent AS user_agent
 FROM logs_stage LS
-WHERE (LS.page = 'NextSong');""")
+LEFT JOIN song_lookup_stage SL ON (SL.title = LS.song) AND (SL.artist_name = LS.artist) AND (SL.duration = LS.length)
+WHERE (LS.page = 'NextSong');""").format(get_time_key_sql('LS.ts', CALENDAR_GRAIN))
 
 #
 # NOTE: Special handling of the user table
 #
-#user_table_insert = ("""
-#""")
+# The users are merged in one transaction (see insert_users in etl.py):
+# 1. The latest information of each user in logs_stage is selected into a temp table
+# 2. The level changes in logs_stage are selected into a second temp table, and added to
+#    the user level history
+# 3. The staged users are deleted from the users table, and inserted again from temp_users
+
+user_temp_table_create = ("""
+SELECT
+    user_id,
+    first_name,
+    last_name,
+    gender,
+    level
+INTO TEMP TABLE temp_users
+FROM (
+    SELECT
+        userid AS user_id,
+        firstname AS first_name,
+        lastname AS last_name,
+        gender,
+        level,
+        ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC, sessionid DESC, iteminsession DESC) AS recency
+    FROM logs_stage
+    WHERE (page = 'NextSong') AND (userid IS NOT NULL)
+) AS latest
+WHERE recency = 1;""")
+
+# A level change is a song play whose level differs from the user's previous song play,
+# or from the current level in the history for the first song play staged.  Song plays
+# older than the start of the current period have already been taken into account.
+user_level_changes_temp_table_create = ("""
+SELECT
+    user_id,
+    level,
+    valid_from
+INTO TEMP TABLE temp_user_level_changes
+FROM (
+    SELECT
+        LS.userid AS user_id,
+        LS.level,
+        LS.ts AS valid_from,
+        COALESCE(LAG(LS.level) OVER (PARTITION BY LS.userid ORDER BY LS.ts, LS.sessionid, LS.iteminsession), H.level) AS previous_level
+    FROM logs_stage LS
+    LEFT JOIN user_level_history H ON (H.user_id = LS.userid) AND (H.valid_to IS NULL)
+    WHERE (LS.page = 'NextSong') AND (LS.userid IS NOT NULL) AND ((H.valid_from IS NULL) OR (LS.ts > H.valid_from))
+) AS plays
+WHERE (previous_level IS NULL) OR (previous_level <> level);""")
+
+user_level_history_close = ("""
+UPDATE user_level_history
+SET valid_to = changes.first_change
+FROM (SELECT user_id, MIN(valid_from) AS first_change FROM temp_user_level_changes GROUP BY user_id) AS changes
+WHERE (user_level_history.user_id = changes.user_id) AND (user_level_history.valid_to IS NULL);""")
+
+user_level_history_insert = ("""
+INSERT INTO user_level_history (user_id, level, valid_from, valid_to)
+SELECT
+    user_id,
+    level,
+    valid_from,
+    LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from) AS valid_to
+FROM temp_user_level_changes;""")
+
+user_table_merge_delete = ("""
+DELETE FROM users
+USING temp_users
+WHERE users.user_id = temp_users.user_id;""")
+
+user_table_merge_insert = ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level
+FROM temp_users;""")
+
+user_temp_tables_drop = ("""
+DROP TABLE IF EXISTS temp_users, temp_user_level_changes;""")
+
+# INCREMENTAL MERGES
+#
+# Each table is merged from the staging tables by deleting the rows whose keys are staged,
+# and then inserting the staged rows, so that loading the same data again has no effect.
+# The merges only touch the keys in the staging tables, not the whole history.
+
+song_table_merge_delete = ("""
+DELETE FROM songs
+USING songs_stage
+WHERE songs.song_id = songs_stage.song_id;""")
 
-song_table_insert = ("""
+song_table_merge_insert = ("""
 INSERT INTO songs (song_id, title, artist_id, year, duration)
 SELECT
     song_id,
@@ -150,36 +412,230 @@ SELECT
     artist_id,
     year,
     duration
-FROM songs_stage
-WHERE song_id NOT IN (SELECT DISTINCT song_id FROM songs);""")
+FROM (
+    SELECT
+        song_id,
+        title,
+        artist_id,
+        year,
+        duration,
+        ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title, artist_id, duration) AS duplicate_rank
+    FROM songs_stage
+) AS staged
+WHERE duplicate_rank = 1;""")
 
-artist_table_insert = ("""
+artist_table_merge_delete = ("""
+DELETE FROM artists
+USING songs_stage
+WHERE artists.artist_id = songs_stage.artist_id;""")
+
+artist_table_merge_insert = ("""
 INSERT INTO artists (artist_id, name, location, latitude, longitude)
 SELECT
-    DISTINCT artist_id,
-    artist_name as name,
-    artist_location AS location,
-    artist_latitude AS latitude,
-    artist_longitude AS longitude
-FROM songs_stage
-WHERE artist_id NOT IN (SELECT DISTINCT artist_id FROM artists);""")
-
-time_table_insert = ("""
-INSERT INTO time
+    artist_id,
+    name,
+    location,
+    latitude,
+    longitude
+FROM (
+    SELECT
+        artist_id,
+        artist_name AS name,
+        artist_location AS location,
+        artist_latitude AS latitude,
+        artist_longitude AS longitude,
+        ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name, artist_location, artist_latitude, artist_longitude) AS duplicate_rank
+    FROM songs_stage
+) AS staged
+WHERE duplicate_rank = 1;""")
+
+# TRUNCATE would commit the merge transaction, so the lookup is emptied with DELETE
+song_lookup_table_delete = ("""
+DELETE FROM song_lookup_stage;""")
+
+# A song play is identified by its start time, user and session
+songplay_table_merge_delete = ("""
+DELETE FROM songplays
+USING logs_stage
+WHERE (songplays.start_time = logs_stage.ts) AND (songplays.user_id = logs_stage.userid)
+    AND (songplays.session_id = logs_stage.sessionid) AND (logs_stage.page = 'NextSong');""")
+
+load_watermark_insert = ("""
+INSERT INTO load_watermarks (window_start, window_end, log_manifest, song_manifest, log_rows, song_rows, loaded_at)
+VALUES (%s, %s, %s, %s, %s, %s, GETDATE());""")
+
+load_watermark_select = ("""
+SELECT MAX(window_end) FROM load_watermarks;""")
+
+# Days of the staged song plays, whose partitions of the rollups are refreshed after each load
+rollup_days_select = ("""
+SELECT DISTINCT TRUNC(ts) FROM logs_stage WHERE page = 'NextSong';""")
+
+# Times of the staged song plays, which the calendar must cover
+staged_time_range_select = ("""
+SELECT MIN(ts), MAX(ts) FROM logs_stage WHERE page = 'NextSong';""")
+
+# FULL LOAD STEPS
+#
+# The full load (see get_full_load_steps in etl.py) runs as steps of load_runner.py, each in
+# one transaction: the staging tables are emptied with DELETE, as TRUNCATE would commit.  The
+# new rows of each dimension are prepared concurrently in the pending tables, and then the
+# dimensions and the song plays are merged in a single transaction, so that a failure never
+# leaves a dimension loaded without the others.
+
+load_checkpoint_insert = ("""
+INSERT INTO load_checkpoints (run_id, step, status, rows, started_at, finished_at, error)
+VALUES (%s, %s, %s, %s, %s, %s, %s);""")
+
+# The last run, done or not
+load_checkpoint_last_run_select = ("""
+SELECT run_id FROM load_checkpoints ORDER BY started_at DESC LIMIT 1;""")
+
+load_checkpoint_done_select = ("""
+SELECT DISTINCT step FROM load_checkpoints WHERE (run_id = %s) AND (status = 'done');""")
+
+song_pending_table_insert = ("""
+INSERT INTO songs_pending (song_id, title, artist_id, year, duration)
+SELECT
+    song_id,
+    title,
+    artist_id,
+    year,
+    duration
+FROM (
+    SELECT
+        song_id,
+        title,
+        artist_id,
+        year,
+        duration,
+        ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title, artist_id, duration) AS duplicate_rank
+    FROM songs_stage
+) AS staged
+WHERE duplicate_rank = 1;""")
+
+artist_pending_table_insert = ("""
+INSERT INTO artists_pending (artist_id, name, location, latitude, longitude)
+SELECT
+    artist_id,
+    name,
+    location,
+    latitude,
+    longitude
+FROM (
+    SELECT
+        artist_id,
+        artist_name AS name,
+        artist_location AS location,
+        artist_latitude AS latitude,
+        artist_longitude AS longitude,
+        ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name, artist_location, artist_latitude, artist_longitude) AS duplicate_rank
+    FROM songs_stage
+) AS staged
+WHERE duplicate_rank = 1;""")
+
+# Same as user_temp_table_create and user_level_changes_temp_table_create, into the pending tables
+user_pending_table_insert = ("""
+INSERT INTO users_pending (user_id, first_name, last_name, gender, level)
+SELECT
+    user_id,
+    first_name,
+    last_name,
+    gender,
+    level
+FROM (
+    SELECT
+        userid AS user_id,
+        firstname AS first_name,
+        lastname AS last_name,
+        gender,
+        level,
+        ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC, sessionid DESC, iteminsession DESC) AS recency
+    FROM logs_stage
+    WHERE (page = 'NextSong') AND (userid IS NOT NULL)
+) AS latest
+WHERE recency = 1;""")
+
+user_level_changes_pending_table_insert = ("""
+INSERT INTO user_level_changes_pending (user_id, level, valid_from)
 SELECT
-    DISTINCT ts AS start_time,
-    EXTRACT(hour FROM ts) AS hour,
-    EXTRACT(day FROM ts) AS day,
-    EXTRACT(week FROM ts) AS week,
-    EXTRACT(month FROM ts) AS month,
-    EXTRACT(year FROM ts) AS year,
-    EXTRACT(dow FROM ts) AS weekday
-FROM logs_stage
-WHERE (page = 'NextSong') AND (ts NOT IN (SELECT DISTINCT start_time FROM time));""")
+    user_id,
+    level,
+    valid_from
+FROM (
+    SELECT
+        LS.userid AS user_id,
+        LS.level,
+        LS.ts AS valid_from,
+        COALESCE(LAG(LS.level) OVER (PARTITION BY LS.userid ORDER BY LS.ts, LS.sessionid, LS.iteminsession), H.level) AS previous_level
+    FROM logs_stage LS
+    LEFT JOIN user_level_history H ON (H.user_id = LS.userid) AND (H.valid_to IS NULL)
+    WHERE (LS.page = 'NextSong') AND (LS.userid IS NOT NULL) AND ((H.valid_from IS NULL) OR (LS.ts > H.valid_from))
+) AS plays
+WHERE (previous_level IS NULL) OR (previous_level <> level);""")
+
+song_table_publish_delete = ("""
+DELETE FROM songs
+USING songs_pending
+WHERE songs.song_id = songs_pending.song_id;""")
+
+song_table_publish_insert = ("""
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+SELECT song_id, title, artist_id, year, duration
+FROM songs_pending;""")
+
+artist_table_publish_delete = ("""
+DELETE FROM artists
+USING artists_pending
+WHERE artists.artist_id = artists_pending.artist_id;""")
+
+artist_table_publish_insert = ("""
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+SELECT artist_id, name, location, latitude, longitude
+FROM artists_pending;""")
+
+user_level_history_publish_close = ("""
+UPDATE user_level_history
+SET valid_to = changes.first_change
+FROM (SELECT user_id, MIN(valid_from) AS first_change FROM user_level_changes_pending GROUP BY user_id) AS changes
+WHERE (user_level_history.user_id = changes.user_id) AND (user_level_history.valid_to IS NULL);""")
+
+user_level_history_publish_insert = ("""
+INSERT INTO user_level_history (user_id, level, valid_from, valid_to)
+SELECT
+    user_id,
+    level,
+    valid_from,
+    LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from) AS valid_to
+FROM user_level_changes_pending;""")
+
+user_table_publish_delete = ("""
+DELETE FROM users
+USING users_pending
+WHERE users.user_id = users_pending.user_id;""")
+
+user_table_publish_insert = ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level
+FROM users_pending;""")
+
+songs_pending_queries = ["DELETE FROM songs_pending;", song_pending_table_insert]
+artists_pending_queries = ["DELETE FROM artists_pending;", artist_pending_table_insert]
+users_pending_queries = ["DELETE FROM users_pending;", "DELETE FROM user_level_changes_pending;",
+                         user_pending_table_insert, user_level_changes_pending_table_insert]
+
+# Merged in one transaction, with the refresh of the rollups
+publish_queries = [song_table_publish_delete, song_table_publish_insert, artist_table_publish_delete,
+                   artist_table_publish_insert, user_level_history_publish_close, user_level_history_publish_insert,
+                   user_table_publish_delete, user_table_publish_insert, song_lookup_table_delete,
+                   song_lookup_table_insert, songplay_table_merge_delete, songplay_table_insert]
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, song_lookup_table_create, load_watermark_table_create, songplay_table_create, user_table_create, user_level_history_table_create, song_table_create, artist_table_create, time_table_create, load_checkpoint_table_create] + pending_table_creates
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, song_lookup_table_drop, load_watermark_table_drop, songplay_table_drop, user_table_drop, user_level_history_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_checkpoint_table_drop] + pending_table_drops
+song_merge_queries = [song_table_merge_delete, song_table_merge_insert, artist_table_merge_delete, artist_table_merge_insert]
+song_lookup_refresh_queries = [song_lookup_table_delete, song_lookup_table_insert]
+log_merge_queries = [songplay_table_merge_delete, songplay_table_insert]
+user_merge_queries = [user_temp_table_create, user_level_changes_temp_table_create, user_level_history_close,
+                      user_level_history_insert, user_table_merge_delete, user_table_merge_insert, user_temp_tables_drop]
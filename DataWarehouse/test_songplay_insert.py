@@ -0,0 +1,218 @@
+"""
+Regression test of the songplays insert: the single join against song_lookup_stage must load
+the same song plays, row for row, as the correlated subqueries it replaced.
+
+Redshift is not needed: the statements of sql_queries.py run on a local PostgreSQL database,
+given by the SONGPLAY_TEST_DSN environment variable, e.g.
+
+    SONGPLAY_TEST_DSN='host=localhost dbname=postgres user=postgres' python3 -m pytest test_songplay_insert.py
+
+The tables are created as temporary tables, with the PostgreSQL types of their Redshift columns,
+so nothing is left in the database.  These tests are skipped without a database; the statements
+themselves are checked without one.
+"""
+import os
+import random
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+# sql_queries.py is in the folder of the test, and the calendar dimension module is shared by the
+# projects of the repository
+folder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, folder)
+sys.path.append(os.path.join(folder, os.pardir))
+from calendar_dimension import GRAINS, get_time_key, get_time_key_sql
+
+# sql_queries.py reads dwh.cfg from the current folder
+cwd = os.getcwd()
+os.chdir(folder)
+try:
+    from sql_queries import song_lookup_table_delete, song_lookup_table_insert, songplay_table_insert, CALENDAR_GRAIN
+finally:
+    os.chdir(cwd)
+
+
+# The songplays insert before the song lookup table, with one correlated subquery per key
+old_songplay_table_insert = ("""
+INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT
+    LS.ts AS start_time,
+    LS.userid AS user_id,
+    LS.level,
+    (SELECT songs.song_id FROM songs JOIN artists ON songs.artist_id = artists.artist_id WHERE (songs.title = LS.song) AND (artists.name = LS.artist) AND (songs.duration = LS.length)) AS song_id,
+    (SELECT artists.artist_id FROM songs JOIN artists ON songs.artist_id = artists.artist_id WHERE (songs.title = LS.song) AND (artists.name = LS.artist) AND (songs.duration = LS.length)) AS artist_id,
+    LS.sessionId AS session_id,
+    LS.location,
+    LS.useragent AS user_agent
+FROM logs_stage LS
+WHERE (LS.page = 'NextSong');""")
+
+# The tables read and written by the inserts, without the Redshift distribution and sort keys
+temp_table_creates = [
+    """CREATE TEMP TABLE logs_stage (artist VARCHAR, auth VARCHAR NOT NULL, firstname VARCHAR, gender CHAR(1),
+        iteminsession SMALLINT NOT NULL, lastname VARCHAR, length DECIMAL(10,5), level VARCHAR NOT NULL,
+        location VARCHAR, method VARCHAR NOT NULL, page VARCHAR NOT NULL, registration DECIMAL,
+        sessionid INT NOT NULL, song VARCHAR, status SMALLINT NOT NULL, ts TIMESTAMP NOT NULL,
+        useragent VARCHAR, userid INT);""",
+    """CREATE TEMP TABLE songs (song_id VARCHAR PRIMARY KEY, title VARCHAR NOT NULL, artist_id VARCHAR NOT NULL,
+        year SMALLINT, duration DECIMAL(10,5));""",
+    """CREATE TEMP TABLE artists (artist_id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, location VARCHAR,
+        latitude DECIMAL(6,3), longitude DECIMAL(6,3));""",
+    """CREATE TEMP TABLE song_lookup_stage (title VARCHAR NOT NULL, artist_name VARCHAR NOT NULL,
+        duration DECIMAL(10,5), song_id VARCHAR NOT NULL, artist_id VARCHAR NOT NULL);""",
+    """CREATE TEMP TABLE songplays (songplay_id SERIAL PRIMARY KEY, start_time TIMESTAMP NOT NULL,
+        time_key INT, user_id INT NOT NULL, level VARCHAR NOT NULL, song_id VARCHAR, artist_id VARCHAR,
+        session_id INT NOT NULL, location VARCHAR, user_agent VARCHAR);""",
+]
+
+songplays_select = ("""
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplays;""")
+
+time_keys_select = "SELECT start_time, time_key FROM songplays;"
+
+
+def get_postgres_songplay_insert():
+    """
+    Returns the songplays insert of sql_queries.py with the PostgreSQL equivalent of its Redshift
+    time_key expression (DATEDIFF), the number of periods of the grain since the epoch.
+    """
+    redshift_time_key = get_time_key_sql('LS.ts', CALENDAR_GRAIN)
+    assert redshift_time_key in songplay_table_insert
+    postgres_time_key = 'CAST(FLOOR(EXTRACT(EPOCH FROM LS.ts) / {}) AS INT)'.format(GRAINS[CALENDAR_GRAIN])
+    return songplay_table_insert.replace(redshift_time_key, postgres_time_key)
+
+
+def get_staging_rows(seed=0, num_artists=120, num_songs=400, num_events=3000):
+    """
+    Returns artists, songs and log events drawn at random.  Artist names and song titles are
+    shared by several artists and songs, so that only the three keys together match a song,
+    but no two songs share all three, which the correlated subqueries do not allow.  The events
+    are song plays of the songs, near misses (right title, wrong artist or length), song plays
+    of unknown songs, and other pages.
+    """
+    rng = random.Random(seed)
+    artists = [('AR{:05d}'.format(i), 'Artist {}'.format(i % (num_artists // 2)), None, None, None)
+               for i in range(num_artists)]
+
+    songs = []
+    keys = set()
+    while len(songs) < num_songs:
+        artist = rng.choice(artists)
+        title = 'Song {}'.format(rng.randrange(num_songs // 4))
+        duration = round(rng.choice([180.0, 240.5, rng.uniform(60, 600)]), 5)
+        if (title, artist[1], duration) in keys:
+            continue
+        keys.add((title, artist[1], duration))
+        songs.append(('SO{:05d}'.format(len(songs)), title, artist[0], 2000, duration))
+    names = dict((artist[0], artist[1]) for artist in artists)
+
+    events = []
+    # seconds since the epoch, from 2018-11-01
+    ts = 1541030400
+    for i in range(num_events):
+        ts += rng.randrange(1, 600)
+        song = rng.choice(songs)
+        draw = rng.random()
+        if draw < 0.6:
+            artist, title, length, page = names[song[2]], song[1], song[4], 'NextSong'
+        elif draw < 0.7:
+            artist, title, length, page = rng.choice(artists)[1], song[1], song[4], 'NextSong'
+        elif draw < 0.8:
+            artist, title, length, page = names[song[2]], song[1], round(song[4] + 0.00001, 5), 'NextSong'
+        elif draw < 0.9:
+            artist, title, length, page = 'Unknown artist', 'Unknown song', 200.0, 'NextSong'
+        else:
+            artist, title, length, page = None, None, None, 'Home'
+        user_id = rng.randrange(1, 50)
+        events.append((artist, 'Logged In', 'First', 'F', i % 20, 'Last', length, rng.choice(['free', 'paid']),
+                       'City {}'.format(user_id), 'PUT', page, None, i // 20, title, 200,
+                       datetime(1970, 1, 1) + timedelta(seconds=ts), 'Agent', user_id))
+
+    return artists, songs, events
+
+
+@pytest.fixture
+def cur():
+    dsn = os.environ.get('SONGPLAY_TEST_DSN')
+    if not dsn:
+        pytest.skip('SONGPLAY_TEST_DSN is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+    try:
+        conn = psycopg2.connect(dsn)
+    except psycopg2.OperationalError as e:
+        pytest.skip('Cannot connect to {}: {}'.format(dsn, e))
+
+    cur = conn.cursor()
+    for query in temp_table_creates:
+        cur.execute(query)
+    yield cur
+    conn.rollback()
+    conn.close()
+
+
+def load_staging_rows(cur, artists, songs, events):
+    cur.executemany("INSERT INTO artists VALUES (%s, %s, %s, %s, %s);", artists)
+    cur.executemany("INSERT INTO songs VALUES (%s, %s, %s, %s, %s);", songs)
+    cur.executemany("INSERT INTO logs_stage VALUES ({});".format(', '.join(['%s'] * 18)), events)
+
+
+def get_songplays(cur):
+    cur.execute(songplays_select)
+    return Counter(cur.fetchall())
+
+
+def test_songplay_insert_time_key():
+    # the time key is computed from the start time at the grain of the calendar, and the song and artist
+    # ids come from a single join against the song lookup
+    assert '{} AS time_key'.format(get_time_key_sql('LS.ts', CALENDAR_GRAIN)) in songplay_table_insert
+    assert 'LEFT JOIN song_lookup_stage SL ON (SL.title = LS.song) AND (SL.artist_name = LS.artist) ' \
+           'AND (SL.duration = LS.length)' in songplay_table_insert
+    assert '{' not in songplay_table_insert
+
+
+def test_postgres_songplay_insert():
+    # only the time key expression differs from the Redshift statement
+    query = get_postgres_songplay_insert()
+    postgres_time_key = 'CAST(FLOOR(EXTRACT(EPOCH FROM LS.ts) / {}) AS INT)'.format(GRAINS[CALENDAR_GRAIN])
+
+    assert 'DATEDIFF' not in query
+    assert query.replace(postgres_time_key, get_time_key_sql('LS.ts', CALENDAR_GRAIN)) == songplay_table_insert
+
+
+def test_songplay_insert_matches_correlated_subqueries(cur):
+    load_staging_rows(cur, *get_staging_rows())
+
+    cur.execute(old_songplay_table_insert)
+    expected = get_songplays(cur)
+    cur.execute("DELETE FROM songplays;")
+
+    cur.execute(song_lookup_table_delete)
+    cur.execute(song_lookup_table_insert)
+    cur.execute(get_postgres_songplay_insert())
+    actual = get_songplays(cur)
+
+    assert actual == expected
+    # Both matched and unmatched song plays were compared
+    assert sum(count for row, count in actual.items() if row[3] is not None) > 0
+    assert sum(count for row, count in actual.items() if row[3] is None) > 0
+
+    # The time keys are those of the calendar
+    cur.execute(time_keys_select)
+    for start_time, time_key in cur.fetchall():
+        assert time_key == get_time_key(start_time, CALENDAR_GRAIN)
+
+
+def test_song_lookup_keeps_lowest_song_id(cur):
+    artists = [('AR1', 'Artist', None, None, None)]
+    songs = [('SO2', 'Song', 'AR1', 2000, 180.0), ('SO1', 'Song', 'AR1', 2001, 180.0)]
+    load_staging_rows(cur, artists, songs, [])
+
+    cur.execute(song_lookup_table_insert)
+    cur.execute("SELECT title, artist_name, duration, song_id, artist_id FROM song_lookup_stage;")
+    rows = cur.fetchall()
+
+    assert [row[3:] for row in rows] == [('SO1', 'AR1')]
@@ -0,0 +1,37 @@
+-- Analytic queries run against the data warehouse, registered for table_advisor.py.
+-- The weight of a query is the number of times it runs per load.
+
+-- Song plays per hour of the day over the last week
+-- weight: 20
+SELECT T.hour, COUNT(*) AS plays
+FROM songplays SP
+JOIN time T ON SP.time_key = T.time_key
+WHERE SP.start_time >= '2018-11-24' AND SP.start_time < '2018-12-01'
+GROUP BY T.hour
+ORDER BY T.hour;
+
+-- Most played songs of the month
+-- weight: 10
+SELECT S.title, A.name, COUNT(*) AS plays
+FROM songplays SP
+JOIN songs S ON SP.song_id = S.song_id
+JOIN artists A ON SP.artist_id = A.artist_id
+WHERE SP.start_time BETWEEN '2018-11-01' AND '2018-11-30'
+GROUP BY S.title, A.name
+ORDER BY plays DESC
+LIMIT 10;
+
+-- Song plays of paid and free users
+-- weight: 10
+SELECT U.level, COUNT(*) AS plays
+FROM songplays SP
+JOIN users U ON SP.user_id = U.user_id
+GROUP BY U.level;
+
+-- Song plays of one user, with the level at the time of the play
+-- weight: 5
+SELECT SP.start_time, SP.song_id, H.level
+FROM songplays SP
+JOIN user_level_history H ON (H.user_id = SP.user_id) AND (SP.start_time >= H.valid_from) AND (H.valid_to IS NULL OR SP.start_time < H.valid_to)
+WHERE SP.user_id = 15
+ORDER BY SP.start_time;
@@ -0,0 +1,170 @@
+"""
+Calendar (time) dimension generator, shared by the Redshift ETL (DataWarehouse/etl.py) and
+the Airflow LoadCalendarOperator.
+
+The time tables used to be rebuilt on every load by EXTRACTing the hour, day, week, month,
+year and weekday of every distinct timestamp of the song plays (the whole songplays table
+for Airflow).  Instead, the calendar is generated here for a range of days, at a grain of a
+day, an hour, a minute or a second, with every attribute computed in Python, and loaded with
+a single COPY of a gzip'd CSV file.  It is only extended when a load brings song plays of
+days it does not cover yet.
+
+The week and the weekday of every time table of the repository are defined here: the Redshift
+calendar, the PostgreSQL time dimension (DataModelingPostgreSQL/time_dimension.py) and the
+Spark time tables (spark_time.py) all follow get_week() and get_weekday().  Each of them keeps
+the weekday numbering its tables were created with, one of WEEKDAY_NUMBERINGS.
+
+The rows are identified by an integer surrogate key: the number of periods of the grain
+since 1970-01-01 (e.g. hours since the epoch), which the fact tables store next to the start
+time of the song plays, computed in SQL with get_time_key_sql().  The keys follow the time,
+so a range of times is a range of keys, and the joins are on a 4 byte integer.
+
+Usage:
+
+    python calendar_dimension.py 2018-01-01 2018-12-31 calendar.csv.gz --grain hour
+"""
+import argparse
+import csv
+import gzip
+import io
+from datetime import date, datetime, timedelta
+
+
+EPOCH = datetime(1970, 1, 1)
+GRAINS = {'day': 86400, 'hour': 3600, 'minute': 60, 'second': 1}
+
+# week is the ISO 8601 week number: weeks start on Monday, and week 1 is the week of the first
+# Thursday of the year.  weekday is the day of the week, numbered by one of these numberings,
+# given by the first day of the week (0 for Monday, like date.weekday()) and its number:
+# - sunday: 0 for Sunday to 6 for Saturday, like EXTRACT(dow), for the Redshift calendar
+# - monday: 0 for Monday to 6 for Sunday, like pandas' dt.weekday, for the PostgreSQL time table
+# - iso: 1 for Monday to 7 for Sunday, like the 'u' pattern of date_format, for the Spark time tables
+WEEKDAY_NUMBERINGS = {'sunday': (6, 0), 'monday': (0, 0), 'iso': (0, 1)}
+
+# Columns of the calendar, in the order of the CSV file
+CALENDAR_COLUMNS = ['time_key', 'start_time', 'date', 'hour', 'day', 'week', 'month', 'quarter', 'year', 'weekday', 'is_weekend']
+
+calendar_range_select = "SELECT MIN(start_time), MAX(start_time) FROM {};"
+
+
+def get_time_key(value, grain='hour'):
+    """
+    Returns the key of the period of the grain that contains a datetime.
+    """
+    return int((value - EPOCH).total_seconds()) // GRAINS[grain]
+
+
+def get_week(day):
+    """
+    Returns the week of a date, its ISO 8601 week number.
+    """
+    return day.isocalendar()[1]
+
+
+def get_weekday(day, numbering='sunday'):
+    """
+    Returns the weekday of a date, in one of WEEKDAY_NUMBERINGS (0 for Sunday to 6 for
+    Saturday by default).
+    """
+    first_day, first_number = WEEKDAY_NUMBERINGS[numbering]
+    return (day.weekday() - first_day) % 7 + first_number
+
+
+def get_time_key_sql(column, grain='hour'):
+    """
+    Returns the SQL expression of the key of a TIMESTAMP column, for Redshift: DATEDIFF counts
+    the boundaries of the grain crossed since the epoch, i.e. get_time_key() of the time.
+    """
+    return "DATEDIFF({}, TIMESTAMP '1970-01-01', {})".format(grain, column)
+
+
+def generate_calendar(start_date, end_date, grain='hour'):
+    """
+    Returns the rows of the calendar from start_date to end_date (inclusive), one per period of
+    the grain, with the week and weekday of get_week() and get_weekday() (0 for Sunday).
+    """
+    rows = []
+    step = timedelta(seconds=GRAINS[grain])
+    moment = datetime(start_date.year, start_date.month, start_date.day)
+    end = datetime(end_date.year, end_date.month, end_date.day) + timedelta(days=1)
+
+    while moment < end:
+        day = moment.date()
+        rows.append((get_time_key(moment, grain), moment, day, moment.hour, day.day, get_week(day),
+                     day.month, (day.month - 1) // 3 + 1, day.year, get_weekday(day), day.weekday() >= 5))
+        moment += step
+
+    return rows
+
+
+def write_calendar_csv(rows):
+    """
+    Returns the rows as a gzip'd CSV file, as loaded by COPY ... CSV GZIP.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    for row in rows:
+        writer.writerow([value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else
+                         value.isoformat() if isinstance(value, date) else
+                         str(value).lower() if isinstance(value, bool) else value for value in row])
+    return gzip.compress(buf.getvalue().encode('utf8'))
+
+
+def get_missing_ranges(first, last, start_date, end_date):
+    """
+    Returns the ranges of days from start_date to end_date that a calendar covering the days
+    first to last does not cover.  The calendar stays contiguous: the days between the end of
+    the calendar and a later start date are added too.
+    """
+    if first is None:
+        return [(start_date, end_date)]
+
+    ranges = []
+    if start_date < first:
+        ranges.append((start_date, first - timedelta(days=1)))
+    if end_date > last:
+        ranges.append((last + timedelta(days=1), end_date))
+    return ranges
+
+
+def load_calendar(cur, store, key_prefix, copy_query, start_date, end_date, grain='hour', table='time'):
+    """
+    Makes sure that the calendar table covers the days from start_date to end_date: the days
+    it does not cover yet are generated, written to a gzip'd CSV file of the store, and loaded
+    with one COPY (copy_query, which takes the URL of the file as its parameter).  Does not
+    commit.  Returns the number of rows added.
+    """
+    cur.execute(calendar_range_select.format(table))
+    first, last = cur.fetchone()
+    first = first.date() if first is not None else None
+    last = last.date() if last is not None else None
+
+    added = 0
+    for range_start, range_end in get_missing_ranges(first, last, start_date, end_date):
+        rows = generate_calendar(range_start, range_end, grain)
+        key = '{}{:%Y%m%d}-{:%Y%m%d}.csv.gz'.format(key_prefix, range_start, range_end)
+        store.write(key, write_calendar_csv(rows))
+        cur.execute(copy_query, (store.url(key),))
+        print('\tAdded {} {} rows from {} to {} to the {} table'.format(len(rows), grain, range_start, range_end, table))
+        added += len(rows)
+
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the rows of a calendar dimension to a gzip\'d CSV file.')
+    parser.add_argument('start_date', help='first day, YYYY-MM-DD')
+    parser.add_argument('end_date', help='last day, YYYY-MM-DD')
+    parser.add_argument('output', help='path of the gzip\'d CSV file to write')
+    parser.add_argument('--grain', choices=sorted(GRAINS), default='hour', help='period of a row (default: hour)')
+    args = parser.parse_args()
+
+    rows = generate_calendar(datetime.strptime(args.start_date, '%Y-%m-%d').date(),
+                             datetime.strptime(args.end_date, '%Y-%m-%d').date(), args.grain)
+    with open(args.output, 'wb') as f:
+        f.write(write_calendar_csv(rows))
+    print('Wrote {} rows ({}) to {}'.format(len(rows), ', '.join(CALENDAR_COLUMNS), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Instrumentation shared by the ETL scripts of the projects in this repository.
+
+The scripts time their stages (file discovery, parsing, transforms, lookups, writes,
+commits, COPY commands and every SQL statement) and count the rows and bytes that go
+through them.  At the end of a run, a JSON run report and optionally a Prometheus text
+file are written.
+
+Instrumentation is off unless the ETL_REPORT environment variable is set to the path of
+the JSON report (ETL_PROMETHEUS can be set to the path of the Prometheus file).  When it
+is off, stage() returns a shared no-op object and cursors are not wrapped, so the
+overhead is a function call per stage.
+
+Usage, with the same module-level functions in every script:
+
+    configure('sparkify_etl')
+    cur = instrument_cursor(conn.cursor())
+    with stage('parse') as s:
+        df = pd.read_json(filepath, lines=True)
+        s.add(rows=len(df))
+        s.add_file(filepath)
+    finish()
+
+The recorder belongs to the process that called configure().  Functions run in worker
+processes, e.g. by a ProcessPoolExecutor, are wrapped with worker_task(): their stages are
+recorded in the worker and returned with their result, which worker_result() merges into
+the recorder of the parent process:
+
+    task = worker_task(extract_file)
+    for value in executor.map(task, files):
+        records = worker_result(value)
+"""
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class _NullStage:
+    """
+    Returned by stage() when the instrumentation is off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, rows=0, bytes=0):
+        pass
+
+    def add_file(self, path):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Times one execution of a stage, and collects its row and byte counts.
+    """
+
+    def __init__(self, recorder, name, rows, bytes):
+        self.recorder = recorder
+        self.name = name
+        self.rows = rows
+        self.bytes = bytes
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.record(self.name, time.perf_counter() - self.started_at, self.rows, self.bytes)
+        return False
+
+    def add(self, rows=0, bytes=0):
+        self.rows += rows
+        self.bytes += bytes
+
+    def add_file(self, path):
+        self.bytes += os.path.getsize(path)
+
+
+class Recorder:
+    """
+    Accumulates the number of calls, time, rows and bytes of each stage of a run.
+    """
+
+    def __init__(self, job, report_path, prometheus_path=None):
+        self.job = job
+        self.report_path = report_path
+        self.prometheus_path = prometheus_path
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds=0.0, rows=0, bytes=0):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0}
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['rows'] += rows
+            stats['bytes'] += bytes
+
+    def merge(self, stages):
+        """
+        Adds the stages recorded by another recorder, e.g. in a worker process.
+        """
+        with self.lock:
+            for name, other in stages.items():
+                stats = self.stages.get(name)
+                if stats is None:
+                    stats = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0}
+                for key in stats:
+                    stats[key] += other[key]
+
+    def get_report(self):
+        stages = {}
+        for name, stats in sorted(self.stages.items()):
+            stages[name] = dict(stats)
+            stages[name]['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else None
+
+        return {
+            'job': self.job,
+            'started_at': self.started_at.isoformat(),
+            'elapsed_seconds': time.perf_counter() - self.started,
+            'stages': stages,
+        }
+
+    def get_prometheus_text(self, report):
+        def escape(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = ['# HELP etl_run_seconds Wall time of the ETL run.',
+                 '# TYPE etl_run_seconds gauge',
+                 'etl_run_seconds{{job="{}"}} {}'.format(escape(self.job), report['elapsed_seconds'])]
+
+        metrics = [('calls', 'Number of times each stage ran.'),
+                   ('seconds', 'Time spent in each stage.'),
+                   ('rows', 'Rows processed by each stage.'),
+                   ('bytes', 'Bytes processed by each stage.')]
+        for metric, description in metrics:
+            lines.append('# HELP etl_stage_{}_total {}'.format(metric, description))
+            lines.append('# TYPE etl_stage_{}_total counter'.format(metric))
+            for name, stats in report['stages'].items():
+                lines.append('etl_stage_{}_total{{job="{}",stage="{}"}} {}'.format(
+                    metric, escape(self.job), escape(name), stats[metric]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        report = self.get_report()
+
+        with open(self.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        if self.prometheus_path:
+            with open(self.prometheus_path, 'w') as f:
+                f.write(self.get_prometheus_text(report))
+
+        return report
+
+
+class InstrumentedCursor:
+    """
+    Wraps a DB-API cursor so that every statement is recorded as an 'sql: ...' stage,
+    and every COPY as a 'copy: ...' stage.  Everything else is passed to the cursor.
+    """
+
+    def __init__(self, cursor, recorder):
+        self._cursor = cursor
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _record(self, prefix, query, started, bytes=0):
+        rows = self._cursor.rowcount if self._cursor.rowcount and self._cursor.rowcount > 0 else 0
+        self._recorder.record(prefix + get_statement_label(query), time.perf_counter() - started, rows, bytes)
+
+    def execute(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        result = self._cursor.execute(query, *args, **kwargs)
+        self._record('sql: ', query, started)
+        return result
+
+    def executemany(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        result = self._cursor.executemany(query, *args, **kwargs)
+        self._record('sql: ', query, started)
+        return result
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        started = time.perf_counter()
+        result = self._cursor.copy_expert(sql, file, *args, **kwargs)
+        self._record('copy: ', sql, started, bytes=file.tell() if hasattr(file, 'tell') else 0)
+        return result
+
+
+# Matches the table a statement works on, e.g. 'INSERT INTO songplays' or 'CREATE TABLE IF NOT EXISTS users'
+_TABLE_PATTERN = re.compile(r'\b(?:INTO|FROM|UPDATE|COPY|TABLE|EXISTS)\s+(?!(?:IF|TABLE)\b)([\w.]+)', re.IGNORECASE)
+
+
+def get_statement_label(query):
+    """
+    Returns a short label for a SQL statement: its first keyword and the table it works on.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf8', 'replace')
+
+    words = query.split()
+    if not words:
+        return ''
+
+    match = _TABLE_PATTERN.search(query)
+    return '{} {}'.format(words[0].upper(), match.group(1)) if match else words[0].upper()
+
+
+_recorder = None
+
+
+def configure(job, report_path=None, prometheus_path=None):
+    """
+    Turns the instrumentation on for this process if a report path is given, or if the
+    ETL_REPORT environment variable is set.
+    """
+    global _recorder
+
+    report_path = report_path or os.environ.get('ETL_REPORT')
+    prometheus_path = prometheus_path or os.environ.get('ETL_PROMETHEUS')
+
+    _recorder = Recorder(job, report_path, prometheus_path) if report_path else None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name, rows=0, bytes=0):
+    """
+    Returns a context manager that times a stage.  Rows and bytes can be passed here, or
+    added with add() and add_file() on the object returned by the with statement.
+    """
+    if _recorder is None:
+        return NULL_STAGE
+    return _Stage(_recorder, name, rows, bytes)
+
+
+def count(name, rows=0, bytes=0):
+    """
+    Records rows and bytes for a stage without timing it.
+    """
+    if _recorder is not None:
+        _recorder.record(name, 0.0, rows, bytes)
+
+
+def instrument_cursor(cursor):
+    """
+    Returns the cursor wrapped so that its statements are timed, or the cursor itself
+    when the instrumentation is off.
+    """
+    if _recorder is None:
+        return cursor
+    return InstrumentedCursor(cursor, _recorder)
+
+
+class _WorkerTask:
+    """
+    A function run in a worker process, with a recorder of its own when the instrumentation is
+    on in the parent process.  Returns the result of the function and the stages it recorded.
+    """
+
+    def __init__(self, func, job):
+        self.func = func
+        self.job = job
+
+    def __call__(self, *args):
+        global _recorder
+
+        if self.job is None:
+            return self.func(*args), None
+
+        _recorder = Recorder(self.job, None)
+        try:
+            return self.func(*args), _recorder.stages
+        finally:
+            _recorder = None
+
+
+def worker_task(func):
+    """
+    Returns the function wrapped to run in a worker process: it returns (result, stages),
+    to be passed to worker_result() in this process.
+    """
+    return _WorkerTask(func, _recorder.job if _recorder is not None else None)
+
+
+def worker_result(value):
+    """
+    Merges the stages of a worker_task() into the recorder of this process, and returns
+    the result of the function.
+    """
+    result, stages = value
+    if stages and _recorder is not None:
+        _recorder.merge(stages)
+    return result
+
+
+def finish():
+    """
+    Writes the run report (and the Prometheus file), and prints where it was written.
+    """
+    if _recorder is None:
+        return None
+
+    report = _recorder.write()
+    print('Run report written to {}'.format(_recorder.report_path))
+    return report
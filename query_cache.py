@@ -0,0 +1,338 @@
+"""
+Result cache for the dashboard queries against the star schemas of the PostgreSQL and
+Redshift projects.
+
+The same aggregate queries (plays per hour, top songs, paid and free users) are run over
+and over, and each run scans the songplays fact table again, although the tables only
+change when the ETL loads new data.  QueryService runs the queries on a warehouse
+connection, and keeps their result sets:
+- A result is keyed by the normalized SQL (comments, case and whitespace outside of string
+  literals do not matter), its parameters and the data version token of the database.
+- The token is read from the data_version table, which bump_data_version() updates at the
+  end of each load of DataModelingPostgreSQL/etl.py and DataWarehouse/etl.py.  When it
+  changes, every cached result is dropped.
+- The results are kept in memory up to a memory budget, evicting the least recently used
+  ones.  With a spill folder, the evicted results are written to Parquet files (this needs
+  pyarrow) and read back on their next use, instead of running the query again.
+- The hits, misses, hit rate and the query time saved by the hits are reported.
+
+Usage, with a connection dedicated to the service (it is switched to autocommit, so that each
+query sees the latest committed load):
+
+    service = QueryService(conn, memory_budget=64 * 1024 * 1024)
+    columns, rows = service.query("SELECT level, COUNT(*) FROM songplays GROUP BY level;")
+    print('\\n'.join(service.report()))
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+data_version_table_create = ("""
+CREATE TABLE IF NOT EXISTS data_version (
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL,
+    job VARCHAR NOT NULL
+);""")
+
+data_version_update = ("""
+UPDATE data_version SET version = version + 1, updated_at = %s, job = %s;""")
+
+data_version_insert = ("""
+INSERT INTO data_version (version, updated_at, job) VALUES (1, %s, %s);""")
+
+data_version_select = ("""
+SELECT version, updated_at FROM data_version;""")
+
+
+def bump_data_version(cur, job):
+    """
+    Bumps the data version token of the database, so that the query services drop the results
+    cached before the load.  The ETL scripts call it at the end of each load, before their
+    last commit.  The token holds the time of the load too, so that it also changes when the
+    database is recreated and the version starts again from 1.
+    """
+    cur.execute(data_version_table_create)
+    cur.execute(data_version_update, (datetime.utcnow(), job))
+    if cur.rowcount == 0:
+        cur.execute(data_version_insert, (datetime.utcnow(), job))
+
+
+def normalize_sql(sql):
+    """
+    Returns the SQL of a query with its comments removed, and its whitespace and case
+    normalized outside of string literals, so that the same query written differently gets
+    the same cache key.
+    """
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            # a string literal
+            normalized.append(part)
+        else:
+            part = re.sub(r'--[^\n]*|/\*.*?\*/', ' ', part, flags=re.S)
+            normalized.append(re.sub(r'\s+', ' ', part.lower()))
+    return ''.join(normalized).strip().rstrip('; ')
+
+
+def get_result_size(columns, rows):
+    """
+    Returns an estimate of the memory used by a result set, in bytes.
+    """
+    size = sys.getsizeof(columns) + sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class QueryService:
+    """
+    Runs queries on a warehouse connection, and caches their result sets until the data
+    version token of the database changes.
+    """
+
+    def __init__(self, conn, memory_budget=64 * 1024 * 1024, spill_dir=None, version_check_interval=0.0, router=None):
+        """
+        - memory_budget: bytes of result sets kept in memory
+        - spill_dir: folder to write the evicted result sets to, as Parquet files
+        - version_check_interval: seconds during which the data version token is not read
+          again (0 reads it before every query, which is a small query on a one row table)
+        - router: a rollups.QueryRouter, to answer the eligible queries from the rollups of
+          the songplays table instead of the table itself
+        """
+        self.conn = conn
+        self.conn.autocommit = True
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.version_check_interval = version_check_interval
+        self.router = router
+
+        if spill_dir is not None:
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError('pyarrow is needed to spill the cached results to disk')
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.spilled = {}
+        self.size = 0
+        self.version = None
+        self.version_checked_at = None
+        self.stats = {'queries': 0, 'hits': 0, 'misses': 0, 'spill_hits': 0, 'evictions': 0, 'spills': 0,
+                      'invalidations': 0, 'routed': 0, 'query_seconds': 0.0, 'saved_seconds': 0.0}
+
+    def get_version(self):
+        """
+        Returns the data version token of the database, and drops the cached results when it
+        has changed since the last query.
+        """
+        now = time.monotonic()
+        if self.version_checked_at is not None and now - self.version_checked_at < self.version_check_interval:
+            return self.version
+
+        cur = self.conn.cursor()
+        try:
+            cur.execute(data_version_select)
+            row = cur.fetchone()
+            version = '{}@{}'.format(*row) if row else '0'
+        except Exception:
+            # nothing has been loaded since the table was added
+            version = '0'
+        cur.close()
+
+        if version != self.version:
+            if self.version is not None and (self.entries or self.spilled):
+                self.stats['invalidations'] += 1
+            self.clear()
+            self.version = version
+        self.version_checked_at = now
+        return version
+
+    def query(self, sql, params=None):
+        """
+        Returns the column names and the rows of a query, from the cache if the same query
+        was run since the last load.
+        """
+        started = time.perf_counter()
+        key = hashlib.sha256(json.dumps([normalize_sql(sql), params, self.get_version()],
+                                        default=str).encode('utf8')).hexdigest()
+        self.stats['queries'] += 1
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif key in self.spilled:
+            entry = self.read_spill(key)
+            self.stats['spill_hits'] += 1
+            self.store(key, entry)
+
+        if entry is not None:
+            self.stats['hits'] += 1
+            self.stats['saved_seconds'] += max(0.0, entry['seconds'] - (time.perf_counter() - started))
+            return entry['columns'], entry['rows']
+
+        routed = self.router.route(sql) if self.router is not None and params is None else None
+        if routed is not None:
+            self.stats['routed'] += 1
+
+        cur = self.conn.cursor()
+        cur.execute(routed or sql, params)
+        columns = [description[0] for description in cur.description]
+        rows = cur.fetchall()
+        cur.close()
+
+        seconds = time.perf_counter() - started
+        self.stats['misses'] += 1
+        self.stats['query_seconds'] += seconds
+        self.store(key, {'columns': columns, 'rows': rows, 'seconds': seconds, 'size': get_result_size(columns, rows)})
+        return columns, rows
+
+    def store(self, key, entry):
+        """
+        Adds a result set to the memory cache, and evicts the least recently used ones (to the
+        spill folder, if any) until the cache fits in the memory budget.
+        """
+        if entry['size'] > self.memory_budget:
+            self.spill(key, entry)
+            return
+
+        self.entries[key] = entry
+        self.size += entry['size']
+        while self.size > self.memory_budget:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= evicted['size']
+            self.stats['evictions'] += 1
+            self.spill(evicted_key, evicted)
+
+    def spill(self, key, entry):
+        """
+        Writes a result set to a Parquet file of the spill folder.  Result sets whose values
+        Arrow cannot convert are dropped instead.
+        """
+        if self.spill_dir is None:
+            return
+        import pyarrow
+        import pyarrow.parquet
+
+        try:
+            arrays = [pyarrow.array([row[i] for row in entry['rows']]) for i in range(len(entry['columns']))]
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            return
+
+        # the columns are stored by position, as a query can return two columns with the same name
+        path = os.path.join(self.spill_dir, key + '.parquet')
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, names=['c{}'.format(i) for i in range(len(arrays))]), path)
+        self.spilled[key] = {'path': path, 'columns': entry['columns'], 'seconds': entry['seconds']}
+        self.stats['spills'] += 1
+
+    def read_spill(self, key):
+        import pyarrow.parquet
+
+        spilled = self.spilled.pop(key)
+        table = pyarrow.parquet.read_table(spilled['path'])
+        os.remove(spilled['path'])
+        rows = list(zip(*[column.to_pylist() for column in table.columns]))
+        return {'columns': spilled['columns'], 'rows': rows, 'seconds': spilled['seconds'],
+                'size': get_result_size(spilled['columns'], rows)}
+
+    def clear(self):
+        """
+        Drops every cached result set, in memory and in the spill folder.
+        """
+        self.entries.clear()
+        self.size = 0
+        for spilled in self.spilled.values():
+            if os.path.exists(spilled['path']):
+                os.remove(spilled['path'])
+        self.spilled.clear()
+
+    def close(self):
+        self.clear()
+
+    def get_stats(self):
+        """
+        Returns the counters of the service, with the hit rate and the memory used.
+        """
+        stats = dict(self.stats)
+        stats['hit_rate'] = stats['hits'] / float(stats['queries']) if stats['queries'] else 0.0
+        stats['cached_results'] = len(self.entries)
+        stats['spilled_results'] = len(self.spilled)
+        stats['memory_bytes'] = self.size
+        return stats
+
+    def report(self):
+        """
+        Returns the lines of a report of the cache hits and of the query time they saved.
+        """
+        stats = self.get_stats()
+        return [
+            'Queries: {} ({} hits, {} misses), hit rate {:.1%}'.format(stats['queries'], stats['hits'], stats['misses'], stats['hit_rate']),
+            'Query time: {:.3f}s run on the database, {:.3f}s saved by the cache'.format(stats['query_seconds'], stats['saved_seconds']),
+            'Misses answered from the rollups: {} of {}'.format(stats['routed'], stats['misses']),
+            'Cached: {} results in memory ({:.2f} MB of {:.2f} MB), {} spilled to disk'.format(
+                stats['cached_results'], stats['memory_bytes'] / 1e6, self.memory_budget / 1e6, stats['spilled_results']),
+            'Evictions: {}, spills: {}, hits from disk: {}, invalidations by a new load: {}'.format(
+                stats['evictions'], stats['spills'], stats['spill_hits'], stats['invalidations']),
+        ]
+
+
+def main():
+    """
+    Runs the queries of a workload file (e.g. DataWarehouse/workload.sql) through a query
+    service, as many times as their weights, and reports the hits and the time saved.
+    """
+    import configparser
+    import psycopg2
+    from table_advisor import load_workload
+
+    parser = argparse.ArgumentParser(description='Run dashboard queries through the result cache.')
+    parser.add_argument('workload', help='file of queries, with -- weight: N comments')
+    parser.add_argument('--dsn', default=None, help='connection string of the database, e.g. of the PostgreSQL project')
+    parser.add_argument('--config', default=None, help='config file with the CLUSTER section, e.g. DataWarehouse/dwh.cfg')
+    parser.add_argument('--repeat', type=int, default=3, help='number of rounds over the workload (default: 3)')
+    parser.add_argument('--memory-budget', type=float, default=64, help='MB of results kept in memory (default: 64)')
+    parser.add_argument('--spill-dir', default=None, help='folder to spill the evicted results to, as Parquet files')
+    parser.add_argument('--version-check-interval', type=float, default=0.0,
+                        help='seconds between two reads of the data version token (default: 0, before every query)')
+    parser.add_argument('--rollups', action='store_true',
+                        help='answer the eligible queries from the songplays rollups (see rollups.py)')
+    args = parser.parse_args()
+
+    if (args.dsn is None) == (args.config is None):
+        parser.error('one of --dsn and --config is needed')
+    if args.config:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+    else:
+        dsn = args.dsn
+
+    router = None
+    if args.rollups:
+        from rollups import QueryRouter
+        router = QueryRouter()
+
+    service = QueryService(psycopg2.connect(dsn), int(args.memory_budget * 1024 * 1024), args.spill_dir,
+                           args.version_check_interval, router)
+    workload = load_workload(args.workload)
+    for i in range(args.repeat):
+        for name, query, weight in workload:
+            for j in range(max(1, int(round(weight)))):
+                service.query(query)
+        print('Round {}/{}: hit rate {:.1%}'.format(i + 1, args.repeat, service.get_stats()['hit_rate']))
+
+    print('\n'.join(service.report()))
+    service.close()
+    service.conn.close()
+
+
+if __name__ == "__main__":
+    main()
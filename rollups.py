@@ -0,0 +1,534 @@
+"""
+Pre-aggregated rollups of the songplays fact table, shared by the Redshift ETL
+(DataWarehouse/etl.py) and the Airflow LoadFactOperator.
+
+The dashboard reports count song plays by hour, day, user level and artist, and each of
+them scans the whole songplays table again.  The rollup tables hold these counts, one
+partition per day of song plays:
+- rollup_sessions_daily: sessions, song plays, and the total and longest session length
+  per day and level
+- rollup_plays_hourly: song plays per day, hour and level
+- rollup_plays_artist_daily: song plays per day, artist and level
+
+refresh_rollups() is called by the loading code right after the song plays are inserted,
+in the same transaction: only the days touched by the load (the days of the staged song
+plays) are deleted from the rollups and aggregated again from songplays, so the cost of a
+refresh depends on the new data, not on the whole history.
+
+QueryRouter answers eligible queries from the smallest rollup that has all the columns
+they need: COUNT(*) queries over songplays (optionally joined with the calendar of
+calendar_dimension.py on the time key), grouped and filtered by the level, the artist, the hour or the day, with
+start time ranges on whole days.  Other queries are left as they are.  QueryService of
+query_cache.py takes a router, so that cached dashboards use the rollups transparently.
+
+Usage:
+
+    refresh_rollups(cur, "SELECT DISTINCT TRUNC(ts) FROM logs_stage WHERE page = 'NextSong';")
+    sql = QueryRouter().route(query) or query
+"""
+import argparse
+import configparser
+import re
+from datetime import date, datetime, timedelta
+
+from query_cache import normalize_sql
+from table_advisor import find_closing, split_top_level
+
+
+# Names of the songplays columns in the schema of each project
+DWH_COLUMNS = {'start_time': 'start_time', 'time_key': 'time_key', 'user_id': 'user_id', 'level': 'level',
+               'artist_id': 'artist_id', 'session_id': 'session_id'}
+AIRFLOW_COLUMNS = {'start_time': 'start_time', 'time_key': 'time_key', 'user_id': 'userid', 'level': 'level',
+                   'artist_id': 'artistid', 'session_id': 'sessionid'}
+
+# The rollups, from the smallest to the largest: the router uses the first one that has all
+# the dimensions of a query.  Their inserts aggregate the song plays of the days refreshed
+# ({days}), with the column names of the schema.  A session played over midnight is counted
+# in both days.
+ROLLUPS = [
+    {
+        'name': 'rollup_sessions_daily',
+        'dimensions': ['play_date', 'level'],
+        'create': ("""
+CREATE TABLE IF NOT EXISTS rollup_sessions_daily (
+    play_date DATE NOT NULL,
+    level VARCHAR,
+    sessions BIGINT NOT NULL,
+    plays BIGINT NOT NULL,
+    session_seconds BIGINT NOT NULL,
+    max_session_seconds BIGINT NOT NULL
+) DISTSTYLE ALL
+SORTKEY (play_date);"""),
+        'insert': ("""
+INSERT INTO rollup_sessions_daily (play_date, level, sessions, plays, session_seconds, max_session_seconds)
+SELECT
+    play_date,
+    level,
+    COUNT(*) AS sessions,
+    SUM(plays) AS plays,
+    SUM(seconds) AS session_seconds,
+    MAX(seconds) AS max_session_seconds
+FROM (
+    SELECT
+        TRUNC({start_time}) AS play_date,
+        {level} AS level,
+        {user_id},
+        {session_id},
+        COUNT(*) AS plays,
+        DATEDIFF(second, MIN({start_time}), MAX({start_time})) AS seconds
+    FROM {fact_table}
+    WHERE {days}
+    GROUP BY 1, 2, 3, 4
+) AS sessions
+GROUP BY play_date, level;"""),
+    },
+    {
+        'name': 'rollup_plays_hourly',
+        'dimensions': ['play_date', 'hour', 'level'],
+        'create': ("""
+CREATE TABLE IF NOT EXISTS rollup_plays_hourly (
+    play_date DATE NOT NULL,
+    hour SMALLINT NOT NULL,
+    level VARCHAR,
+    plays BIGINT NOT NULL
+) DISTSTYLE ALL
+SORTKEY (play_date, hour);"""),
+        'insert': ("""
+INSERT INTO rollup_plays_hourly (play_date, hour, level, plays)
+SELECT
+    TRUNC({start_time}) AS play_date,
+    EXTRACT(hour FROM {start_time}) AS hour,
+    {level} AS level,
+    COUNT(*) AS plays
+FROM {fact_table}
+WHERE {days}
+GROUP BY 1, 2, 3;"""),
+    },
+    {
+        'name': 'rollup_plays_artist_daily',
+        'dimensions': ['play_date', 'artist_id', 'level'],
+        'create': ("""
+CREATE TABLE IF NOT EXISTS rollup_plays_artist_daily (
+    play_date DATE NOT NULL,
+    artist_id VARCHAR,
+    level VARCHAR,
+    plays BIGINT NOT NULL
+) DISTSTYLE AUTO
+SORTKEY (play_date, artist_id);"""),
+        'insert': ("""
+INSERT INTO rollup_plays_artist_daily (play_date, artist_id, level, plays)
+SELECT
+    TRUNC({start_time}) AS play_date,
+    {artist_id} AS artist_id,
+    {level} AS level,
+    COUNT(*) AS plays
+FROM {fact_table}
+WHERE {days}
+GROUP BY 1, 2, 3;"""),
+    },
+]
+
+rollup_table_create_queries = [rollup['create'] for rollup in ROLLUPS]
+rollup_table_drop_queries = ['DROP TABLE IF EXISTS {};'.format(rollup['name']) for rollup in ROLLUPS]
+
+# Days of every song play, to build the rollups of an existing songplays table
+fact_days_select = "SELECT DISTINCT TRUNC({start_time}) FROM {fact_table};"
+
+# Columns of the time table, as expressions of the rollup columns
+TIME_COLUMNS = {'hour': 'hour', 'date': 'play_date', 'day': 'extract(day from play_date)',
+                'week': 'extract(week from play_date)', 'month': 'extract(month from play_date)',
+                'quarter': 'extract(quarter from play_date)', 'year': 'extract(year from play_date)',
+                'weekday': 'extract(dow from play_date)'}
+DATE_PARTS = {'day': 'day', 'week': 'week', 'month': 'month', 'quarter': 'quarter', 'year': 'year', 'dow': 'dow',
+              'dayofweek': 'dow'}
+
+UNSUPPORTED = re.compile(r'\b(distinct|having|union|intersect|except|over|or|not|between|case|null|with)\b|%s')
+QUERY = re.compile(r'^select (?P<select>.+?) from (?P<from>.+?)(?: where (?P<where>.+?))?(?: group by (?P<group>.+?))?'
+                   r'(?: order by (?P<order>.+?))?(?: limit (?P<limit>\d+))?$')
+FROM_CLAUSE = re.compile(r'^(?P<fact>\w+)(?:(?: as)? (?!(?:inner|join)\b)(?P<fact_alias>\w+))?'
+                         r'(?: (?:inner )?join (?P<time>\w+)(?:(?: as)? (?!on\b)(?P<time_alias>\w+))?'
+                         r' on \(?(?P<left>[\w.]+) = (?P<right>[\w.]+)\)?)?$')
+COLUMN = re.compile(r'^(?:(\w+)\.)?(\w+)$')
+LITERAL = re.compile(r'^(__literal_\d+__|-?\d+(?:\.\d+)?)$')
+DAY_LITERAL = re.compile(r"^'(\d{4}-\d{2}-\d{2})(?: 00:00:00(?:\.0+)?)?'$")
+
+
+def mask_parentheses(text):
+    """
+    Returns the text with the characters between parentheses replaced by '~'.
+    """
+    masked = []
+    depth = 0
+    for char in text:
+        if char == ')':
+            depth -= 1
+        masked.append('~' if depth > 0 else char)
+        if char == '(':
+            depth += 1
+    return ''.join(masked)
+
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def get_day_ranges(days):
+    """
+    Returns the [start, end) ranges of consecutive days in a list of days, e.g. a week of
+    days gives one range instead of seven predicates.
+    """
+    ranges = []
+    for day in sorted(set(days)):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    return [tuple(day_range) for day_range in ranges]
+
+
+def get_range_predicate(column, ranges):
+    """
+    Returns a predicate selecting the rows of the day ranges, and its parameters.  Ranges on
+    the column itself let Redshift skip the blocks of the other days with the zone maps of a
+    start_time sort key, unlike a TRUNC(start_time) IN (...) predicate.
+    """
+    predicate = ' OR '.join('({0} >= %s AND {0} < %s)'.format(column) for day_range in ranges)
+    return '(' + predicate + ')', [bound for day_range in ranges for bound in day_range]
+
+
+def refresh_rollups(cur, days_query, days_params=None, columns=DWH_COLUMNS, fact_table='songplays', rollups=ROLLUPS):
+    """
+    Refreshes the days touched by a load in every rollup: the days returned by days_query
+    (e.g. the days of the staged song plays) are deleted from the rollups, and aggregated
+    again from the fact table.  Creates the rollup tables if needed, and does not commit, so
+    that the refresh is part of the transaction of the load.  Returns the days refreshed.
+    """
+    cur.execute(days_query, days_params)
+    days = sorted(set(to_date(row[0]) for row in cur.fetchall() if row[0] is not None))
+    if not days:
+        return days
+
+    ranges = get_day_ranges(days)
+    rollup_predicate, params = get_range_predicate('play_date', ranges)
+    fact_predicate, fact_params = get_range_predicate(columns['start_time'], ranges)
+
+    for rollup in rollups:
+        cur.execute(rollup['create'])
+        cur.execute('DELETE FROM {} WHERE {};'.format(rollup['name'], rollup_predicate), params)
+        cur.execute(rollup['insert'].format(days=fact_predicate, fact_table=fact_table, **columns), fact_params)
+
+    return days
+
+
+class QueryRouter:
+    """
+    Rewrites the eligible COUNT(*) queries over the songplays table to read the smallest
+    rollup that has all their dimensions.
+    """
+
+    def __init__(self, rollups=ROLLUPS, columns=DWH_COLUMNS, fact_table='songplays', time_table='time',
+                 calendar_grain='hour'):
+        """
+        - calendar_grain: grain of the time table; a calendar of days has no hours to group by
+        """
+        self.rollups = rollups
+        self.columns = {name: canonical for canonical, name in columns.items()}
+        self.fact_table = fact_table
+        self.time_table = time_table
+        self.calendar_grain = calendar_grain
+
+    def route(self, sql):
+        """
+        Returns the SQL of the query answered from a rollup, or None if the query is not
+        eligible.
+        """
+        try:
+            return self.rewrite(sql)
+        except ValueError:
+            return None
+
+    def rewrite(self, sql):
+        """
+        Rewrites a query to read a rollup.  Raises a ValueError if the query is not eligible.
+        """
+        # The string literals are set aside, so that they cannot be mistaken for SQL
+        literals = []
+
+        def set_aside(match):
+            literals.append(match.group(0))
+            return '__literal_{}__'.format(len(literals) - 1)
+
+        text = re.sub(r"'(?:[^']|'')*'", set_aside, normalize_sql(sql))
+        if UNSUPPORTED.search(text) or len(re.findall(r'\bselect\b', text)) > 1:
+            raise ValueError('unsupported construct')
+        # The clauses are found outside of parentheses, e.g. not in EXTRACT(hour FROM start_time)
+        match = QUERY.match(mask_parentheses(text))
+        if match is None:
+            raise ValueError('unsupported query')
+        query = {name: text[match.start(name):match.end(name)] if match.group(name) else None
+                 for name in ['select', 'from', 'where', 'group', 'order', 'limit']}
+
+        self.aliases = self.parse_from(query['from'])
+        self.literals = literals
+        dimensions = set()
+
+        items = []
+        names = set()
+        aggregates = 0
+        for item in split_top_level(query['select']):
+            expression, alias = self.split_alias(item)
+            if self.is_count(expression):
+                aggregates += 1
+                rewritten = 'sum(plays)' if query['group'] else 'coalesce(sum(plays), 0)'
+                alias = alias or 'count'
+            else:
+                rewritten, dimension = self.resolve(expression)
+                dimensions.add(dimension)
+                if alias is None:
+                    column = COLUMN.match(expression)
+                    if column is None:
+                        raise ValueError('unnamed expression: ' + expression)
+                    alias = column.group(2)
+            names.add(alias)
+            items.append(rewritten if rewritten == alias else '{} as {}'.format(rewritten, alias))
+        if aggregates == 0:
+            raise ValueError('no COUNT(*)')
+
+        conditions = []
+        for condition in query['where'].split(' and ') if query['where'] else []:
+            rewritten, dimension = self.resolve_condition(condition)
+            dimensions.add(dimension)
+            conditions.append(rewritten)
+
+        groups = []
+        for item in split_top_level(query['group'] or ''):
+            rewritten, dimension = self.resolve_reference(item, names)
+            dimensions.add(dimension)
+            groups.append(rewritten)
+
+        orders = []
+        for item in split_top_level(query['order'] or ''):
+            direction = re.search(r'( (?:asc|desc))?( nulls (?:first|last))?$', item).group(0)
+            expression = item[:len(item) - len(direction)]
+            if self.is_count(expression):
+                rewritten = 'sum(plays)'
+            else:
+                rewritten, dimension = self.resolve_reference(expression, names)
+                dimensions.add(dimension)
+            orders.append(rewritten + direction)
+
+        dimensions.discard(None)
+        rollup = self.get_rollup(dimensions)
+
+        rewritten = 'select {} from {}'.format(', '.join(items), rollup['name'])
+        if conditions:
+            rewritten += ' where ' + ' and '.join(conditions)
+        if groups:
+            rewritten += ' group by ' + ', '.join(groups)
+        if orders:
+            rewritten += ' order by ' + ', '.join(orders)
+        if query['limit']:
+            rewritten += ' limit ' + query['limit']
+
+        return re.sub(r'__literal_(\d+)__', lambda match: literals[int(match.group(1))], rewritten) + ';'
+
+    def parse_from(self, text):
+        """
+        Returns the table of each name a column can be qualified with: songplays, joined
+        with the time table on the time key or not.
+        """
+        match = FROM_CLAUSE.match(text)
+        if match is None or match.group('fact') != self.fact_table:
+            raise ValueError('unsupported FROM clause: ' + text)
+
+        aliases = {self.fact_table: 'fact', match.group('fact_alias') or self.fact_table: 'fact'}
+        if match.group('time'):
+            if match.group('time') != self.time_table:
+                raise ValueError('unsupported join: ' + match.group('time'))
+            aliases[self.time_table] = 'time'
+            aliases[match.group('time_alias') or self.time_table] = 'time'
+
+            # Every song play has its calendar row, so the join neither drops nor repeats song plays
+            sides = set()
+            for column in [match.group('left'), match.group('right')]:
+                qualifier, name = COLUMN.match(column).groups()
+                if qualifier not in aliases or name != 'time_key':
+                    raise ValueError('unsupported join condition')
+                sides.add(aliases[qualifier])
+            if sides != {'fact', 'time'}:
+                raise ValueError('unsupported join condition')
+
+        return aliases
+
+    def split_alias(self, item):
+        match = re.match(r'^(.+) as (\w+)$', item) or re.match(r'^(.+\)|[\w.]+) (\w+)$', item)
+        if match:
+            return match.group(1), match.group(2)
+        return item, None
+
+    def is_count(self, expression):
+        match = re.match(r'^count\((\*|1|[\w.]+)\)$', expression)
+        if match is None:
+            return False
+        return match.group(1) in ('*', '1') or self.get_column(match.group(1)) == ('fact', 'start_time')
+
+    def get_column(self, expression):
+        """
+        Returns the table ('fact' or 'time') and the canonical name of a column reference.
+        """
+        match = COLUMN.match(expression)
+        if match is None:
+            raise ValueError('not a column: ' + expression)
+        qualifier, name = match.groups()
+
+        if qualifier is not None:
+            if qualifier not in self.aliases:
+                raise ValueError('unknown table: ' + qualifier)
+            table = self.aliases[qualifier]
+        elif name in self.columns:
+            table = 'fact'
+        elif 'time' in self.aliases.values() and name in TIME_COLUMNS:
+            table = 'time'
+        else:
+            raise ValueError('unknown column: ' + name)
+
+        if table == 'fact':
+            if name not in self.columns:
+                raise ValueError('unknown column: ' + name)
+            return table, self.columns[name]
+        if name not in TIME_COLUMNS or (name == 'hour' and self.calendar_grain == 'day'):
+            # e.g. the start time of the calendar row, which is not the time of the song play
+            raise ValueError('not a column of the rollups: ' + name)
+        return table, name
+
+    def resolve(self, expression):
+        """
+        Returns an expression of the rollup columns equal to a dimension of a query, and the
+        rollup column it needs.
+        """
+        match = re.match(r'^extract\((\w+) from ([\w.]+)\)$', expression)
+        if match and self.get_column(match.group(2)) == ('fact', 'start_time'):
+            if match.group(1) == 'hour':
+                return 'hour', 'hour'
+            if match.group(1) in DATE_PARTS:
+                return 'extract({} from play_date)'.format(DATE_PARTS[match.group(1)]), 'play_date'
+
+        match = re.match(r"^(?:trunc\(([\w.]+)\)|date_trunc\(__literal_(\d+)__, ([\w.]+)\))$", expression)
+        if match:
+            if match.group(1) and self.get_column(match.group(1)) == ('fact', 'start_time'):
+                return 'play_date', 'play_date'
+            if match.group(3) and self.literals[int(match.group(2))] == "'day'" and \
+                    self.get_column(match.group(3)) == ('fact', 'start_time'):
+                return 'play_date', 'play_date'
+
+        table, name = self.get_column(expression)
+        if table == 'time':
+            return TIME_COLUMNS[name], 'hour' if name == 'hour' else 'play_date'
+        if name in ('level', 'artist_id'):
+            return name, name
+        raise ValueError('not a dimension of the rollups: ' + expression)
+
+    def resolve_reference(self, item, names):
+        """
+        Resolves an item of the GROUP BY or ORDER BY clause: a dimension, a position, or the
+        name of a column of the SELECT clause.
+        """
+        if re.match(r'^\d+$', item):
+            return item, None
+        try:
+            return self.resolve(item)
+        except ValueError:
+            if item in names:
+                return item, None
+            raise
+
+    def resolve_condition(self, condition):
+        """
+        Rewrites a condition of the WHERE clause: a comparison of a dimension with a literal,
+        or a range of the start time on whole days.
+        """
+        while condition.startswith('(') and find_closing(condition, 0) == len(condition) - 1:
+            condition = condition[1:-1].strip()
+
+        match = re.match(r'^(.+?) in \((.+)\)$', condition)
+        if match:
+            values = split_top_level(match.group(2))
+            if not all(LITERAL.match(value) for value in values):
+                raise ValueError('not a list of literals: ' + condition)
+            rewritten, dimension = self.resolve(match.group(1))
+            return '{} in ({})'.format(rewritten, ', '.join(values)), dimension
+
+        match = re.match(r'^(.+?) ?(=|<>|!=|>=|<=|>|<) ?(.+)$', condition)
+        if match is None or not LITERAL.match(match.group(3)):
+            raise ValueError('unsupported condition: ' + condition)
+        left, operator, value = match.groups()
+
+        try:
+            is_start_time = self.get_column(left) == ('fact', 'start_time')
+        except ValueError:
+            is_start_time = False
+        if is_start_time:
+            # Only ranges on whole days can be read from the daily partitions
+            day = DAY_LITERAL.match(self.literals[int(value[10:-2])]) if value.startswith('__literal_') else None
+            if day is None or operator not in ('>=', '<'):
+                raise ValueError('start time range not on whole days: ' + condition)
+            return "play_date {} '{}'".format(operator, day.group(1)), 'play_date'
+
+        rewritten, dimension = self.resolve(left)
+        return '{} {} {}'.format(rewritten, operator, value), dimension
+
+    def get_rollup(self, dimensions):
+        for rollup in self.rollups:
+            if dimensions <= set(rollup['dimensions']):
+                return rollup
+        raise ValueError('no rollup has the dimensions {}'.format(sorted(dimensions)))
+
+
+def main():
+    """
+    Shows the rewrite of the queries of a workload file, or builds the rollups of the
+    songplays table already loaded (e.g. when the rollups are added to an existing cluster).
+    """
+    from table_advisor import load_workload
+
+    parser = argparse.ArgumentParser(description='Route queries to the songplays rollups, or refresh the rollups.')
+    subparsers = parser.add_subparsers(dest='command')
+    route_parser = subparsers.add_parser('route', help='print the rollup query answering each query of a workload file')
+    route_parser.add_argument('workload', help='file of queries, e.g. DataWarehouse/workload.sql')
+    refresh_parser = subparsers.add_parser('refresh', help='build the rollups of the whole songplays table')
+    refresh_parser.add_argument('--config', default='dwh.cfg', help='config file with the CLUSTER section (default: dwh.cfg)')
+    for subparser in [route_parser, refresh_parser]:
+        subparser.add_argument('--schema', choices=['dwh', 'airflow'], default='dwh',
+                               help='column names of the songplays table (default: dwh)')
+    args = parser.parse_args()
+    columns = AIRFLOW_COLUMNS if args.schema == 'airflow' else DWH_COLUMNS
+
+    if args.command == 'route':
+        router = QueryRouter(columns=columns)
+        for name, query, weight in load_workload(args.workload):
+            print('-- {}'.format(name))
+            print(router.route(query) or '-- not eligible, run on songplays')
+            print('')
+
+    elif args.command == 'refresh':
+        import psycopg2
+
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        cur = conn.cursor()
+        days = refresh_rollups(cur, fact_days_select.format(fact_table='songplays', **columns), columns=columns)
+        conn.commit()
+        conn.close()
+        print('Refreshed {} days of song plays in {} rollups'.format(len(days), len(ROLLUPS)))
+
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
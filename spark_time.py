@@ -0,0 +1,82 @@
+"""
+Timestamp and calendar columns for the Spark jobs, shared by the data lake ETL
+(DataLake/etl.py) and the Capstone notebook.
+
+The jobs used to convert their times with Python UDFs, e.g.
+udf(lambda x: datetime.fromtimestamp(x / 1000.0)), which sends every row through a Python
+worker and back, and converts the times with the local timezone of the workers.  The
+functions here return native Spark column expressions instead, which run in the JVM, and
+the times are interpreted in the timezone of the Spark session, set explicitly with
+set_timezone().
+
+Usage:
+
+    set_timezone(spark, 'UTC')
+    df = df.withColumn('start_time', epoch_millis_to_timestamp('ts'))
+    time_table = add_calendar_columns(df.select('start_time').distinct(), 'start_time')
+    df = df.withColumn('arrival_date', sas_date_to_date('arrival_date_days'))
+"""
+from pyspark.sql import functions as F
+
+from calendar_dimension import WEEKDAY_NUMBERINGS
+
+
+# Day 0 of the SAS dates
+SAS_EPOCH = '1960-01-01'
+
+
+def set_timezone(spark, timezone='UTC'):
+    """
+    Sets the timezone the timestamps are converted from and to, and the calendar columns
+    computed in, for the Spark session.
+    """
+    spark.conf.set('spark.sql.session.timeZone', timezone)
+
+
+def to_column(column):
+    return F.col(column) if isinstance(column, str) else column
+
+
+def epoch_millis_to_timestamp(column):
+    """
+    Returns the timestamp of a number of milliseconds since 1970-01-01 UTC, e.g. the ts
+    field of the log data.
+    """
+    return (to_column(column) / 1000.0).cast('timestamp')
+
+
+def sas_date_to_date(column):
+    """
+    Returns the date of a column of SAS dates, numbers of days since 1960-01-01, given by
+    its name.  The date is NULL if the SAS date is NULL or NaN.
+    """
+    # date_add takes a column of days in SQL, not in the Python API of Spark 2
+    return F.when(~F.isnan(F.col(column)),
+                  F.expr("date_add(DATE '{}', CAST(`{}` AS INT))".format(SAS_EPOCH, column)))
+
+
+def add_calendar_columns(df, column='start_time', numbering='iso'):
+    """
+    Adds the hour, day, week, month, year and weekday of a timestamp column to a data
+    frame.  The week and weekday are those of get_week() and get_weekday() in
+    calendar_dimension.py: the ISO week, and the weekday in one of its numberings, by
+    default the ISO day of the week, 1 for Monday to 7 for Sunday.
+    """
+    column = to_column(column)
+    return df.withColumn('hour', F.hour(column)) \
+        .withColumn('day', F.dayofmonth(column)) \
+        .withColumn('week', F.weekofyear(column)) \
+        .withColumn('month', F.month(column)) \
+        .withColumn('year', F.year(column)) \
+        .withColumn('weekday', get_weekday(column, numbering))
+
+
+def get_weekday(column, numbering='iso'):
+    """
+    Returns the day of the week of a date or timestamp, like get_weekday() in
+    calendar_dimension.py, by default the ISO day of the week, 1 for Monday to 7 for Sunday,
+    like the 'u' pattern of date_format, which Spark 3 no longer accepts.
+    """
+    first_day, first_number = WEEKDAY_NUMBERINGS[numbering]
+    # dayofweek is 1 for Sunday to 7 for Saturday, so dayofweek + 5 is 0 for Monday modulo 7
+    return (F.dayofweek(to_column(column)) + 12 - first_day) % 7 + first_number
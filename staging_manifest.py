@@ -0,0 +1,286 @@
+"""
+Manifest-driven staging loads, shared by the Redshift ETL (DataWarehouse/etl.py) and the
+Airflow StageToRedshiftOperator.
+
+Instead of pointing COPY at a bare S3 prefix, the source objects are listed and written to
+a COPY manifest.  Redshift loads one file per slice at a time, so thousands of tiny song
+files leave most slices idle while a few large files keep one slice busy.  Optionally, the
+objects are first compacted: they are grouped into batches of about the same size, one or
+more per slice, and each batch is written as one gzip'd JSON file, which the manifest then
+lists instead of the original objects.
+
+The object stores are small classes with the same methods:
+- S3Store: an S3 bucket, through a boto3 client
+- LocalStore: a folder on the local file system, used as a stand-in for S3
+
+copy_manifest_locally() emulates COPY ... JSON 'auto ignorecase' MANIFEST on a Postgres
+database, reading the files listed in a manifest from a LocalStore.
+
+Usage:
+
+    store = S3Store('udacity-dend', boto3.client('s3'))
+    manifest = build_manifest(store, 'song_data/', slices=8, compact_store=staging, compact_prefix='compacted/song_data/')
+    url = write_manifest(staging, 'manifests/songs_stage.manifest', manifest)
+"""
+import gzip
+import heapq
+import io
+import json
+import os
+import time
+
+
+class S3Store:
+    """
+    An S3 bucket, accessed with a boto3 S3 client.
+    """
+
+    def __init__(self, bucket, client):
+        self.bucket = bucket
+        self.client = client
+
+    def list_objects(self, prefix):
+        """
+        Returns the (key, size) of every object under the prefix.
+        """
+        objects = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if not item['Key'].endswith('/'):
+                    objects.append((item['Key'], item['Size']))
+        return objects
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def url(self, key):
+        return 's3://{}/{}'.format(self.bucket, key)
+
+
+class LocalStore:
+    """
+    A folder on the local file system, used as a stand-in for an S3 bucket.  Keys are paths
+    relative to the folder, with '/' separators.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def list_objects(self, prefix):
+        objects = []
+        for folder, dirs, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(folder, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    objects.append((key, os.path.getsize(os.path.join(folder, name))))
+        return sorted(objects)
+
+    def read(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def url(self, key):
+        return self.path(key)
+
+
+def balance_objects(objects, num_batches):
+    """
+    Splits the (key, size) objects into num_batches batches of about the same total size.
+    The objects are taken from the largest to the smallest, and each one is added to the
+    batch with the smallest total so far.  Returns the list of batches (lists of objects),
+    leaving out empty batches.
+    """
+    batches = [[] for i in range(num_batches)]
+    heap = [(0, i) for i in range(num_batches)]
+
+    for key, size in sorted(objects, key=lambda item: (-item[1], item[0])):
+        total, i = heapq.heappop(heap)
+        batches[i].append((key, size))
+        heapq.heappush(heap, (total + size, i))
+
+    return [batch for batch in batches if batch]
+
+
+def get_num_batches(total_size, slices, target_size):
+    """
+    Returns the number of compacted files to write: a multiple of the number of slices,
+    so that every slice loads the same number of files, with files of about target_size.
+    """
+    files_per_slice = max(1, -(-total_size // (slices * target_size)))
+    return slices * files_per_slice
+
+
+def compact_objects(store, batches, compact_store, compact_prefix):
+    """
+    Writes each batch of objects as one gzip'd file of newline separated JSON records in
+    compact_store.  Returns the (key, size) of the compacted files.
+    """
+    compacted = []
+    for i, batch in enumerate(batches):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            for key, size in batch:
+                data = store.read(key).strip()
+                if data:
+                    f.write(data)
+                    f.write(b'\n')
+
+        key = '{}part-{:05d}.json.gz'.format(compact_prefix, i)
+        compact_store.write(key, buf.getvalue())
+        compacted.append((key, len(buf.getvalue())))
+
+    return compacted
+
+
+def build_manifest(store, prefix, slices=1, compact_store=None, compact_prefix=None, target_size=64 * 1024 * 1024):
+    """
+    Lists the objects under the prefix, and returns a COPY manifest for them (as a dict).
+    If a compact store is given, the objects are first compacted into gzip'd files of about
+    target_size bytes (before compression), in a multiple of the number of slices, and the
+    manifest lists the compacted files.  The manifest's 'gzip' entry tells whether the COPY
+    needs the GZIP option.
+    """
+    objects = store.list_objects(prefix)
+    total_size = sum(size for key, size in objects)
+    gzipped = False
+
+    if compact_store is not None and objects:
+        batches = balance_objects(objects, get_num_batches(total_size, slices, target_size))
+        print('Compacting {} objects ({} bytes) into {} files'.format(len(objects), total_size, len(batches)))
+        objects = compact_objects(store, batches, compact_store, compact_prefix)
+        store = compact_store
+        gzipped = True
+
+    return {
+        'entries': [{'url': store.url(key), 'mandatory': True, 'meta': {'content_length': size}} for key, size in objects],
+        'gzip': gzipped,
+    }
+
+
+def write_manifest(store, key, manifest):
+    """
+    Writes a manifest in the COPY manifest format, and returns its URL.
+    """
+    store.write(key, json.dumps({'entries': manifest['entries']}, indent=2).encode('utf8'))
+    return store.url(key)
+
+
+def get_slice_count(cur, default=1):
+    """
+    Returns the number of slices of the Redshift cluster, or the default when the database
+    is not Redshift (e.g. a local Postgres stand-in).
+    """
+    try:
+        cur.execute("SELECT COUNT(*) FROM stv_slices;")
+        return cur.fetchone()[0] or default
+    except Exception:
+        cur.connection.rollback()
+        return default
+
+
+def read_json_records(data):
+    """
+    Returns the JSON records of a file: one or more JSON objects, one after the other, as
+    accepted by COPY ... JSON.
+    """
+    decoder = json.JSONDecoder()
+    text = data.decode('utf8')
+    records = []
+    position = 0
+
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return records
+        record, position = decoder.raw_decode(text, position)
+        records.append(record)
+
+
+def format_epoch_millis(value):
+    """
+    Returns the timestamp of epoch milliseconds, as loaded by TIMEFORMAT 'epochmillisecs'.
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(value / 1000.0)) + '.{:03d}'.format(int(value) % 1000)
+
+
+def copy_manifest_locally(cur, table, columns, manifest_path, epoch_millis_columns=(), empty_as_null=False):
+    """
+    Emulates COPY table FROM manifest JSON 'auto ignorecase' MANIFEST [GZIP] on a local
+    Postgres database, for files of a LocalStore: the files listed in the manifest are read
+    (and gunzip'd if their name ends with .gz), their fields are matched to the columns
+    ignoring case, and the rows are sent with COPY ... FROM STDIN.  Columns in
+    epoch_millis_columns are converted from epoch milliseconds to timestamps, like
+    TIMEFORMAT 'epochmillisecs', and empty strings are loaded as NULL if empty_as_null is set,
+    like EMPTYASNULL.  Returns the number of rows copied.
+    """
+    with open(manifest_path) as f:
+        entries = json.load(f)['entries']
+
+    buf = io.StringIO()
+    num_rows = 0
+    for entry in entries:
+        with open(entry['url'], 'rb') as f:
+            data = f.read()
+        if entry['url'].endswith('.gz'):
+            data = gzip.decompress(data)
+
+        for record in read_json_records(data):
+            record = {field.lower(): value for field, value in record.items()}
+            row = []
+            for column in columns:
+                value = record.get(column.lower())
+                if value == '' and empty_as_null:
+                    value = None
+                if value is not None and column in epoch_millis_columns:
+                    value = format_epoch_millis(value)
+                row.append(r'\N' if value is None else str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n'))
+            buf.write('\t'.join(row) + '\n')
+            num_rows += 1
+
+    buf.seek(0)
+    cur.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buf)
+    return num_rows
+
+
+def main():
+    """
+    Builds a manifest for a folder of the local file system, e.g. to try the compaction on a
+    data set of the benchmark before running it against S3.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a COPY manifest for the files under a prefix of a local folder.')
+    parser.add_argument('source', help='folder standing in for the source bucket')
+    parser.add_argument('prefix', help='prefix of the files to list, e.g. song_data/')
+    parser.add_argument('staging', help='folder standing in for the staging bucket')
+    parser.add_argument('--slices', type=int, default=1, help='number of slices to balance the files over (default: 1)')
+    parser.add_argument('--compact', action='store_true', help="combine the files into gzip'd files")
+    parser.add_argument('--target-file-size', type=int, default=64,
+                        help='size of the compacted files in MB, before compression (default: 64)')
+    args = parser.parse_args()
+
+    staging = LocalStore(args.staging)
+    name = args.prefix.strip('/').replace('/', '_')
+    manifest = build_manifest(LocalStore(args.source), args.prefix, args.slices,
+                              compact_store=staging if args.compact else None,
+                              compact_prefix='compacted/{}/'.format(name),
+                              target_size=args.target_file_size * 1024 * 1024)
+    url = write_manifest(staging, 'manifests/{}.manifest'.format(name), manifest)
+    print('Wrote a manifest of {} files to {}'.format(len(manifest['entries']), url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,801 @@
+"""
+Distribution style, sort key and compression encoding advisor for the Redshift schemas of
+the DataWarehouse and Capstone projects.
+
+The keys in sql_queries.py were chosen by hand.  The advisor reads a sql_queries.py module:
+- its CREATE TABLE statements give the tables, their columns and their current layout
+- its INSERT, DELETE, UPDATE and SELECT statements are the load workload, run once per load
+and a registered workload of analytic queries (a workload.sql file next to the module, with
+an optional '-- weight: N' comment giving the number of runs per load of each query).
+
+The joins, filters and columns read by every query are extracted, the cardinality of each
+column is measured (or estimated from the staging tables for tables that are still empty),
+and each table gets a recommended layout:
+- DISTSTYLE ALL for small tables joined with a much larger table
+- a DISTKEY on the most used join column of the other tables, preferring the columns that
+  colocate the join with a table already distributed on its side of the join
+- a compound SORTKEY on the most filtered columns (range filters first) and join keys
+- an encoding per column: RAW for a filtered leading sort key column, BYTEDICT for text columns
+  with few distinct values, AZ64 for numbers and times, ZSTD for other text
+
+The bytes scanned and moved between slices by each query are predicted with the current and
+the recommended layouts, and the recommended CREATE TABLE statements are written together
+with a deep copy migration script for existing tables.
+
+Usage (from the root of the repository, or with the stats saved by an earlier run):
+
+    python table_advisor.py DataWarehouse/sql_queries.py
+    python table_advisor.py Capstone/sql_queries.py --stats capstone_stats.json
+"""
+import argparse
+import configparser
+import importlib.util
+import json
+import os
+import re
+from collections import defaultdict
+
+from staging_manifest import get_slice_count
+
+
+# Bytes per value of the fixed width types
+TYPE_WIDTHS = {
+    'smallint': 2, 'int2': 2, 'int': 4, 'integer': 4, 'int4': 4, 'bigint': 8, 'int8': 8,
+    'decimal': 8, 'numeric': 8, 'real': 4, 'float4': 4, 'float': 8, 'float8': 8, 'double': 8,
+    'date': 4, 'timestamp': 8, 'timestamptz': 8, 'boolean': 1, 'bool': 1,
+}
+TEXT_TYPES = {'char', 'nchar', 'varchar', 'nvarchar', 'text', 'character', 'bpchar'}
+FLOAT_TYPES = {'real', 'float4', 'float', 'float8', 'double'}
+DEFAULT_TEXT_WIDTH = 32
+
+# Rough ratio of the encoded to the raw size of the encodings (BYTEDICT stores one byte per value)
+ENCODING_RATIOS = {'raw': 1.0, 'az64': 0.35, 'lzo': 0.5, 'zstd': 0.35}
+
+# Share of the blocks read by a range filter on the leading sort key column
+DEFAULT_RANGE_SELECTIVITY = 0.1
+
+# Tables up to this number of rows, joined with a table ALL_MIN_RATIO times larger, are copied to every node
+DEFAULT_ALL_MAX_ROWS = 1000000
+ALL_MIN_RATIO = 10
+
+# A distribution key needs this many distinct values per slice to spread the rows evenly
+MIN_DISTINCT_PER_SLICE = 10
+
+MAX_SORTKEY_COLUMNS = 3
+
+SUBQUERY = re.compile(r'\(\s*(select|with)\b')
+
+SQL_KEYWORDS = {
+    'select', 'from', 'where', 'join', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'on',
+    'using', 'group', 'order', 'by', 'having', 'limit', 'union', 'set', 'as', 'and', 'or', 'not',
+    'in', 'is', 'null', 'between', 'distinct', 'case', 'when', 'then', 'else', 'end', 'into',
+    'values', 'over', 'partition', 'desc', 'asc', 'natural', 'temp', 'table', 'with', 'exists',
+}
+
+# A table read by a statement, with its alias
+TABLE_REFERENCE = re.compile(r'\b(from|join|using|update)\s+(\w+)(?:\s+(?:as\s+)?(?!(?:{})\b)(\w+))?'.format(
+    '|'.join(sorted(SQL_KEYWORDS))))
+
+
+def load_queries(path):
+    """
+    Imports a sql_queries.py module, and returns its (name, statement) strings in the order
+    of the module.  The module is imported from its folder, as it reads its config file from
+    the current folder.
+    """
+    path = os.path.abspath(path)
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        spec = importlib.util.spec_from_file_location('advised_sql_queries', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+
+    return [(name, value) for name, value in vars(module).items()
+            if isinstance(value, str) and not name.startswith('_')]
+
+
+def load_workload(path):
+    """
+    Returns the (name, statement, weight) queries of a workload file.  The queries are separated
+    by semicolons; the comments before a query give its name, and a '-- weight: N' comment the
+    number of times it runs per load (1 by default).
+    """
+    queries = []
+    with open(path) as f:
+        text = f.read()
+
+    for chunk in text.split(';'):
+        weight = 1.0
+        comments = []
+        lines = []
+        for line in chunk.splitlines():
+            stripped = line.strip()
+            if not stripped and not lines:
+                # a blank line ends the comments that are not about the query
+                weight = 1.0
+                comments = []
+                continue
+            match = re.match(r'--\s*weight:\s*([\d.]+)', stripped, re.I)
+            if match:
+                weight = float(match.group(1))
+            elif stripped.startswith('--'):
+                comments.append(stripped.lstrip('-').strip())
+            else:
+                lines.append(line)
+
+        if lines:
+            name = comments[0] if comments else 'workload query {}'.format(len(queries) + 1)
+            queries.append((name, '\n'.join(lines) + ';', weight))
+
+    return queries
+
+
+def find_closing(text, start):
+    """
+    Returns the index of the parenthesis closing the one at start.
+    """
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError('unbalanced parentheses: {}'.format(text[start:start + 80]))
+
+
+def split_top_level(text):
+    """
+    Splits a text on the commas outside of parentheses.
+    """
+    parts = []
+    depth = 0
+    current = ''
+    for char in text:
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    parts.append(current)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def parse_column(definition):
+    """
+    Parses a column definition into its name, type, base type (e.g. varchar), IDENTITY clause,
+    constraints and inline DISTKEY, SORTKEY and ENCODE attributes.
+    """
+    match = re.match(r'(\w+)\s+((?:double\s+precision|character\s+varying|\w+)(?:\s*\([^)]*\))?)(.*)$',
+                     definition, re.I | re.S)
+    name, column_type, rest = match.group(1), match.group(2), match.group(3)
+
+    identity = re.search(r'\bIDENTITY\s*\([^)]*\)', rest, re.I)
+    encoding = re.search(r'\bENCODE\s+(\w+)', rest, re.I)
+    constraints = re.sub(r'\bIDENTITY\s*\([^)]*\)|\bENCODE\s+\w+|\bDISTKEY\b|\bSORTKEY\b', '', rest, flags=re.I)
+
+    return {
+        'name': name.lower(),
+        'type': ' '.join(column_type.split()),
+        'base_type': column_type.split('(')[0].split()[0].lower(),
+        'length': int(re.search(r'\((\d+)', column_type).group(1)) if re.search(r'\((\d+)', column_type) else None,
+        'identity': ' '.join(identity.group(0).split()) if identity else None,
+        'constraints': ' '.join(constraints.split()),
+        'distkey': bool(re.search(r'\bDISTKEY\b', rest, re.I)),
+        'sortkey': bool(re.search(r'\bSORTKEY\b', rest, re.I)),
+        'encoding': encoding.group(1).lower() if encoding else None,
+    }
+
+
+def parse_create_table(statement):
+    """
+    Parses a CREATE TABLE statement into a table: its name, columns, table constraints and
+    current layout (distribution style, distribution key, sort key and encodings).
+    Returns None if the statement is not a CREATE TABLE.
+    """
+    match = re.match(r'\s*CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)\s*\(', statement, re.I)
+    if match is None:
+        return None
+
+    end = find_closing(statement, match.end() - 1)
+    body = statement[match.end():end]
+    tail = statement[end + 1:]
+
+    columns = []
+    constraints = []
+    for item in split_top_level(body):
+        if re.match(r'(PRIMARY\s+KEY|UNIQUE|FOREIGN\s+KEY|CONSTRAINT)\b', item, re.I):
+            constraints.append(' '.join(item.split()))
+        else:
+            columns.append(parse_column(item))
+
+    diststyle = re.search(r'\bDISTSTYLE\s+(\w+)', tail, re.I)
+    distkey = re.search(r'\bDISTKEY\s*\(\s*(\w+)\s*\)', tail, re.I)
+    sortkey = re.search(r'\bSORTKEY\s*\(([^)]*)\)', tail, re.I)
+
+    layout = {
+        'diststyle': diststyle.group(1).lower() if diststyle else 'auto',
+        'distkey': distkey.group(1).lower() if distkey else None,
+        'sortkey': [name.strip().lower() for name in sortkey.group(1).split(',')] if sortkey else [],
+    }
+    for column in columns:
+        if column['distkey']:
+            layout['distkey'] = column['name']
+        if column['sortkey']:
+            layout['sortkey'] = [column['name']]
+    if layout['distkey']:
+        layout['diststyle'] = 'key'
+    layout['encodings'] = {column['name']: column['encoding'] or get_default_encoding(column, layout['sortkey'])
+                           for column in columns}
+
+    return {
+        'name': match.group(2).lower(),
+        'if_not_exists': bool(match.group(1)),
+        'columns': columns,
+        'constraints': constraints,
+        'layout': layout,
+    }
+
+
+def get_default_encoding(column, sortkey):
+    """
+    Returns the encoding Redshift gives a column created without ENCODE.
+    """
+    if column['name'] in sortkey or column['base_type'] in FLOAT_TYPES or column['base_type'] in ('boolean', 'bool'):
+        return 'raw'
+    if column['base_type'] in TEXT_TYPES:
+        return 'lzo'
+    return 'az64'
+
+
+def strip_sql(sql):
+    """
+    Lower cases a statement, removes its comments, and replaces its string literals and
+    parameters with '?', so that they cannot be mistaken for names.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "'?'", sql)
+    sql = re.sub(r'--[^\n]*', ' ', sql)
+    sql = sql.replace('%s', "'?'")
+    return ' '.join(sql.lower().split())
+
+
+def split_scopes(sql):
+    """
+    Returns the scopes of a statement: the statement and each of its subqueries, with the
+    subqueries they contain replaced by a placeholder, so that names are resolved against
+    the tables of their own scope.
+    """
+    scopes = []
+
+    def extract(text):
+        parts = []
+        i = 0
+        while i < len(text):
+            if SUBQUERY.match(text, i):
+                end = find_closing(text, i)
+                scopes.append(extract(text[i + 1:end]))
+                parts.append(' __subquery__ ')
+                i = end + 1
+            else:
+                parts.append(text[i])
+                i += 1
+        return ''.join(parts)
+
+    scopes.append(extract(sql))
+    return scopes
+
+
+def analyze_query(sql, tables):
+    """
+    Returns the columns read by a statement, its join predicates and its filters:
+    - columns: {table: set of columns}
+    - joins: {(table, other table): [((table, column), (other table, column))]}
+    - filters: [(table, column, 'eq' or 'range')], for comparisons with a literal or parameter
+    The table an INSERT writes to is not read.
+    """
+    columns = defaultdict(set)
+    joins = defaultdict(list)
+    filters = []
+
+    for scope in split_scopes(strip_sql(sql)):
+        aliases = {}
+        for match in TABLE_REFERENCE.finditer(scope):
+            if match.group(2) not in tables:
+                continue
+            aliases[match.group(2)] = match.group(2)
+            if match.group(3):
+                aliases[match.group(3)] = match.group(2)
+        scope_tables = set(aliases.values())
+
+        def resolve(ref):
+            if '.' in ref:
+                alias, name = ref.split('.', 1)
+                table = aliases.get(alias)
+                if table and any(column['name'] == name for column in tables[table]['columns']):
+                    return table, name
+                return None
+            owners = [table for table in scope_tables if any(column['name'] == ref for column in tables[table]['columns'])]
+            return (owners[0], ref) if len(owners) == 1 else None
+
+        if re.search(r'\bselect\s+(distinct\s+)?\*', scope):
+            for table in scope_tables:
+                columns[table].update(column['name'] for column in tables[table]['columns'])
+
+        for match in re.finditer(r'(?<![\w.])(\w+(?:\.\w+)?)(?![\w.]|\s*\()', scope):
+            if match.group(1) in SQL_KEYWORDS:
+                continue
+            resolved = resolve(match.group(1))
+            if resolved:
+                columns[resolved[0]].add(resolved[1])
+
+        ref = r'(?<![\w.])(\w+(?:\.\w+)?)'
+        for match in re.finditer(ref + r'\s*=\s*' + ref + r'(?![\w.(])', scope):
+            left, right = resolve(match.group(1)), resolve(match.group(2))
+            if left and right and left[0] != right[0]:
+                pair = tuple(sorted([left, right]))
+                joins[(pair[0][0], pair[1][0])].append(pair)
+
+        for match in re.finditer(ref + r"\s*(=|<=|>=|<|>)\s*('\?'|-?\d)", scope):
+            resolved = resolve(match.group(1))
+            if resolved:
+                filters.append(resolved + ('eq' if match.group(2) == '=' else 'range',))
+        for match in re.finditer(ref + r"\s+(between|in)\s*(\(\s*)?('\?'|-?\d)", scope):
+            resolved = resolve(match.group(1))
+            if resolved:
+                filters.append(resolved + ('range' if match.group(2) == 'between' else 'eq',))
+
+    return {'columns': dict(columns), 'joins': dict(joins), 'filters': sorted(set(filters))}
+
+
+def get_insert_selects(statements, tables):
+    """
+    Returns the SELECT of the INSERT statements of each table, with the columns it produces:
+    {table: [(columns, select)]}, in the order of the module.
+    """
+    selects = defaultdict(list)
+    for name, statement in statements:
+        match = re.match(r'\s*INSERT\s+INTO\s+(\w+)\s*(?:\(([^)]*)\))?\s*(SELECT\b.*?);?\s*$', statement, re.I | re.S)
+        if match is None or match.group(1).lower() not in tables:
+            continue
+        table = tables[match.group(1).lower()]
+        if match.group(2):
+            names = [column.strip().lower() for column in match.group(2).split(',')]
+        else:
+            names = [column['name'] for column in table['columns']]
+        selects[table['name']].append((names, match.group(3)))
+    return selects
+
+
+def profile_columns(cur, table, names, source):
+    """
+    Returns the number of rows of a source (a table, or the SELECT of an INSERT) and the
+    number of distinct values and the average width of the given columns of a table.
+    """
+    by_name = {column['name']: column for column in table['columns']}
+    expressions = ['COUNT(*)']
+    for name in names:
+        expressions.append('COUNT(DISTINCT {})'.format(name))
+        if by_name[name]['base_type'] in TEXT_TYPES:
+            expressions.append('AVG(OCTET_LENGTH({}))'.format(name))
+
+    cur.execute('{} SELECT {} FROM source;'.format(source, ', '.join(expressions)))
+    values = list(cur.fetchone())
+    rows = values.pop(0) or 0
+
+    profile = {}
+    for name in names:
+        profile[name] = {'distinct': values.pop(0) or 0}
+        if by_name[name]['base_type'] in TEXT_TYPES:
+            width = values.pop(0)
+            profile[name]['width'] = round(float(width), 1) if width is not None else None
+    return rows, profile
+
+
+def collect_stats(cur, tables, selects, slices=None):
+    """
+    Measures the rows of each table and the distinct values and widths of its columns.
+    Tables that hold rows are measured directly.  Empty tables (e.g. before the first load)
+    are estimated from the SELECT of their INSERT over the staging tables.
+    """
+    stats = {'slices': slices or get_slice_count(cur), 'tables': {}}
+
+    for table in tables.values():
+        names = [column['name'] for column in table['columns']]
+        try:
+            rows, profile = profile_columns(cur, table, names, 'WITH source AS (SELECT * FROM {})'.format(table['name']))
+            source = 'table'
+        except Exception:
+            cur.connection.rollback()
+            rows, profile, source = 0, {}, 'missing'
+
+        if rows == 0:
+            for select_names, select in selects.get(table['name'], []):
+                try:
+                    query = 'WITH source ({}) AS ({})'.format(', '.join(select_names), select)
+                    rows, profile = profile_columns(cur, table, select_names, query)
+                    source = 'staging'
+                    break
+                except Exception:
+                    cur.connection.rollback()
+
+        # IDENTITY columns are not produced by the INSERT, and have one value per row
+        for column in table['columns']:
+            if column['identity'] and column['name'] not in profile:
+                profile[column['name']] = {'distinct': rows}
+
+        stats['tables'][table['name']] = {'rows': rows, 'source': source, 'columns': profile}
+        print('\t{}: {} rows ({})'.format(table['name'], rows, source))
+
+    return stats
+
+
+def get_width(table, column, stats):
+    """
+    Returns the average bytes per value of a column.
+    """
+    if column['base_type'] in TEXT_TYPES:
+        measured = stats['tables'].get(table['name'], {}).get('columns', {}).get(column['name'], {}).get('width')
+        if measured is not None:
+            return max(measured, 1.0)
+        if column['base_type'] in ('char', 'nchar', 'character', 'bpchar') and column['length']:
+            return float(column['length'])
+        return float(DEFAULT_TEXT_WIDTH)
+    return float(TYPE_WIDTHS.get(column['base_type'], 8))
+
+
+def get_encoded_width(table, column, encoding, stats):
+    width = get_width(table, column, stats)
+    if encoding == 'bytedict':
+        return min(width, 1.0)
+    return width * ENCODING_RATIOS.get(encoding, 1.0)
+
+
+def get_distinct(table, name, stats):
+    return stats['tables'].get(table, {}).get('columns', {}).get(name, {}).get('distinct')
+
+
+def get_rows(table, stats):
+    return stats['tables'].get(table, {}).get('rows', 0)
+
+
+def get_usage(analyses):
+    """
+    Sums the weighted join and filter usage of each column over the analyzed queries:
+    {table: {'joins': {column: {(other table, other column): weight}}, 'filters': {column: {'eq': weight, 'range': weight}}}}
+    """
+    usage = defaultdict(lambda: {'joins': defaultdict(lambda: defaultdict(float)),
+                                 'filters': defaultdict(lambda: defaultdict(float))})
+    for analysis in analyses:
+        weight = analysis['weight']
+        for predicates in analysis['joins'].values():
+            for (table, column), (other_table, other_column) in predicates:
+                usage[table]['joins'][column][(other_table, other_column)] += weight
+                usage[other_table]['joins'][other_column][(table, column)] += weight
+        for table, column, kind in analysis['filters']:
+            usage[table]['filters'][column][kind] += weight
+    return usage
+
+
+def recommend_encoding(table, column, sortkey, filtered, stats):
+    """
+    Returns the encoding of a column.  A leading sort key column used by filters is left RAW,
+    so that its blocks hold as many rows as the blocks of the other columns, and the zone maps
+    skip the same rows in every column.
+    """
+    if (sortkey and column['name'] == sortkey[0] and filtered) or column['base_type'] in FLOAT_TYPES or \
+            column['base_type'] in ('boolean', 'bool'):
+        return 'raw'
+    if column['base_type'] in TEXT_TYPES:
+        distinct = get_distinct(table['name'], column['name'], stats)
+        return 'bytedict' if distinct is not None and 0 < distinct <= 256 else 'zstd'
+    return 'az64'
+
+
+def recommend(tables, usage, stats, all_max_rows=DEFAULT_ALL_MAX_ROWS):
+    """
+    Returns the recommended layout of each table:
+    1. Small tables joined with a much larger table are copied to every node (DISTSTYLE ALL)
+    2. From the largest table down, the other tables are distributed on their most used join
+       column with enough distinct values (as measured), with twice the weight for the joins colocated with
+       a table already distributed on its side of the join.  Tables without such a column are
+       distributed EVEN when large, and left to AUTO when small.  Tables without rows keep
+       their distribution.
+    3. The sort key holds the columns with the most weighted filters (range filters count
+       twice, join keys half), up to MAX_SORTKEY_COLUMNS
+    4. Encodings as described in recommend_encoding()
+    """
+    layouts = {}
+    for name, table in tables.items():
+        if get_rows(name, stats) == 0:
+            # without rows to measure, the distribution is left as it is
+            layouts[name] = {'diststyle': table['layout']['diststyle'], 'distkey': table['layout']['distkey']}
+            continue
+        partners = {other for column in usage[name]['joins'].values() for other, _ in column}
+        if partners and 0 < get_rows(name, stats) <= all_max_rows and \
+                any(get_rows(other, stats) >= ALL_MIN_RATIO * get_rows(name, stats) for other in partners):
+            layouts[name] = {'diststyle': 'all', 'distkey': None}
+
+    for name in sorted(tables, key=lambda name: -get_rows(name, stats)):
+        if name in layouts:
+            continue
+        scores = {}
+        for column, edges in usage[name]['joins'].items():
+            distinct = get_distinct(name, column, stats)
+            if distinct is None or distinct < stats['slices'] * MIN_DISTINCT_PER_SLICE:
+                continue
+            score = 0.0
+            for (other, other_column), weight in edges.items():
+                other_layout = layouts.get(other, {})
+                if other_layout.get('diststyle') == 'all':
+                    continue
+                score += weight * (2 if other_layout.get('distkey') == other_column else 1)
+            if score > 0:
+                scores[column] = (score, distinct)
+
+        if scores:
+            layouts[name] = {'diststyle': 'key', 'distkey': max(scores, key=lambda column: (scores[column], column))}
+        elif get_rows(name, stats) > all_max_rows:
+            layouts[name] = {'diststyle': 'even', 'distkey': None}
+        else:
+            layouts[name] = {'diststyle': 'auto', 'distkey': None}
+
+    for name, table in tables.items():
+        scores = {}
+        for column in table['columns']:
+            filters = usage[name]['filters'].get(column['name'], {})
+            joins = usage[name]['joins'].get(column['name'], {})
+            score = 2 * filters.get('range', 0) + filters.get('eq', 0) + 0.5 * sum(joins.values())
+            if score > 0:
+                scores[column['name']] = (score, sum(filters.values()))
+
+        # sorted() is stable, so columns with the same score keep the order of the table
+        sortkey = sorted(scores, key=lambda column: -scores[column][0])[:MAX_SORTKEY_COLUMNS]
+        layouts[name]['sortkey'] = sortkey
+        filtered = bool(sortkey) and scores[sortkey[0]][1] > 0
+        layouts[name]['encodings'] = {column['name']: recommend_encoding(table, column, sortkey, filtered, stats)
+                                      for column in table['columns']}
+
+    return layouts
+
+
+def get_effective_diststyle(name, layout, stats, all_max_rows):
+    """
+    Returns the distribution style a table gets: AUTO is ALL for small tables, EVEN otherwise.
+    """
+    if layout['diststyle'] == 'auto':
+        return 'all' if get_rows(name, stats) <= all_max_rows else 'even'
+    return layout['diststyle']
+
+
+def predict_query_bytes(analysis, tables, layouts, stats, all_max_rows=DEFAULT_ALL_MAX_ROWS):
+    """
+    Predicts the bytes a query scans and moves between slices with the given layouts:
+    - a table scans the encoded columns read by the query, and only the share of the blocks
+      selected by a filter on its leading sort key column (1 / distinct values for an
+      equality, DEFAULT_RANGE_SELECTIVITY for a range)
+    - a join that is not colocated (neither table ALL, and not both distributed on the join
+      columns) moves the smaller side to the slices of the other
+    Returns (scanned bytes, moved bytes).
+    """
+    scanned = {}
+    for name, names in analysis['columns'].items():
+        table = tables[name]
+        layout = layouts[name]
+        width = sum(get_encoded_width(table, column, layout['encodings'][column['name']], stats)
+                    for column in table['columns'] if column['name'] in names)
+
+        fraction = 1.0
+        for filtered, column, kind in analysis['filters']:
+            if filtered == name and layout['sortkey'] and column == layout['sortkey'][0]:
+                distinct = get_distinct(name, column, stats)
+                selectivity = DEFAULT_RANGE_SELECTIVITY if kind == 'range' or not distinct else 1.0 / distinct
+                fraction = min(fraction, selectivity)
+
+        scanned[name] = get_rows(name, stats) * width * fraction
+
+    moved = 0.0
+    for (name, other), predicates in analysis['joins'].items():
+        styles = [get_effective_diststyle(table, layouts[table], stats, all_max_rows) for table in (name, other)]
+        if 'all' in styles:
+            continue
+        if any(layouts[name]['distkey'] == column and layouts[other]['distkey'] == other_column
+               for (_, column), (_, other_column) in predicates):
+            continue
+        moved += min(scanned.get(name, 0.0), scanned.get(other, 0.0))
+
+    return sum(scanned.values()), moved
+
+
+def render_layout(layout):
+    parts = ['DISTSTYLE {}'.format(layout['diststyle'].upper())]
+    if layout['distkey']:
+        parts.append('DISTKEY ({})'.format(layout['distkey']))
+    if layout['sortkey']:
+        parts.append('COMPOUND SORTKEY ({})'.format(', '.join(layout['sortkey'])))
+    return parts
+
+
+def render_create_table(table, layout, name=None, if_not_exists=None):
+    """
+    Returns the CREATE TABLE statement of a table with a layout.
+    """
+    lines = []
+    for column in table['columns']:
+        parts = [column['name'], column['type']]
+        if column['identity']:
+            parts.append(column['identity'])
+        parts.append('ENCODE {}'.format(layout['encodings'][column['name']]))
+        if column['constraints']:
+            parts.append(column['constraints'])
+        lines.append('    ' + ' '.join(parts))
+    lines.extend('    ' + constraint for constraint in table['constraints'])
+
+    if if_not_exists is None:
+        if_not_exists = table['if_not_exists']
+    return 'CREATE TABLE {}{} (\n{}\n)\n{};'.format('IF NOT EXISTS ' if if_not_exists else '', name or table['name'],
+                                                  ',\n'.join(lines), '\n'.join(render_layout(layout)))
+
+
+def render_deep_copy(table, layout):
+    """
+    Returns the deep copy migration of an existing table to a new layout: the rows are copied
+    into a new table created with the layout, which then replaces the old table, in one
+    transaction.
+    """
+    name = table['name']
+    copied = [column['name'] for column in table['columns'] if not column['identity']]
+    lines = ['-- {}: {} -> {}'.format(name, ' '.join(render_layout(table['layout'])), ' '.join(render_layout(layout)))]
+    for column in table['columns']:
+        if column['identity']:
+            lines.append('-- {} is an IDENTITY column: the copy numbers the rows again'.format(column['name']))
+
+    lines += [
+        'BEGIN;',
+        render_create_table(table, layout, name + '_deep_copy', False),
+        'INSERT INTO {}_deep_copy ({}) SELECT {} FROM {};'.format(name, ', '.join(copied), ', '.join(copied), name),
+        'ALTER TABLE {} RENAME TO {}_before_deep_copy;'.format(name, name),
+        'ALTER TABLE {}_deep_copy RENAME TO {};'.format(name, name),
+        'DROP TABLE {}_before_deep_copy;'.format(name),
+        'COMMIT;',
+        'ANALYZE {};'.format(name),
+    ]
+    return '\n'.join(lines)
+
+
+def advise(statements, workload, stats, all_max_rows=DEFAULT_ALL_MAX_ROWS, load_weight=1.0):
+    """
+    Returns the tables of the module, their recommended layouts, and the predicted bytes
+    scanned and moved by each query with the current and the recommended layouts.
+    """
+    tables = {}
+    for name, statement in statements:
+        table = parse_create_table(statement)
+        if table:
+            tables[table['name']] = table
+
+    queries = [(name, statement, load_weight) for name, statement in statements
+               if re.match(r'\s*(INSERT|DELETE|UPDATE|SELECT)\b', statement, re.I)] + workload
+
+    analyses = []
+    for name, statement, weight in queries:
+        analysis = analyze_query(statement, tables)
+        analysis.update(name=name, weight=weight)
+        analyses.append(analysis)
+
+    layouts = recommend(tables, get_usage(analyses), stats, all_max_rows)
+    current = {name: table['layout'] for name, table in tables.items()}
+
+    predictions = []
+    for analysis in analyses:
+        before = predict_query_bytes(analysis, tables, current, stats, all_max_rows)
+        after = predict_query_bytes(analysis, tables, layouts, stats, all_max_rows)
+        predictions.append({'name': analysis['name'], 'weight': analysis['weight'],
+                            'current': {'scanned_bytes': round(before[0]), 'moved_bytes': round(before[1])},
+                            'recommended': {'scanned_bytes': round(after[0]), 'moved_bytes': round(after[1])}})
+
+    return tables, layouts, predictions
+
+
+def get_saving(before, after):
+    return 'n/a' if before == 0 else '{:.0f}%'.format((before - after) * 100.0 / before)
+
+
+def print_report(tables, layouts, predictions, stats):
+    print('\nTables:')
+    for name, table in tables.items():
+        print('  {} ({} rows)'.format(name, get_rows(name, stats)))
+        print('    current:     {}'.format(' '.join(render_layout(table['layout']))))
+        print('    recommended: {}'.format(' '.join(render_layout(layouts[name]))))
+
+    print('\nPredicted MB scanned + moved per run:')
+    row_format = '  {:<52} {:>7} {:>12} {:>12} {:>7}'
+    print(row_format.format('query', 'weight', 'current', 'recommended', 'saving'))
+    total_before = total_after = 0.0
+    for prediction in predictions:
+        before = sum(prediction['current'].values()) / 1e6
+        after = sum(prediction['recommended'].values()) / 1e6
+        total_before += before * prediction['weight']
+        total_after += after * prediction['weight']
+        print(row_format.format(prediction['name'][:52], '{:g}'.format(prediction['weight']), '{:.2f}'.format(before),
+                                '{:.2f}'.format(after), get_saving(before, after)))
+    print(row_format.format('weighted total per load', '', '{:.2f}'.format(total_before), '{:.2f}'.format(total_after),
+                            get_saving(total_before, total_after)))
+
+
+def main():
+    """
+    Recommends the layout of the tables of a sql_queries.py module, and writes the recommended
+    DDL, a deep copy migration script and a JSON report to the output folder.
+    """
+    parser = argparse.ArgumentParser(description='Recommend distribution styles, sort keys and encodings for a Redshift schema.')
+    parser.add_argument('queries', help='sql_queries.py module of the project, e.g. DataWarehouse/sql_queries.py')
+    parser.add_argument('--workload', default=None,
+                        help='file of analytic queries (default: workload.sql next to the module, if any)')
+    parser.add_argument('--stats', default=None,
+                        help='JSON file of table stats saved by an earlier run, instead of connecting to the cluster')
+    parser.add_argument('--save-stats', default=None, help='write the stats measured on the cluster to this JSON file')
+    parser.add_argument('--config', default=None, help='config file with the CLUSTER section (default: dwh.cfg next to the module)')
+    parser.add_argument('--slices', type=int, default=None, help='number of slices of the cluster (default: measured)')
+    parser.add_argument('--all-max-rows', type=int, default=DEFAULT_ALL_MAX_ROWS,
+                        help='largest table copied to every node (default: {})'.format(DEFAULT_ALL_MAX_ROWS))
+    parser.add_argument('--load-weight', type=float, default=1.0,
+                        help='number of runs of the statements of the module per load (default: 1)')
+    parser.add_argument('--output', default=None, help='output folder (default: advice/ next to the module)')
+    args = parser.parse_args()
+
+    folder = os.path.dirname(os.path.abspath(args.queries))
+    statements = load_queries(args.queries)
+
+    workload_path = args.workload or os.path.join(folder, 'workload.sql')
+    workload = load_workload(workload_path) if args.workload or os.path.exists(workload_path) else []
+    print('{} statements in {}, {} queries in the workload'.format(len(statements), args.queries, len(workload)))
+
+    if args.stats:
+        with open(args.stats) as f:
+            stats = json.load(f)
+        if args.slices:
+            stats['slices'] = args.slices
+    else:
+        import psycopg2
+
+        config = configparser.ConfigParser()
+        config.read(args.config or os.path.join(folder, 'dwh.cfg'))
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        tables = {table['name']: table for table in filter(None, (parse_create_table(statement) for name, statement in statements))}
+        print('Measuring the tables:')
+        stats = collect_stats(conn.cursor(), tables, get_insert_selects(statements, tables), args.slices)
+        conn.close()
+        if args.save_stats:
+            with open(args.save_stats, 'w') as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
+
+    tables, layouts, predictions = advise(statements, workload, stats, args.all_max_rows, args.load_weight)
+    print_report(tables, layouts, predictions, stats)
+
+    output = args.output or os.path.join(folder, 'advice')
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, 'recommended_ddl.sql'), 'w') as f:
+        f.write('\n\n'.join(render_create_table(table, layouts[name]) for name, table in tables.items()) + '\n')
+
+    changed = [name for name, table in tables.items()
+               if render_create_table(table, table['layout']) != render_create_table(table, layouts[name])]
+    with open(os.path.join(output, 'deep_copy_migration.sql'), 'w') as f:
+        f.write('-- Deep copy of the existing tables whose layout changes, one transaction per table.\n')
+        f.write('-- The tables are not available to writers during their copy.\n\n')
+        f.write('\n\n'.join(render_deep_copy(tables[name], layouts[name]) for name in changed) + '\n')
+
+    with open(os.path.join(output, 'advice.json'), 'w') as f:
+        json.dump({'stats': stats, 'tables': {name: {'current': table['layout'], 'recommended': layouts[name]}
+                                              for name, table in tables.items()},
+                   'queries': predictions}, f, indent=2, sort_keys=True)
+
+    print('\nRecommended DDL, deep copy migration of {} tables and report written to {}'.format(len(changed), output))
+
+
+if __name__ == "__main__":
+    main()